@@ -43,7 +43,7 @@ class ConfigManager:
         
         self._config["model"] = config["OpenAI"].get("MODEL", "gpt-4o")
         self._config["embedding_model"] = config["OpenAI"].get("EMBEDDING_MODEL", "text-embedding-3-small")
-        if config["OpenAI"].get("API_TYPE") == "azure":
+        if config["OpenAI"].get("API_TYPE") in ("azure", "azure_async"):
             self._config["azure_embedding_model_api_version"] = config["OpenAI"].get("AZURE_EMBEDDING_MODEL_API_VERSION", "2023-05-15")
         self._config["reasoning_model"] = config["OpenAI"].get("REASONING_MODEL", "o3-mini")
 
@@ -59,20 +59,42 @@ class ConfigManager:
         self._config["max_attempts"] = float(config["OpenAI"].get("MAX_ATTEMPTS", "0.0"))
         self._config["waiting_time"] = float(config["OpenAI"].get("WAITING_TIME", "1"))
         self._config["exponential_backoff_factor"] = float(config["OpenAI"].get("EXPONENTIAL_BACKOFF_FACTOR", "5"))
+        self._config["max_concurrent_requests"] = config["OpenAI"].getint("MAX_CONCURRENT_REQUESTS", 64)
+        self._config["requests_per_minute"] = config["OpenAI"].getfloat("REQUESTS_PER_MINUTE", 0)
+        self._config["tokens_per_minute"] = config["OpenAI"].getfloat("TOKENS_PER_MINUTE", 0)
 
         self._config["cache_api_calls"] = config["OpenAI"].getboolean("CACHE_API_CALLS", False)
-        self._config["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "openai_api_cache.pickle")
+        self._config["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "openai_api_cache.sqlite")
+        self._config["cache_max_entries"] = config["OpenAI"].getint("CACHE_MAX_ENTRIES", 0)
+        self._config["cache_max_age_days"] = config["OpenAI"].getfloat("CACHE_MAX_AGE_DAYS", 0)
+        self._config["cache_embeddings"] = config["OpenAI"].getboolean("CACHE_EMBEDDINGS", True)
+        self._config["embedding_cache_file_name"] = config["OpenAI"].get("EMBEDDING_CACHE_FILE_NAME", "tinytroupe_embeddings_cache")
 
         self._config["max_content_display_length"] = config["OpenAI"].getint("MAX_CONTENT_DISPLAY_LENGTH", 1024)
 
         self._config["parallel_agent_actions"] = config["Simulation"].getboolean("PARALLEL_AGENT_ACTIONS", True)
         self._config["parallel_agent_generation"] = config["Simulation"].getboolean("PARALLEL_AGENT_GENERATION", True)
+        self._config["step_executor"] = config["Simulation"].get("STEP_EXECUTOR", "thread")
+        self._config["step_executor_workers"] = config["Simulation"].getint("STEP_EXECUTOR_WORKERS", 0)
+        self._config["stream_agent_actions"] = config["Simulation"].getboolean("STREAM_AGENT_ACTIONS", False)
+        self._config["agent_scheduling"] = config["Simulation"].get("AGENT_SCHEDULING", "all")
+        self._config["checkpoint_keyframe_interval"] = config["Simulation"].getint("CHECKPOINT_KEYFRAME_INTERVAL", 20)
+        self._config["trace_compression"] = config["Simulation"].getboolean("TRACE_COMPRESSION", True)
+        self._config["fast_forward_replay"] = config["Simulation"].getboolean("FAST_FORWARD_REPLAY", False)
+        self._config["background_checkpointing"] = config["Simulation"].getboolean("BACKGROUND_CHECKPOINTING", True)
+        self._config["checkpoint_every_n_transactions"] = config["Simulation"].getint("CHECKPOINT_EVERY_N_TRANSACTIONS", 1)
+        self._config["checkpoint_min_interval_seconds"] = config["Simulation"].getfloat("CHECKPOINT_MIN_INTERVAL_SECONDS", 0)
 
         self._config["enable_memory_consolidation"] = config["Cognition"].get("ENABLE_MEMORY_CONSOLIDATION", True)
         self._config["min_episode_length"] = config["Cognition"].getint("MIN_EPISODE_LENGTH", 30)
         self._config["max_episode_length"] = config["Cognition"].getint("MAX_EPISODE_LENGTH", 100)  
         self._config["episodic_memory_fixed_prefix_length"] = config["Cognition"].getint("EPISODIC_MEMORY_FIXED_PREFIX_LENGTH", 20)
         self._config["episodic_memory_lookback_length"] = config["Cognition"].getint("EPISODIC_MEMORY_LOOKBACK_LENGTH", 20)
+        self._config["memory_context_refresh"] = config["Cognition"].get("MEMORY_CONTEXT_REFRESH", "context_change")
+        self._config["memory_context_similarity_threshold"] = config["Cognition"].getfloat("MEMORY_CONTEXT_SIMILARITY_THRESHOLD", 0.9)
+        self._config["grounding_vector_index"] = config["Cognition"].get("GROUNDING_VECTOR_INDEX", "llama_index")
+        self._config["grounding_ivf_lists"] = config["Cognition"].getint("GROUNDING_IVF_LISTS", 0)
+        self._config["grounding_ivf_probes"] = config["Cognition"].getint("GROUNDING_IVF_PROBES", 8)
 
         self._config["action_generator_max_attempts"] = config["ActionGenerator"].getint("MAX_ATTEMPTS", 2)
         self._config["action_generator_enable_quality_checks"] = config["ActionGenerator"].getboolean("ENABLE_QUALITY_CHECKS", False)
@@ -228,12 +250,8 @@ def get_config(key, override_value=None):
 ## LLaMa-Index configs ########################################################
 #from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
-if config["OpenAI"].get("API_TYPE") == "azure":
-    from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-else:
-    from llama_index.embeddings.openai import OpenAIEmbedding
-
 from llama_index.core import Settings, Document, VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core.embeddings import BaseEmbedding
 from llama_index.readers.web import SimpleWebPageReader
 
 
@@ -243,13 +261,29 @@ from llama_index.readers.web import SimpleWebPageReader
 ##    model_name="BAAI/bge-small-en-v1.5"
 ##)
 
-if config["OpenAI"].get("API_TYPE") == "azure":
-    llamaindex_openai_embed_model = AzureOpenAIEmbedding(model=default["embedding_model"],
-                                                        deployment_name=default["embedding_model"],
-                                                        api_version=default["azure_embedding_model_api_version"],
-                                                        embed_batch_size=10)
-else:
-    llamaindex_openai_embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=10)
+class ClientEmbedding(BaseEmbedding):
+    """
+    A LLaMa-Index embedding model that routes all embedding requests through the configured TinyTroupe
+    client (see `openai_utils.client()`). This way, grounding and memory ingestion embed many texts
+    per request, and share the same clients and rate limits as any other API call.
+    """
+
+    def _get_query_embedding(self, query: str) -> list:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> list:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> list:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: list) -> list:
+        # local import to avoid circular dependencies
+        from tinytroupe import openai_utils
+        return openai_utils.client().get_embeddings(texts, model=self.model_name)
+
+# the client packs texts into requests up to the provider's limits, so we let LLaMa-Index hand over large batches
+llamaindex_openai_embed_model = ClientEmbedding(model_name=default["embedding_model"], embed_batch_size=2048)
 Settings.embed_model = llamaindex_openai_embed_model
 
 
@@ -2,13 +2,17 @@ from tinytroupe.utils import JsonSerializableRegistry
 import tinytroupe.utils as utils
 
 from tinytroupe.agent import logger
-from llama_index.core import  VectorStoreIndex, SimpleDirectoryReader, Document, StorageContext, load_index_from_storage
+from tinytroupe.agent.vector_store import VectorStore, create_vector_store
+from llama_index.core import  VectorStoreIndex, SimpleDirectoryReader, Document, StorageContext, load_index_from_storage, Settings
 from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import MetadataMode
 from llama_index.readers.web import SimpleWebPageReader
 import json
 import tempfile
 import os
 import shutil
+from typing import Union
 
 
 #######################################################################################################################
@@ -43,9 +47,12 @@ class BaseSemanticGroundingConnector(GroundingConnector):
     documents based on so-called "semantic search" (i.e, embeddings-based search). This specific implementation
     is based on the VectorStoreIndex class from the LLaMa-Index library. Here, "documents" refer to the llama-index's
     data structure that stores a unit of content, not necessarily a file.
+
+    Alternatively, if a VectorStore is given, documents are still split and embedded by LLaMa-Index, but their 
+    embeddings are kept and searched in the store instead, which is much faster and cheaper to serialize.
     """
 
-    serializable_attributes = ["documents", "index"]
+    serializable_attributes = ["documents", "index", "vector_store"]
     
     # needs custom deserialization to handle Pydantic models (Document is a Pydantic model)
     custom_deserializers = {"documents": lambda docs_json: [Document.from_json(doc_json) for doc_json in docs_json],
@@ -54,12 +61,13 @@ class BaseSemanticGroundingConnector(GroundingConnector):
     custom_serializers = {"documents": lambda docs: [doc.to_json() for doc in docs] if docs is not None else None,
                           "index": lambda index: BaseSemanticGroundingConnector._serialize_index(index)}
 
-    def __init__(self, name:str="Semantic Grounding") -> None:
+    def __init__(self, name:str="Semantic Grounding", vector_store:VectorStore=None) -> None:
         super().__init__(name)
 
         self.documents = None 
         self.name_to_document = None
         self.index = None
+        self.vector_store = vector_store
 
         # @post_init ensures that _post_init is called after the __init__ method
     
@@ -87,8 +95,16 @@ class BaseSemanticGroundingConnector(GroundingConnector):
                     else:
                         self.name_to_document[name] = [document]
         
+        if not hasattr(self, 'vector_store'):
+            self.vector_store = None
+
         # Rebuild index from documents if it's None or invalid
-        if self.index is None and self.documents:
+        if self._uses_vector_store():
+            if self.documents and len(self.vector_store) == 0:
+                logger.warning("Empty vector store. Rebuilding it from documents.")
+                self._add_documents_to_vector_store(self.documents)
+
+        elif self.index is None and self.documents:
             logger.warning("No index found. Rebuilding index from documents.")
             vector_store = SimpleVectorStore()
             self.index = VectorStoreIndex.from_documents(
@@ -159,17 +175,21 @@ class BaseSemanticGroundingConnector(GroundingConnector):
         if not relevance_target or not relevance_target.strip():
             return []
             
-        if self.index is not None:
+        if self._uses_vector_store():
+            query_embedding = Settings.embed_model.get_query_embedding(relevance_target)
+            matches = [(payload["metadata"], score, payload["text"]) 
+                       for _, score, payload in self.vector_store.search(query_embedding, top_k=top_k)]
+        elif self.index is not None:
             retriever = self.index.as_retriever(similarity_top_k=top_k)
-            nodes = retriever.retrieve(relevance_target)
+            matches = [(node.metadata, node.score, node.text) for node in retriever.retrieve(relevance_target)]
         else:
-            nodes = []
+            matches = []
 
         retrieved = []
-        for node in nodes:
-            content = "SOURCE: " + node.metadata.get('file_name', '(unknown)')
-            content += "\n" + "SIMILARITY SCORE:" + str(node.score)
-            content += "\n" + "RELEVANT CONTENT:" + node.text
+        for metadata, score, text in matches:
+            content = "SOURCE: " + metadata.get('file_name', '(unknown)')
+            content += "\n" + "SIMILARITY SCORE:" + str(score)
+            content += "\n" + "RELEVANT CONTENT:" + text
             retrieved.append(content)
 
             logger.debug(f"Content retrieved: {content[:200]}")
@@ -245,8 +265,13 @@ class BaseSemanticGroundingConnector(GroundingConnector):
                         self.name_to_document[name] = [document]
 
 
+            self._documents_version = self.documents_version() + 1
+
             # index documents for semantic retrieval
-            if self.index is None:
+            if self._uses_vector_store():
+                self._add_documents_to_vector_store(new_documents)
+
+            elif self.index is None:
                 # Create storage context with vector store
                 vector_store = SimpleVectorStore()
                 storage_context = StorageContext.from_defaults(vector_store=vector_store)
@@ -257,7 +282,66 @@ class BaseSemanticGroundingConnector(GroundingConnector):
                     store_nodes_override=True  # This ensures nodes (with text) are stored
                 )
             else:
-                self.index.refresh(self.documents)
+                # only the new documents need to be indexed, and they are embedded together, in as few requests as possible
+                self._insert_documents_into_index(new_documents)
+
+    def remove_document(self, name:str) -> int:
+        """
+        Removes the documents with the specified name (i.e., all the pages of a content source) from the index.
+
+        Returns:
+            int: The number of documents removed.
+        """
+        documents = self.name_to_document.pop(name, []) if self.name_to_document is not None else []
+        if len(documents) == 0:
+            return 0
+
+        removed_ids = set(document.id_ for document in documents)
+        self.documents = [document for document in self.documents if document.id_ not in removed_ids]
+
+        if self._uses_vector_store():
+            self.vector_store.remove([node_id for node_id, payload in zip(self.vector_store.ids, self.vector_store.payloads)
+                                      if payload["document_id"] in removed_ids])
+        elif self.index is not None:
+            for document_id in removed_ids:
+                self.index.delete_ref_doc(document_id, delete_from_docstore=True)
+
+        self._documents_version = self.documents_version() + 1
+
+        return len(documents)
+
+    def documents_version(self) -> int:
+        """
+        Returns a counter that changes whenever documents are indexed, so that clients can tell whether previous
+        retrievals are still valid.
+        """
+        return getattr(self, "_documents_version", 0)
+
+    def _uses_vector_store(self) -> bool:
+        return getattr(self, "vector_store", None) is not None
+
+    def _add_documents_to_vector_store(self, documents:list) -> None:
+        """
+        Splits the given documents into nodes, as a llama-index index would, and adds their embeddings, obtained in batch, to the vector store.
+        """
+        nodes = run_transformations(documents, Settings.transformations)
+        if len(nodes) == 0:
+            return
+
+        embeddings = Settings.embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+        self.vector_store.add([node.node_id for node in nodes], embeddings,
+                              [{"text": node.text, "metadata": node.metadata, "document_id": node.ref_doc_id} for node in nodes])
+
+    def _insert_documents_into_index(self, documents:list) -> None:
+        """
+        Inserts the given documents into the existing index, embedding all their nodes in batch.
+        """
+        nodes = run_transformations(documents, self.index._transformations)
+        self.index.insert_nodes(nodes)
+
+        # keep track of the inserted documents, as llama-index's own insert() would do
+        for document in documents:
+            self.index.docstore.set_document_hash(document.id_, document.hash)
     
     @staticmethod
     def _set_internal_id_to_documents(documents:list, external_attribute_name:str ="file_name") -> None:
@@ -278,8 +362,18 @@ class LocalFilesGroundingConnector(BaseSemanticGroundingConnector):
 
     serializable_attributes = ["folders_paths"]
 
-    def __init__(self, name:str="Local Files", folders_paths: list=None) -> None:
-        super().__init__(name)
+    def __init__(self, name:str="Local Files", folders_paths: list=None, vector_store:Union[VectorStore, str]=None) -> None:
+        """
+        Initializes the connector.
+
+        Args:
+            vector_store (VectorStore or str, optional): Where to index the files' contents, either a store or the kind of index to create 
+                ("llama_index", "exact" or "ivf", see create_vector_store). Defaults to the index configured by GROUNDING_VECTOR_INDEX.
+        """
+        if vector_store is None or isinstance(vector_store, str):
+            vector_store = create_vector_store(vector_store)
+
+        super().__init__(name, vector_store=vector_store)
 
         self.folders_paths = folders_paths
 
@@ -352,8 +446,18 @@ class WebPagesGroundingConnector(BaseSemanticGroundingConnector):
 
     serializable_attributes = ["web_urls"]
 
-    def __init__(self, name:str="Web Pages", web_urls: list=None) -> None:
-        super().__init__(name)
+    def __init__(self, name:str="Web Pages", web_urls: list=None, vector_store:Union[VectorStore, str]=None) -> None:
+        """
+        Initializes the connector.
+
+        Args:
+            vector_store (VectorStore or str, optional): Where to index the pages' contents, either a store or the kind of index to create 
+                ("llama_index", "exact" or "ivf", see create_vector_store). Defaults to the index configured by GROUNDING_VECTOR_INDEX.
+        """
+        if vector_store is None or isinstance(vector_store, str):
+            vector_store = create_vector_store(vector_store)
+
+        super().__init__(name, vector_store=vector_store)
 
         self.web_urls = web_urls
 
@@ -3,6 +3,7 @@ import json
 from tinytroupe.agent import logger
 from tinytroupe.agent.mental_faculty import TinyMentalFaculty
 from tinytroupe.agent.grounding import BaseSemanticGroundingConnector
+from tinytroupe.agent.vector_store import VectorStore
 import tinytroupe.utils as utils
 
 
@@ -223,6 +224,9 @@ class EpisodicMemory(TinyMemory):
 
     MEMORY_BLOCK_OMISSION_INFO = {'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None}
 
+    # the index of item types is derived from the memory itself, so it is rebuilt when needed instead of serialized
+    suppress_attributes_from_serialization = ["_item_type_positions", "_indexed_count"]
+
     def __init__(
         self, fixed_prefix_length: int = 20, lookback_length: int = 100
     ) -> None:
@@ -242,6 +246,11 @@ class EpisodicMemory(TinyMemory):
         # the current episode buffer, which is used to store messages during an episode
         self.episodic_buffer = []
 
+        # for each item type, the positions of the corresponding values in the memory followed by the episodic buffer.
+        # Committing an episode does not change these positions, so the index only grows as values are stored.
+        self._item_type_positions = {}
+        self._indexed_count = 0
+
 
     def commit_episode(self):
         """
@@ -268,7 +277,7 @@ class EpisodicMemory(TinyMemory):
         """
         Returns the number of values in memory.
         """
-        return len(self._memory_with_current_buffer())
+        return len(self.memory) + len(self.episodic_buffer)
 
     def clear(self, max_prefix_to_clear:int=None, max_suffix_to_clear:int=None):
         """
@@ -294,13 +303,76 @@ class EpisodicMemory(TinyMemory):
 
         if max_prefix_to_clear is None and max_suffix_to_clear is None:
             self.memory = []
+
+        # positions have changed, so the index must be rebuilt
+        self._item_type_positions = None
     
+    def _extend(self, values:list, memory_length:int) -> None:
+        """
+        Stores the values after those in the memory and the episodic buffer, and then commits to memory the values before
+        the position memory_length, as if the values had been stored and the episode committed in order. Positions do not 
+        change, so the item types index is updated incrementally.
+        """
+        for value in values:
+            self._store(value)
+
+        committed = memory_length - len(self.memory)
+        if committed > 0:
+            self.memory.extend(self.episodic_buffer[:committed])
+            self.episodic_buffer = self.episodic_buffer[committed:]
+
     def _memory_with_current_buffer(self) -> list:
         """
         Returns the current memory, including the episodic buffer.
         This is useful for retrieving the most recent memories, including the current episode.
+        Note that this copies the whole memory, so retrieval methods use _window instead.
         """
         return self.memory + self.episodic_buffer
+
+    def _item_types_index(self) -> dict:
+        """
+        Returns the positions of the values of each item type, (re)building the index if it is missing (e.g., after 
+        deserialization) or out of sync with the memory.
+        """
+        count = self.count()
+        if getattr(self, "_item_type_positions", None) is None or getattr(self, "_indexed_count", None) != count:
+            self._item_type_positions = {}
+            for position in range(count):
+                self._item_type_positions.setdefault(self._value_at(position)["type"], []).append(position)
+            self._indexed_count = count
+
+        return self._item_type_positions
+
+    def _value_at(self, position:int) -> Any:
+        """
+        Returns the value at the given position of the memory followed by the episodic buffer.
+        """
+        if position < len(self.memory):
+            return self.memory[position]
+        else:
+            return self.episodic_buffer[position - len(self.memory)]
+
+    def _window(self, start:int=None, stop:int=None, item_type:str=None) -> list:
+        """
+        Returns the values in the [start:stop] slice (with the usual slicing semantics) of the memory followed by the episodic buffer, 
+        or of its values of the given item type. Only the values in the window are visited, so this takes time proportional to the 
+        window size, not to the memory size.
+        """
+        if item_type is None:
+            positions = range(self.count())
+        else:
+            positions = self._item_types_index().get(item_type, [])
+
+        return [self._value_at(position) for position in positions[start:stop]]
+
+    def _length(self, item_type:str=None) -> int:
+        """
+        Returns the number of values in memory, or of values of the given item type.
+        """
+        if item_type is None:
+            return self.count()
+        else:
+            return len(self._item_types_index().get(item_type, []))
         
     ######################################
     # General memory methods
@@ -309,8 +381,13 @@ class EpisodicMemory(TinyMemory):
         """
         Stores a value in memory.
         """
+        item_types_index = self._item_types_index()
+
         self.episodic_buffer.append(value)
 
+        item_types_index.setdefault(value["type"], []).append(self._indexed_count)
+        self._indexed_count += 1
+
     def retrieve(self, first_n: int, last_n: int, include_omission_info:bool=True, item_type:str=None) -> list:
         """
         Retrieves the first n and/or last n values from memory. If n is None, all values are retrieved.
@@ -348,22 +425,22 @@ class EpisodicMemory(TinyMemory):
         """
         omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
         
-        # Filter memories if item_type is provided
-        memories = self._memory_with_current_buffer() if item_type is None else self.filter_by_item_type(self._memory_with_current_buffer(), item_type)
+        # Only the values of item_type are considered, if it is provided
+        length = self._length(item_type)
 
         # compute fixed prefix
-        fixed_prefix = memories[: self.fixed_prefix_length] + omisssion_info
+        fixed_prefix = self._window(None, self.fixed_prefix_length, item_type=item_type) + omisssion_info
 
         # how many lookback values remain?
         remaining_lookback = min(
-            len(memories) - len(fixed_prefix) + (1 if include_omission_info else 0), self.lookback_length
+            length - len(fixed_prefix) + (1 if include_omission_info else 0), self.lookback_length
         )
 
         # compute the remaining lookback values and return the concatenation
         if remaining_lookback <= 0:
             return fixed_prefix
         else:
-            return fixed_prefix + memories[-remaining_lookback:]
+            return fixed_prefix + self._window(-remaining_lookback, None, item_type=item_type)
 
     def retrieve_all(self, item_type:str=None) -> list:
         """
@@ -372,8 +449,7 @@ class EpisodicMemory(TinyMemory):
         Args:
             item_type (str, optional): If provided, only retrieve memories of this type.
         """
-        memories = self._memory_with_current_buffer() if item_type is None else self.filter_by_item_type(self._memory_with_current_buffer(), item_type)
-        return copy.copy(memories)
+        return self._window(item_type=item_type)
 
     def retrieve_relevant(self, relevance_target: str, top_k:int) -> list:
         """
@@ -392,8 +468,7 @@ class EpisodicMemory(TinyMemory):
         """
         omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
         
-        memories = self._memory_with_current_buffer() if item_type is None else self.filter_by_item_type(self._memory_with_current_buffer(), item_type)
-        return memories[:n] + omisssion_info
+        return self._window(None, n, item_type=item_type) + omisssion_info
     
     def retrieve_last(self, n: int=None, include_omission_info:bool=True, item_type:str=None) -> list:
         """
@@ -406,8 +481,7 @@ class EpisodicMemory(TinyMemory):
         """
         omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
 
-        memories = self._memory_with_current_buffer() if item_type is None else self.filter_by_item_type(self._memory_with_current_buffer(), item_type)
-        memories = memories[-n:] if n is not None else memories
+        memories = self._window(-n, None, item_type=item_type) if n is not None else self._window(item_type=item_type)
                             
         return omisssion_info + memories  
 
@@ -439,7 +513,8 @@ class SemanticMemory(TinyMemory):
             self.memories = []
 
         if not hasattr(self, 'semantic_grounding_connector') or self.semantic_grounding_connector is None:
-            self.semantic_grounding_connector = BaseSemanticGroundingConnector("Semantic Memory Storage")
+            # memories are kept in an in-process vector store, rather than in a llama-index index, to make retrieval and serialization cheap
+            self.semantic_grounding_connector = BaseSemanticGroundingConnector("Semantic Memory Storage", vector_store=VectorStore())
             
             # TODO remove?
             #self.semantic_grounding_connector.add_documents(self._build_documents_from(self.memories))
@@ -503,6 +578,18 @@ class SemanticMemory(TinyMemory):
         engram_doc = self._build_document_from(value)
         logger.debug(f"Storing engram in semantic memory: {engram_doc}")
         self.semantic_grounding_connector.add_document(engram_doc)
+
+    def store_all(self, values: list) -> None:
+        """
+        Stores a list of values in memory. All the corresponding documents are indexed together, so that
+        their embeddings are obtained in as few requests as possible.
+        """
+        logger.debug(f"Storing {len(values)} values in semantic memory: {values}")
+        engrams = [self._preprocess_value_for_storage(value) for value in values]
+        self.memories.extend(engrams)
+
+        engram_docs = self._build_documents_from(engrams)
+        self.semantic_grounding_connector.add_documents(engram_docs)
     
     def retrieve_relevant(self, relevance_target:str, top_k=20) -> list:
         """
@@ -510,6 +597,13 @@ class SemanticMemory(TinyMemory):
         """
         return self.semantic_grounding_connector.retrieve_relevant(relevance_target, top_k)
 
+    def version(self) -> tuple:
+        """
+        Returns a value that changes whenever the contents of the memory change, so that relevant memories
+        retrieved before can be reused while it stays the same.
+        """
+        return (id(self.semantic_grounding_connector), self.semantic_grounding_connector.documents_version())
+
     def retrieve_all(self, item_type:str=None) -> list:
         """
         Retrieves all values from memory.
@@ -278,11 +278,21 @@ class FilesAndWebGroundingFaculty(TinyMentalFaculty):
     """
 
 
-    def __init__(self, folders_paths: list=None, web_urls: list=None):
+    def __init__(self, folders_paths: list=None, web_urls: list=None, vector_index: str=None):
+        """
+        Initializes the faculty.
+
+        Args:
+            folders_paths (list, optional): The folders with the files to ground on. Defaults to None.
+            web_urls (list, optional): The web pages to ground on. Defaults to None.
+            vector_index (str, optional): How documents are indexed for semantic retrieval, either "llama_index", "exact" or "ivf" 
+                (approximate, for large collections). Defaults to the GROUNDING_VECTOR_INDEX config value.
+        """
         super().__init__("Local Files and Web Grounding")
 
-        self.local_files_grounding_connector = LocalFilesGroundingConnector(folders_paths=folders_paths)
-        self.web_grounding_connector = WebPagesGroundingConnector(web_urls=web_urls)
+        # the connectors create their own stores from the kind of index, so an explicit "llama_index" is not overridden by the config
+        self.local_files_grounding_connector = LocalFilesGroundingConnector(folders_paths=folders_paths, vector_store=vector_index)
+        self.web_grounding_connector = WebPagesGroundingConnector(web_urls=web_urls, vector_store=vector_index)
 
     def process_action(self, agent, action: dict) -> bool:
         if action['type'] == "CONSULT" and action['content'] is not None:
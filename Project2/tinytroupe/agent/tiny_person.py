@@ -9,11 +9,14 @@ from tinytroupe import config_manager
 import os
 import json
 import copy
+import hashlib
 import textwrap  # to dedent strings
 import chevron  # to parse Mustache templates
+import chevron.tokenizer
 from typing import Any
 from rich import print
 import threading
+import textdistance
 from tinytroupe.utils import LLMChat  # Import LLMChat from the appropriate module
 
 import tinytroupe.utils.llm
@@ -39,6 +42,10 @@ class TinyPerson(JsonSerializableRegistry):
     MIN_EPISODE_LENGTH = config_manager.get("min_episode_length", 15)  # The minimum number of messages in an episode before it is considered valid.
     MAX_EPISODE_LENGTH = config_manager.get("max_episode_length", 50)  # The maximum number of messages in an episode before it is considered valid.
 
+    # When the memories relevant to the current context are retrieved again from semantic memory (see retrieve_relevant_memories_for_current_context).
+    MEMORY_CONTEXT_REFRESH = config_manager.get("memory_context_refresh", "context_change")
+    MEMORY_CONTEXT_SIMILARITY_THRESHOLD = config_manager.get("memory_context_similarity_threshold", 0.9)
+
     PP_TEXT_WIDTH = 100
 
     serializable_attributes = ["_persona", "_mental_state", "_mental_faculties", "_current_episode_event_count", "episodic_memory", "semantic_memory"]
@@ -200,6 +207,12 @@ class TinyPerson(JsonSerializableRegistry):
         )
         self._init_system_message = None  # initialized later
 
+        # the parts of the system prompt that only change when the persona or mental faculties do
+        self._prompt_fragments_cache = None
+
+        # the last retrieval of memories relevant to the current context, reused while still valid
+        self._memory_context_cache = None
+
 
         ############################################################
         # Special mechanisms used during deserialization
@@ -240,35 +253,91 @@ class TinyPerson(JsonSerializableRegistry):
     def _rename(self, new_name:str):    
         self.name = new_name
         self._persona["name"] = self.name
+        self._invalidate_prompt_cache()
 
 
     def generate_agent_system_prompt(self):
-        with open(self._prompt_template_path, "r", encoding="utf-8", errors="replace") as f:
-            agent_prompt_template = f.read()
+        agent_prompt_template = TinyPerson._compiled_prompt_template(self._prompt_template_path)
+
+        fragments = self._prompt_fragments()
+        mental_state = json.dumps(self._mental_state, indent=4)
+
+        # the mental state changes far less often than the prompt is reset, so the last rendering can often be reused
+        last_rendering = self._prompt_fragments_cache["last_rendering"]
+        if last_rendering is not None and last_rendering[0] is agent_prompt_template and last_rendering[1] == mental_state:
+            return last_rendering[2]
 
         # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
         template_variables = self._persona.copy()    
-        template_variables["persona"] = json.dumps(self._persona.copy(), indent=4)    
+        template_variables.update(fragments)
 
         # add mental state to the template variables
-        template_variables["mental_state"] = json.dumps(self._mental_state, indent=4)
+        template_variables["mental_state"] = mental_state
 
-        # Prepare additional action definitions and constraints
+        prompt = chevron.render(agent_prompt_template, template_variables)
+        self._prompt_fragments_cache["last_rendering"] = (agent_prompt_template, mental_state, prompt)
+
+        return prompt
+
+    def _prompt_fragments(self) -> dict:
+        """
+        Returns the template variables derived from the persona and the mental faculties (as well as the RAI
+        disclaimers), which are only recomputed when these change, instead of before every action.
+        """
+        # Prepare additional action definitions and constraints. Faculties can change their actions at any time 
+        # (e.g., CustomMentalFaculty.add_action), so these are always obtained, which is cheap compared to the rest.
         actions_definitions_prompt = ""
         actions_constraints_prompt = ""
         for faculty in self._mental_faculties:
             actions_definitions_prompt += f"{faculty.actions_definitions_prompt()}\n"
             actions_constraints_prompt += f"{faculty.actions_constraints_prompt()}\n"
-        
-        # Make the additional prompt pieces available to the template. 
-        # Identation here is to align with the text structure in the template.
-        template_variables['actions_definitions_prompt'] = textwrap.indent(actions_definitions_prompt.strip(), "  ")
-        template_variables['actions_constraints_prompt'] = textwrap.indent(actions_constraints_prompt.strip(), "  ")
 
-        # RAI prompt components, if requested
-        template_variables = utils.add_rai_template_variables_if_enabled(template_variables)
+        # persona changes are signaled via _invalidate_prompt_cache, but replacing the persona altogether is also detected
+        cache_key = (id(self._persona), actions_definitions_prompt, actions_constraints_prompt)
+
+        fragments_cache = getattr(self, "_prompt_fragments_cache", None)
+        if fragments_cache is None or fragments_cache["key"] != cache_key:
+
+            fragments = {
+                "persona": json.dumps(self._persona, indent=4),
+
+                # Make the additional prompt pieces available to the template. 
+                # Identation here is to align with the text structure in the template.
+                "actions_definitions_prompt": textwrap.indent(actions_definitions_prompt.strip(), "  "),
+                "actions_constraints_prompt": textwrap.indent(actions_constraints_prompt.strip(), "  ")
+            }
+
+            # RAI prompt components, if requested
+            fragments = utils.add_rai_template_variables_if_enabled(fragments)
+
+            fragments_cache = {"key": cache_key, "fragments": fragments, "last_rendering": None}
+            self._prompt_fragments_cache = fragments_cache
+
+        return fragments_cache["fragments"]
+
+    def _invalidate_prompt_cache(self):
+        """
+        Signals that the persona or the mental faculties changed, so the corresponding parts of the prompt must be recomputed.
+        """
+        self._prompt_fragments_cache = None
+
+    # the prompt templates already parsed, shared by all agents: {path: (modification time, tokens)}
+    _compiled_prompt_templates = {}
+
+    @staticmethod
+    def _compiled_prompt_template(path:str) -> list:
+        """
+        Returns the parsed Mustache template at the specified path, reading and parsing it again only if the file changed.
+        """
+        modification_time = os.path.getmtime(path)
+
+        compiled = TinyPerson._compiled_prompt_templates.get(path)
+        if compiled is None or compiled[0] != modification_time:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                compiled = (modification_time, list(chevron.tokenizer.tokenize(f.read())))
+            TinyPerson._compiled_prompt_templates[path] = compiled
 
-        return chevron.render(agent_prompt_template, template_variables)
+        return compiled[1]
 
     def reset_prompt(self):
 
@@ -369,6 +438,7 @@ class TinyPerson(JsonSerializableRegistry):
         """
 
         self._persona = utils.merge_dicts(self._persona, additional_definitions)
+        self._invalidate_prompt_cache()
 
         # must reset prompt after adding to configuration
         self.reset_prompt()
@@ -406,6 +476,7 @@ class TinyPerson(JsonSerializableRegistry):
         else:
             raise ValueError(f"The key '{key}' already exists in the persona configuration and overwrite_scalars is set to False.")
 
+        self._invalidate_prompt_cache()
             
         # must reset prompt after adding to configuration
         self.reset_prompt()
@@ -440,6 +511,8 @@ class TinyPerson(JsonSerializableRegistry):
         else:
             raise Exception("Invalid arguments for define_relationships.")
 
+        self._invalidate_prompt_cache()
+
     ##############################################################################
     # Relationships
     ##############################################################################
@@ -450,6 +523,7 @@ class TinyPerson(JsonSerializableRegistry):
         Clears the TinyPerson's relationships.
         """
         self._persona['relationships'] = []  
+        self._invalidate_prompt_cache()
 
         return self      
     
@@ -491,6 +565,7 @@ class TinyPerson(JsonSerializableRegistry):
         # check if the faculty is already there or not
         if faculty not in self._mental_faculties:
             self._mental_faculties.append(faculty)
+            self._invalidate_prompt_cache()
         else:
             raise Exception(f"The mental faculty {faculty} is already present in the agent.")
         
@@ -1069,6 +1144,7 @@ max_content_length=max_content_length,
             # commit the current episode to episodic memory
             self.episodic_memory.commit_episode()
             self._current_episode_event_count = 0
+            self._memory_context_cache = None # episode boundaries always refresh the relevant memories
             logger.debug(f"[{self.name}] Current episode event count reset to 0 after consolidation.")
 
             # TODO reflections, optimizations, etc.
@@ -1120,6 +1196,24 @@ max_content_length=max_content_length,
         goals = self._mental_state.get("goals", "")
         attention = self._mental_state.get("attention", "")
         emotions = self._mental_state.get("emotions", "")
+
+        mental_context = textwrap.dedent(f"""
+        Current Context: {context}
+        Current Goals: {goals}
+        Current Attention: {attention}
+        Current Emotions: {emotions}
+        """).strip()
+
+        # Semantic memory only changes at episode boundaries, and the mental state far less often than the agent acts,
+        # so we avoid retrieving (and thus embedding the target) again if the last retrieval is still valid. The recent 
+        # episodic memories also make up the target, but they change at every action, so they are not considered here.
+        semantic_memory_version = self.semantic_memory.version()
+        context_digest = hashlib.sha256(mental_context.encode("utf-8", errors="replace")).hexdigest()
+        cache = getattr(self, "_memory_context_cache", None)
+        if cache is not None and cache["semantic_memory_version"] == semantic_memory_version and cache["top_k"] == top_k and \
+           self._can_reuse_memory_context(cache, mental_context, context_digest):
+            logger.debug(f"[{self.name}] Reusing the relevant memories retrieved for a previous mental state.")
+            return list(cache["relevant_memories"])
         
         # Retrieve recent memories efficiently
         recent_memories_list = self.retrieve_memories(first_n=10, last_n=20, max_content_length=500)
@@ -1137,7 +1231,35 @@ max_content_length=max_content_length,
 
         logger.debug(f"[{self.name}] Retrieving relevant memories for contextual target: {target}")
 
-        return self.retrieve_relevant_memories(target, top_k=top_k)
+        relevant_memories = self.retrieve_relevant_memories(target, top_k=top_k)
+        self._memory_context_cache = {"semantic_memory_version": semantic_memory_version, "top_k": top_k, 
+                                      "mental_context": mental_context, "context_digest": context_digest,
+                                      "relevant_memories": list(relevant_memories)}
+
+        return relevant_memories
+
+    def _can_reuse_memory_context(self, cache:dict, mental_context:str, context_digest:str) -> bool:
+        """
+        Checks whether the memories retrieved for a previous mental state can be reused for the current one, according
+        to the MEMORY_CONTEXT_REFRESH policy:
+          - "always": memories are always retrieved again.
+          - "context_change": memories are retrieved again whenever the context, goals, attention or emotions change at all.
+          - "similarity": memories are retrieved again when the Jaccard similarity between the words of the previous and current 
+            context, goals, attention and emotions drops below MEMORY_CONTEXT_SIMILARITY_THRESHOLD.
+          - "episode": memories are only retrieved again at episode boundaries.
+        In all cases, memories are retrieved again if the semantic memory changed.
+        """
+        policy = TinyPerson.MEMORY_CONTEXT_REFRESH
+        if policy == "always":
+            return False
+        elif policy == "context_change":
+            return cache["context_digest"] == context_digest
+        elif policy == "similarity":
+            return textdistance.jaccard(cache["mental_context"].split(), mental_context.split()) >= TinyPerson.MEMORY_CONTEXT_SIMILARITY_THRESHOLD
+        elif policy == "episode":
+            return True
+        else:
+            raise ValueError(f"Unknown memory context refresh policy: {policy}")
 
     def summarize_relevant_memories_via_full_scan(self, relevance_target:str, item_type: str = None) -> str:
         """
@@ -1645,10 +1767,15 @@ max_content_length=max_content_length,
         
 
 
-    def encode_complete_state(self) -> dict:
+    def encode_complete_state(self, include_memory:bool=True, include_mental_faculties:bool=True) -> dict:
         """
         Encodes the complete state of the TinyPerson, including the current messages, accessible agents, etc.
         This is meant for serialization and caching purposes, not for exporting the state to the user.
+
+        Args:
+            include_memory (bool, optional): Whether to include the episodic and semantic memories, which are by far the 
+                largest part of the state. Defaults to True.
+            include_mental_faculties (bool, optional): Whether to include the mental faculties. Defaults to True.
         """
         to_copy = copy.copy(self.__dict__)
 
@@ -1656,11 +1783,18 @@ max_content_length=max_content_length,
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
         del to_copy["action_generator"]
+        to_copy.pop("_prompt_fragments_cache", None) # derived from the rest of the state
+        to_copy.pop("_memory_context_cache", None)
 
         to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
-        to_copy['episodic_memory'] = self.episodic_memory.to_json()
-        to_copy['semantic_memory'] = self.semantic_memory.to_json()
-        to_copy["_mental_faculties"] = [faculty.to_json() for faculty in self._mental_faculties]
+        if include_memory:
+            to_copy['episodic_memory'] = self.episodic_memory.to_json()
+            to_copy['semantic_memory'] = self.semantic_memory.to_json()
+        else:
+            del to_copy['episodic_memory']
+            del to_copy['semantic_memory']
+        if include_mental_faculties:
+            to_copy["_mental_faculties"] = [faculty.to_json() for faculty in self._mental_faculties]
 
         state = copy.deepcopy(to_copy)
 
@@ -1689,6 +1823,8 @@ max_content_length=max_content_length,
         # restore other fields
         self.__dict__.update(state)
 
+        self._invalidate_prompt_cache()
+        self._memory_context_cache = None
 
         return self
     
@@ -1706,6 +1842,7 @@ max_content_length=max_content_length,
         new_persona['name'] = new_name
 
         new_agent._persona = new_persona
+        new_agent._invalidate_prompt_cache()
 
         return new_agent
         
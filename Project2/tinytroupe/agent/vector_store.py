@@ -0,0 +1,552 @@
+"""
+Lightweight in-process storage of embeddings for semantic retrieval. Embeddings are kept normalized in a
+contiguous float32 matrix, so that the cosine similarity to a query is a single vectorized product, and
+only the top-k rows are sorted. For large collections, an approximate (IVF) index avoids scanning every row.
+"""
+
+import base64
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from tinytroupe.agent import logger
+from tinytroupe.utils import JsonSerializableRegistry
+import tinytroupe.utils as utils
+from tinytroupe import config_manager
+
+
+# the folder stores are saved to when serialized, if any (see external_storage)
+_external_storage = threading.local()
+
+@contextmanager
+def external_storage(folder:str):
+    """
+    Within this context, stores are serialized by saving them to files in the specified folder (see `VectorStore.save`) and 
+    referring to these files, instead of embedding all their embeddings in the JSON. The files are never changed afterwards, 
+    and a store is only saved again once it changes, so serializing the same store repeatedly (e.g., at every simulation 
+    checkpoint) costs next to nothing while it does not change. Stores deserialized from such references memory-map 
+    their embeddings.
+
+    Args:
+        folder (str): The folder to save the stores to, or None to embed them in the JSON as usual.
+    """
+    previous_folder = getattr(_external_storage, "folder", None)
+    _external_storage.folder = folder
+    try:
+        yield
+    finally:
+        _external_storage.folder = previous_folder
+
+
+@utils.post_init
+class VectorStore(JsonSerializableRegistry):
+    """
+    Stores embeddings and retrieves those most similar to a query embedding, by exhaustive (exact) search.
+
+    Each embedding is associated with an ID and a payload (a JSON-serializable dict with whatever the client needs
+    to make sense of the results, e.g., the text that was embedded). Embeddings can be added and removed incrementally:
+    the matrix grows geometrically, and removed rows are filled with the last one, so that the used rows are always
+    contiguous.
+    """
+
+    serializable_attributes = ["ids", "payloads", "embeddings", "storage_path"]
+
+    # the embeddings are serialized as the base64 encoding of their float32 representation, which is far more compact than lists of numbers
+    custom_serializers = {"embeddings": lambda embeddings: VectorStore._encode_array(embeddings)}
+    custom_deserializers = {"embeddings": lambda embeddings_json: VectorStore._decode_array(embeddings_json)}
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self) -> None:
+        self.ids = None
+        self.payloads = None
+
+        # @post_init ensures that _post_init is called after the __init__ method
+
+    def _post_init(self):
+        """
+        This will run after __init__, since the class has the @post_init decorator.
+        It is convenient to separate some of the initialization processes to make deserialize easier.
+        """
+        if not hasattr(self, 'storage_path'):
+            self.storage_path = None
+
+        if self.storage_path is not None and not hasattr(self, 'ids'):
+            # deserialized from a reference to the files the store was saved to (see external_storage)
+            self.__dict__.update(VectorStore.load(self.storage_path, mmap=True).__dict__)
+
+        if not hasattr(self, 'ids') or self.ids is None:
+            self.ids = []
+
+        if not hasattr(self, 'payloads') or self.payloads is None:
+            self.payloads = [None] * len(self.ids)
+
+        if not hasattr(self, '_matrix'):
+            self._matrix = None
+
+        self._id_to_row = {id_: row for row, id_ in enumerate(self.ids)}
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """
+        The stored embeddings, as a (count, dimensions) float32 matrix whose rows correspond to the IDs, in the same order.
+        """
+        if self._matrix is None:
+            return None
+
+        return self._matrix[:len(self.ids)]
+
+    @embeddings.setter
+    def embeddings(self, embeddings:np.ndarray):
+        self._matrix = embeddings
+
+    @property
+    def dimensions(self) -> int:
+        return self._matrix.shape[1] if self._matrix is not None else None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id_) -> bool:
+        return id_ in self._id_to_row
+
+    def add(self, ids:list, embeddings, payloads:list=None) -> None:
+        """
+        Adds embeddings to the store. If an ID already exists, its embedding and payload are replaced.
+
+        Args:
+            ids (list): The IDs of the embeddings.
+            embeddings (list or np.ndarray): The embeddings, one per ID.
+            payloads (list, optional): The payloads, one per ID. Defaults to None.
+        """
+        if len(ids) == 0:
+            return
+
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1))
+        if payloads is None:
+            payloads = [None] * len(ids)
+
+        if self.dimensions is not None and vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Embeddings have {vectors.shape[1]} dimensions, but the store has {self.dimensions}.")
+
+        self._ensure_writable_capacity(len(self.ids) + len(ids), vectors.shape[1])
+        self.storage_path = None
+
+        for id_, vector, payload in zip(ids, vectors, payloads):
+            row = self._id_to_row.get(id_)
+            if row is None:
+                row = len(self.ids)
+                self.ids.append(id_)
+                self.payloads.append(payload)
+                self._id_to_row[id_] = row
+            else:
+                self.payloads[row] = payload
+
+            self._matrix[row] = vector
+
+    def remove(self, ids:list) -> int:
+        """
+        Removes the embeddings with the specified IDs from the store. Unknown IDs are ignored.
+
+        Returns:
+            int: The number of embeddings actually removed.
+        """
+        removed = 0
+        for id_ in ids:
+            row = self._id_to_row.pop(id_, None)
+            if row is None:
+                continue
+
+            self._ensure_writable_capacity(len(self.ids), self.dimensions)
+            self.storage_path = None
+
+            # the last row takes the place of the removed one, to keep the used rows contiguous
+            last = len(self.ids) - 1
+            if row != last:
+                self._move_row(last, row)
+
+            self.ids.pop()
+            self.payloads.pop()
+            removed += 1
+
+        return removed
+
+    def search(self, query_embedding, top_k:int=20) -> list:
+        """
+        Retrieves the stored embeddings most similar to the query, by cosine similarity.
+
+        Returns:
+            list: Up to top_k (id, score, payload) tuples, from the most to the least similar.
+        """
+        count = len(self.ids)
+        if count == 0 or top_k <= 0:
+            return []
+
+        query = self._normalize(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        scores = self._matrix[:count] @ query
+
+        if top_k < count:
+            # only the top-k scores need to be sorted
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(count)
+        best = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [(self.ids[row], float(scores[row]), self.payloads[row]) for row in best]
+
+    def clear(self) -> None:
+        """
+        Removes all embeddings from the store.
+        """
+        self.ids = []
+        self.payloads = []
+        self._matrix = None
+        self._id_to_row = {}
+        self.storage_path = None
+
+    def to_json(self, include:list=None, suppress:list=None, file_path:str=None,
+                serialization_type_field_name="json_serializable_class_name") -> dict:
+        folder = getattr(_external_storage, "folder", None)
+        if folder is None:
+            return super().to_json(include=include, suppress=(suppress or []) + ["storage_path"], file_path=file_path,
+                                   serialization_type_field_name=serialization_type_field_name)
+
+        # the store is only saved again if it changed since it was last saved to (or loaded from) this folder
+        if self.storage_path is None or os.path.dirname(self.storage_path) != folder or not os.path.exists(f"{self.storage_path}.json"):
+            storage_path = os.path.join(folder, uuid.uuid4().hex)
+            self.save(storage_path)
+            self.storage_path = storage_path
+
+        return super().to_json(include=["storage_path"], file_path=file_path,
+                               serialization_type_field_name=serialization_type_field_name)
+
+    def save(self, path:str) -> None:
+        """
+        Saves the store to `<path>.npy` (the embeddings matrix) and `<path>.json` (the IDs and payloads).
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        embeddings = self.embeddings
+        if embeddings is None:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        np.save(f"{path}.npy", np.ascontiguousarray(embeddings))
+
+        with open(f"{path}.json", "w", encoding="utf-8", errors="replace") as f:
+            json.dump({"store_class": self.__class__.__name__, "ids": self.ids, "payloads": self.payloads, "index": self._save_index(path)}, f)
+
+    @staticmethod
+    def load(path:str, mmap:bool=False):
+        """
+        Loads a store saved with `save`, of the same class it had. The store remembers the path it was loaded from, so that it
+        is not saved again under `external_storage` until it changes.
+
+        Args:
+            path (str): The path the store was saved to, without extensions.
+            mmap (bool, optional): Whether to memory-map the embeddings matrix instead of reading it, which makes loading
+                large stores nearly instantaneous. The matrix is only copied into memory if the store is changed. Defaults to False.
+        """
+        with open(f"{path}.json", "r", encoding="utf-8", errors="replace") as f:
+            metadata = json.load(f)
+
+        embeddings = np.load(f"{path}.npy", mmap_mode="r" if mmap else None)
+        if embeddings.size == 0:
+            embeddings = None
+
+        store_class = JsonSerializableRegistry.class_mapping.get(metadata.get("store_class"), VectorStore)
+        store = store_class.__new__(store_class)
+        store.ids = metadata["ids"]
+        store.payloads = metadata["payloads"]
+        store._matrix = embeddings
+        store.storage_path = path
+        store._load_index(path, metadata.get("index"), mmap)
+        store._post_init()
+
+        if embeddings is not None and embeddings.shape[0] != len(store.ids):
+            raise ValueError(f"The store at {path} is inconsistent: {embeddings.shape[0]} embeddings for {len(store.ids)} IDs.")
+
+        return store
+
+    def _save_index(self, path:str) -> dict:
+        """
+        Saves any auxiliary index structures next to `path`, returning the metadata needed to load them. Exhaustive search needs none.
+        """
+        return None
+
+    def _load_index(self, path:str, index_metadata:dict, mmap:bool) -> None:
+        """
+        Loads the auxiliary index structures saved by `_save_index`.
+        """
+        pass
+
+    def _move_row(self, source:int, destination:int) -> None:
+        self._matrix[destination] = self._matrix[source]
+        self.ids[destination] = self.ids[source]
+        self.payloads[destination] = self.payloads[source]
+        self._id_to_row[self.ids[destination]] = destination
+
+    def _ensure_writable_capacity(self, required_rows:int, dimensions:int) -> None:
+        """
+        Makes sure the matrix can be written to and holds at least the required number of rows, growing it geometrically if needed.
+        """
+        if self._matrix is not None and self._matrix.shape[0] >= required_rows and self._matrix.flags.writeable:
+            return
+
+        capacity = max(VectorStore.INITIAL_CAPACITY, required_rows)
+        if self._matrix is not None and self._matrix.shape[0] < required_rows:
+            # doubling makes adding embeddings one at a time take amortized constant time
+            capacity = max(capacity, 2 * self._matrix.shape[0])
+        elif self._matrix is not None:
+            capacity = max(capacity, self._matrix.shape[0])
+
+        matrix = np.zeros((capacity, dimensions), dtype=np.float32)
+        if self._matrix is not None:
+            logger.debug(f"Growing vector store from {self._matrix.shape[0]} to {capacity} rows.")
+            matrix[:len(self.ids)] = self._matrix[:len(self.ids)]
+        self._matrix = matrix
+
+    @staticmethod
+    def _normalize(vectors:np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0 # zero vectors are kept as they are, and are not similar to anything
+        return vectors / norms
+
+    @staticmethod
+    def _encode_array(array:np.ndarray) -> dict:
+        if array is None:
+            return None
+
+        return {"shape": list(array.shape), "dtype": array.dtype.name,
+                "base64": base64.b64encode(np.ascontiguousarray(array).tobytes()).decode("ascii")}
+
+    @staticmethod
+    def _decode_array(array_json:dict) -> np.ndarray:
+        if array_json is None:
+            return None
+
+        data = base64.b64decode(array_json["base64"])
+        return np.frombuffer(data, dtype=array_json["dtype"]).reshape(array_json["shape"]).copy()
+
+
+@utils.post_init
+class IVFVectorStore(VectorStore):
+    """
+    Stores embeddings and retrieves those most similar to a query embedding approximately, using an inverted file
+    (IVF) index: embeddings are clustered around `n_lists` centroids (by spherical k-means), and queries only scan
+    the clusters of the `n_probe` centroids closest to them. This makes retrieval time roughly proportional to
+    n_probe / n_lists of the stored embeddings, at the cost of occasionally missing a match that lies in a cluster 
+    that was not scanned. More probes give better recall, but slower retrieval.
+
+    The index is trained once the store holds `min_training_size` embeddings (before that, search is exhaustive), 
+    and trained again whenever the store doubles in size, so that clusters stay balanced. New embeddings are 
+    assigned to their closest centroid as they are added.
+    """
+
+    serializable_attributes = ["n_lists", "n_probe", "min_training_size", "trained_count", "centroids", "assignments"]
+
+    custom_serializers = {"centroids": lambda centroids: VectorStore._encode_array(centroids),
+                          "assignments": lambda assignments: VectorStore._encode_array(assignments)}
+    custom_deserializers = {"centroids": lambda centroids_json: VectorStore._decode_array(centroids_json),
+                            "assignments": lambda assignments_json: VectorStore._decode_array(assignments_json)}
+
+    TRAINING_ITERATIONS = 10
+    TRAINING_SAMPLES_PER_LIST = 64
+
+    def __init__(self, n_lists:int=None, n_probe:int=8, min_training_size:int=1000) -> None:
+        """
+        Initializes the store.
+
+        Args:
+            n_lists (int, optional): The number of clusters. Defaults to about the square root of the number of embeddings when trained.
+            n_probe (int, optional): The number of clusters scanned by each query. Defaults to 8.
+            min_training_size (int, optional): The number of embeddings from which the index is used. Defaults to 1000.
+        """
+        super().__init__()
+
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_training_size = min_training_size
+
+        # @post_init ensures that _post_init is called after the __init__ method
+
+    def _post_init(self):
+        """
+        This will run after __init__, since the class has the @post_init decorator.
+        It is convenient to separate some of the initialization processes to make deserialize easier.
+        """
+        super()._post_init()
+
+        if not hasattr(self, 'n_lists'):
+            self.n_lists = None
+        if not hasattr(self, 'n_probe') or self.n_probe is None:
+            self.n_probe = 8
+        if not hasattr(self, 'min_training_size') or self.min_training_size is None:
+            self.min_training_size = 1000
+
+        if not hasattr(self, 'trained_count') or self.trained_count is None:
+            self.trained_count = 0
+        if not hasattr(self, 'centroids'):
+            self.centroids = None
+        if not hasattr(self, '_assignments'):
+            self._assignments = None
+
+    @property
+    def assignments(self) -> np.ndarray:
+        """
+        The cluster of each stored embedding, in the same order as the IDs, or None if the index is not trained.
+        """
+        if self._assignments is None:
+            return None
+
+        return self._assignments[:len(self.ids)]
+
+    @assignments.setter
+    def assignments(self, assignments:np.ndarray):
+        self._assignments = assignments
+
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, ids:list, embeddings, payloads:list=None) -> None:
+        super().add(ids, embeddings, payloads)
+
+        if len(self.ids) >= self.min_training_size and (not self.is_trained() or len(self.ids) >= 2 * self.trained_count):
+            self.train()
+
+        elif self.is_trained() and len(ids) > 0:
+            rows = np.array([self._id_to_row[id_] for id_ in ids])
+            self._assignments[rows] = self._closest_centroids(self._matrix[rows])
+
+    def search(self, query_embedding, top_k:int=20) -> list:
+        count = len(self.ids)
+        if not self.is_trained() or count == 0 or top_k <= 0 or self.n_probe >= len(self.centroids):
+            return super().search(query_embedding, top_k)
+
+        query = self._normalize(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+
+        # only the embeddings in the clusters closest to the query are scanned
+        probed = np.zeros(len(self.centroids), dtype=bool)
+        probed[np.argpartition(-(self.centroids @ query), self.n_probe - 1)[:self.n_probe]] = True
+        rows = np.flatnonzero(probed[self._assignments[:count]])
+        scores = self._matrix[rows] @ query
+
+        if top_k < len(rows):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(rows))
+        best = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [(self.ids[rows[i]], float(scores[i]), self.payloads[rows[i]]) for i in best]
+
+    def train(self) -> None:
+        """
+        Clusters the stored embeddings and assigns each one to its cluster. This is done automatically as embeddings are added, 
+        but can also be requested explicitly (e.g., after changing n_lists).
+        """
+        count = len(self.ids)
+        if count == 0:
+            return
+
+        n_lists = self.n_lists if self.n_lists is not None else int(np.sqrt(count))
+        n_lists = max(1, min(n_lists, count))
+
+        # a fixed seed keeps simulations reproducible
+        rng = np.random.default_rng(0)
+        sample_size = min(count, n_lists * IVFVectorStore.TRAINING_SAMPLES_PER_LIST)
+        sample = self._matrix[:count][np.sort(rng.choice(count, sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        logger.debug(f"Training IVF index with {n_lists} lists on {sample_size} of {count} embeddings.")
+        for _ in range(IVFVectorStore.TRAINING_ITERATIONS):
+            sample_assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, sample_assignments, sample)
+
+            # clusters that ended up empty keep their previous centroid
+            non_empty = np.bincount(sample_assignments, minlength=n_lists) > 0
+            centroids[non_empty] = self._normalize(sums[non_empty])
+
+        self.centroids = centroids
+        self.storage_path = None
+        self._assignments = np.zeros(self._matrix.shape[0], dtype=np.int32)
+        self._assignments[:count] = self._closest_centroids(self._matrix[:count])
+        self.trained_count = count
+
+    def _closest_centroids(self, vectors:np.ndarray, batch_size:int=65536) -> np.ndarray:
+        closest = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch_size):
+            closest[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ self.centroids.T, axis=1)
+        return closest
+
+    def clear(self) -> None:
+        super().clear()
+        self.centroids = None
+        self._assignments = None
+        self.trained_count = 0
+
+    def _ensure_writable_capacity(self, required_rows:int, dimensions:int) -> None:
+        super()._ensure_writable_capacity(required_rows, dimensions)
+
+        # assignments grow (and become writable) together with the matrix
+        if self._assignments is not None and (len(self._assignments) < self._matrix.shape[0] or not self._assignments.flags.writeable):
+            assignments = np.zeros(self._matrix.shape[0], dtype=np.int32)
+            assignments[:len(self.ids)] = self._assignments[:len(self.ids)]
+            self._assignments = assignments
+
+    def _move_row(self, source:int, destination:int) -> None:
+        super()._move_row(source, destination)
+        if self._assignments is not None:
+            self._assignments[destination] = self._assignments[source]
+
+    def _save_index(self, path:str) -> dict:
+        if self.is_trained():
+            np.save(f"{path}.centroids.npy", self.centroids)
+            np.save(f"{path}.assignments.npy", np.ascontiguousarray(self.assignments))
+
+        return {"n_lists": self.n_lists, "n_probe": self.n_probe, "min_training_size": self.min_training_size,
+                "trained_count": self.trained_count if self.is_trained() else 0}
+
+    def _load_index(self, path:str, index_metadata:dict, mmap:bool) -> None:
+        index_metadata = index_metadata if index_metadata is not None else {}
+        self.n_lists = index_metadata.get("n_lists")
+        self.n_probe = index_metadata.get("n_probe")
+        self.min_training_size = index_metadata.get("min_training_size")
+        self.trained_count = index_metadata.get("trained_count", 0)
+
+        if self.trained_count > 0:
+            self.centroids = np.load(f"{path}.centroids.npy")
+            self._assignments = np.load(f"{path}.assignments.npy", mmap_mode="r" if mmap else None)
+        else:
+            self.centroids = None
+            self._assignments = None
+
+
+def create_vector_store(kind:str=None) -> VectorStore:
+    """
+    Creates a vector store of the specified kind, for grounding connectors to index their documents with.
+
+    Args:
+        kind (str, optional): Either "llama_index" (in which case no store is created, and connectors use LLaMa-Index's own index),
+            "exact" or "ivf". Defaults to the GROUNDING_VECTOR_INDEX config value.
+
+    Returns:
+        VectorStore: The new store, or None if kind is "llama_index".
+    """
+    if kind is None:
+        kind = config_manager.get("grounding_vector_index", "llama_index")
+
+    kind = kind.lower()
+    if kind == "llama_index":
+        return None
+    elif kind == "exact":
+        return VectorStore()
+    elif kind == "ivf":
+        return IVFVectorStore(n_lists=config_manager.get("grounding_ivf_lists", 0) or None,
+                              n_probe=config_manager.get("grounding_ivf_probes", 8))
+    else:
+        raise ValueError(f"Unknown vector index: {kind}")
@@ -0,0 +1,409 @@
+"""
+On-disk storage for cached LLM API calls and embeddings.
+
+The cache is a keyed SQLite store: each API response is written as a single row, so the cost of
+saving a new entry does not depend on how many entries were cached before. Lookups go straight to
+disk (SQLite keeps its own page cache), so nothing is loaded up front. Old entries can be evicted
+by age or by count, and the file can be compacted on demand.
+
+Entries are keyed by a fixed-width fingerprint of the request (see `request_fingerprint`), rather
+than by the full request text. The full request can optionally be kept alongside each entry, for debugging.
+
+Legacy pickle caches (e.g., `openai_api_cache.pickle`) are imported automatically the first time
+the corresponding store is opened.
+
+Embeddings are kept in a separate, content-addressed cache (see `EmbeddingCache`), since they are
+deterministic and the same texts are re-embedded very often (e.g., when memories are restored).
+"""
+import ast
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("tinytroupe")
+
+
+# request parameters that do not affect the response, and thus are not part of the fingerprint
+_NON_SEMANTIC_REQUEST_PARAMS = {"timeout", "stream"}
+
+
+def request_fingerprint(model: str, chat_api_params: dict) -> str:
+    """
+    Computes a canonical, fixed-width fingerprint of an LLM request. The fingerprint does not depend on
+    the order of dictionary keys, and covers the model, the messages, the sampling parameters and the
+    response format (via its JSON schema, if it is a Pydantic model).
+
+    Args:
+        model (str): The model the request is sent to.
+        chat_api_params (dict): The request parameters.
+
+    Returns:
+        str: A hex digest identifying the request.
+    """
+    canonical = canonical_request_json(model, chat_api_params)
+    return hashlib.blake2b(canonical.encode("utf-8", errors="replace"), digest_size=16).hexdigest()
+
+
+def canonical_request_json(model: str, chat_api_params: dict) -> str:
+    """
+    Returns the canonical JSON representation of an LLM request, used to compute its fingerprint.
+    """
+    params = {k: v for k, v in chat_api_params.items() if k not in _NON_SEMANTIC_REQUEST_PARAMS}
+    return json.dumps([model, params], sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+                      default=_canonical_json_default)
+
+
+def _canonical_json_default(obj):
+    if isinstance(obj, type):
+        if hasattr(obj, "model_json_schema"): # a Pydantic model class
+            return _model_schema(obj)
+        return f"{obj.__module__}.{obj.__qualname__}"
+    elif hasattr(obj, "model_dump"): # a Pydantic model instance
+        return obj.model_dump(mode="json")
+    elif isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    else:
+        return str(obj)
+
+
+@functools.lru_cache(maxsize=None)
+def _model_schema(model_class) -> dict:
+    return {"schema": model_class.model_json_schema(), "name": model_class.__qualname__}
+
+
+class APICache:
+    """
+    A persistent key-value store for API responses, backed by SQLite.
+    """
+
+    # how many writes to wait between automatic eviction passes
+    EVICTION_INTERVAL = 1000
+
+    def __init__(self, cache_file_name: str, max_entries: int = 0, max_age_days: float = 0) -> None:
+        """
+        Opens (or creates) the cache store.
+
+        Args:
+            cache_file_name (str): The name of the cache file. If it refers to a legacy pickle file (i.e., ends in `.pickle`),
+                the store is kept alongside it, with the `.sqlite` extension, and the pickle contents are imported.
+            max_entries (int): The maximum number of entries to keep. 0 means unlimited.
+            max_age_days (float): The maximum age of an entry, in days. 0 means unlimited.
+        """
+        self.db_path, self.legacy_path = APICache._resolve_paths(cache_file_name)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, request TEXT)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(entries)")]
+        if "request" not in columns:
+            self._connection.execute("ALTER TABLE entries ADD COLUMN request TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        self._import_legacy_pickle()
+        self.evict()
+
+    @staticmethod
+    def _resolve_paths(cache_file_name: str):
+        root, extension = os.path.splitext(cache_file_name)
+        if extension == ".pickle":
+            return root + ".sqlite", cache_file_name
+        else:
+            return cache_file_name, root + ".pickle"
+
+    ###########################################################################
+    # Dict-like access
+    ###########################################################################
+    def get(self, key: str, default=None):
+        """
+        Returns the cached value for the given key, or `default` if there is none.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return default
+
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            logger.warning(f"Could not unpickle cached API response, ignoring it: {e}")
+            return default
+
+    def put(self, key: str, value, request: str = None) -> None:
+        """
+        Stores the given value under the given key, replacing any previous value.
+
+        Args:
+            key (str): The key, typically a request fingerprint.
+            value: The value to store. Must be picklable.
+            request (str, optional): A readable description of the request, kept only for debugging purposes.
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO entries (key, value, created_at, request) VALUES (?, ?, ?, ?)",
+                                     (key, blob, time.time(), request))
+            self._writes_since_eviction += 1
+            must_evict = self._writes_since_eviction >= APICache.EVICTION_INTERVAL
+
+        if must_evict:
+            self.evict()
+
+    def get_request(self, key: str):
+        """
+        Returns the request description stored with the given key, if any.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT request FROM entries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key: str):
+        value = self.get(key, default=KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value) -> None:
+        self.put(key, value)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    ###########################################################################
+    # Maintenance
+    ###########################################################################
+    def evict(self) -> int:
+        """
+        Removes entries that are older than `max_age_days` and, if there are still more than `max_entries`,
+        the oldest entries beyond that limit.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        removed = 0
+        with self._lock:
+            if self.max_age_days and self.max_age_days > 0:
+                cutoff = time.time() - self.max_age_days * 24 * 3600
+                removed += self._connection.execute("DELETE FROM entries WHERE created_at < ?", (cutoff,)).rowcount
+
+            if self.max_entries and self.max_entries > 0:
+                removed += self._connection.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)).rowcount
+
+            self._writes_since_eviction = 0
+
+        if removed > 0:
+            logger.debug(f"Evicted {removed} entries from API cache {self.db_path}.")
+        return removed
+
+    def compact(self) -> None:
+        """
+        Applies the eviction policy and then reclaims the unused space in the cache file.
+        """
+        self.evict()
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.execute("VACUUM")
+
+    def clear(self) -> None:
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._connection.close()
+
+    ###########################################################################
+    # Migration
+    ###########################################################################
+    def _import_legacy_pickle(self) -> int:
+        """
+        Imports the entries of the legacy pickle cache, if there is one that was not imported yet (or
+        that changed since it was last imported).
+
+        Returns:
+            int: The number of entries imported.
+        """
+        if not os.path.exists(self.legacy_path):
+            return 0
+
+        marker = f"{os.path.abspath(self.legacy_path)}:{os.path.getmtime(self.legacy_path)}"
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'imported_legacy_pickle'").fetchone()
+        if row is not None and row[0] == marker:
+            return 0
+
+        try:
+            with open(self.legacy_path, "rb") as f:
+                legacy_cache = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read legacy API cache {self.legacy_path}, skipping its import: {e}")
+            return 0
+
+        now = time.time()
+        rows = [(APICache._legacy_key_to_fingerprint(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now)
+                for key, value in legacy_cache.items()]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR IGNORE INTO entries (key, value, created_at) VALUES (?, ?, ?)", rows)
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_legacy_pickle', ?)", (marker,))
+            self._connection.execute("COMMIT")
+
+        logger.info(f"Imported {len(rows)} entries from legacy API cache {self.legacy_path} into {self.db_path}.")
+        return len(rows)
+
+    @staticmethod
+    def _legacy_key_to_fingerprint(key) -> str:
+        """
+        Legacy caches used `str((model, chat_api_params))` as keys. When that string can be parsed back,
+        it is converted to the corresponding fingerprint, so that the imported entry can still be hit.
+        Otherwise, the raw key is kept.
+        """
+        try:
+            model, chat_api_params = ast.literal_eval(key)
+            return request_fingerprint(model, chat_api_params)
+        except Exception:
+            return str(key)
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed cache of embeddings, keyed by (model, text). The vectors are appended,
+    as raw float32 rows, to a data file that is read through a memory map, while a small SQLite index maps each
+    key to the position and dimension of its vector.
+    """
+
+    def __init__(self, cache_file_name: str) -> None:
+        """
+        Opens (or creates) the embedding cache.
+
+        Args:
+            cache_file_name (str): The base name of the cache files. The index is stored in `<name>.sqlite` and
+                the vectors in `<name>.f32`.
+        """
+        root, extension = os.path.splitext(cache_file_name)
+        base_name = root if extension in (".sqlite", ".f32") else cache_file_name
+        self.index_path = base_name + ".sqlite"
+        self.data_path = base_name + ".f32"
+
+        self._lock = threading.Lock()
+        self._memmap = None
+
+        self._connection = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, offset INTEGER NOT NULL, dimension INTEGER NOT NULL)")
+
+        # the data file is only ever appended to
+        self._data_file = open(self.data_path, "ab")
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        """
+        Returns the cache key of the embedding of the given text by the given model.
+        """
+        return hashlib.blake2b(f"{model}\0{text}".encode("utf-8", errors="replace"), digest_size=16).hexdigest()
+
+    def get_many(self, model: str, texts: list) -> list:
+        """
+        Returns the cached embeddings of the given texts, with None for those that are not cached.
+        """
+        keys = [EmbeddingCache.key(model, text) for text in texts]
+
+        with self._lock:
+            locations = {}
+            # SQLite limits the number of parameters in a query, so we look keys up in chunks
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, offset, dimension FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                locations.update({key: (offset, dimension) for key, offset, dimension in rows})
+
+            if not locations:
+                return [None] * len(texts)
+
+            vectors = self._vectors()
+
+        results = []
+        for key in keys:
+            if key in locations:
+                offset, dimension = locations[key]
+                results.append(vectors[offset:offset + dimension].tolist())
+            else:
+                results.append(None)
+
+        return results
+
+    def put_many(self, model: str, texts: list, embeddings: list) -> None:
+        """
+        Stores the embeddings of the given texts.
+        """
+        rows = []
+        with self._lock:
+            # other processes (e.g., step executor or simulation runner workers) may share the cache, so the append and the 
+            # index update happen under SQLite's write lock, and the offset comes from the actual size of the data file
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                offset = os.fstat(self._data_file.fileno()).st_size // 4
+                for text, embedding in zip(texts, embeddings):
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    self._data_file.write(vector.tobytes())
+                    rows.append((EmbeddingCache.key(model, text), offset, len(vector)))
+                    offset += len(vector)
+
+                # vectors must be on disk before the index points to them
+                self._data_file.flush()
+                self._connection.executemany("INSERT OR IGNORE INTO embeddings (key, offset, dimension) VALUES (?, ?, ?)", rows)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _vectors(self):
+        """
+        Returns a memory map over all the stored vectors, refreshing it if the data file grew.
+        """
+        size = os.path.getsize(self.data_path) // 4
+        if self._memmap is None or len(self._memmap) < size:
+            self._memmap = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(size,)) if size > 0 else np.zeros(0, dtype=np.float32)
+        return self._memmap
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Closes the underlying files.
+        """
+        with self._lock:
+            self._data_file.close()
+            self._connection.close()
+            self._memmap = None
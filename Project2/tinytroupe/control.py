@@ -1,14 +1,15 @@
 """
 Simulation controlling mechanisms.
 """
+import hashlib
 import json
 import os
-import tempfile
 import threading
 import traceback
 
 import tinytroupe
 import tinytroupe.utils as utils
+from tinytroupe.trace_store import SimulationTrace, TraceWriter, open_trace, resolve_trace_paths
 
 import uuid
 
@@ -17,8 +18,6 @@ import logging
 logger = logging.getLogger("tinytroupe")
 
 # to protect from race conditions when running in parallel
-concurrent_execution_lock = threading.Lock()
-
 class Simulation:
 
     STATUS_STOPPED = "stopped"
@@ -38,11 +37,25 @@ class Simulation:
         self.name_to_environment = {} # {environment_name: environment, ...}
         self.status = Simulation.STATUS_STOPPED
 
-        self.cache_path = f"./tinytroupe-{id}.cache.json" # default cache path
+        self.cache_path = f"./tinytroupe-{id}.cache.trace" # default cache path
         
         # should we always automatically checkpoint at the every transaction?
         self.auto_checkpoint = False
 
+        # checkpointing policy: automatic checkpoints happen every so many transactions, and can be written
+        # in the background, in which case they are written at most every so many seconds (and coalesced meanwhile)
+        self.background_checkpointing = tinytroupe.config_manager.get("background_checkpointing", True)
+        self.checkpoint_every_n_transactions = tinytroupe.config_manager.get("checkpoint_every_n_transactions", 1)
+        self.checkpoint_min_interval_seconds = tinytroupe.config_manager.get("checkpoint_min_interval_seconds", 0)
+        self._transactions_since_checkpoint = 0
+        self._checkpoint_writer = None # created when first needed
+        self._checkpoint_lock = threading.Lock()
+
+        # should cached states be restored only when actually needed, thus skipping intermediate states when replaying?
+        self.fast_forward = tinytroupe.config_manager.get("fast_forward_replay", False)
+        self._deferred_restore_position = None # the position of the cached state to restore, if its restoration was deferred
+        self._deferred_restore_lock = threading.Lock()
+
         # whether there are changes not yet saved to the cache file
         self.has_unsaved_cache_changes = False
 
@@ -54,12 +67,22 @@ class Simulation:
         # simulation caching later
         self._under_parallel_transactions = False
 
+        # protects the transactions bookkeeping above. It is only held for short updates, never while transactions execute.
+        self._transactions_lock = threading.Lock()
+
+        # the outputs of the parallel transactions in the current segment, accumulated separately by each thread
+        # and merged into the traces only when the segment ends: {thread id: {"execution": {event_hash: ...}, "cache": {...}}}
+        self._parallel_buffers = {}
+
         # Cache chain mechanism.
         # 
         # stores a list of simulation states.
-        # Each state is a tuple (prev_node_hash, event_hash, event_output, state), where prev_node_hash is a hash of the previous node in this chain,
+        # Each state is a tuple (prev_node_hash, event_hash, event_output, state, node_hash), where prev_node_hash is a hash of the previous node in this chain,
         # if any, event_hash is a hash of the event that triggered the transition to this state, if any, event_output is the output of the event,
-        # if any, and state is the actual complete state that resulted.
+        # if any, state is the actual complete state that resulted, and node_hash is the hash of this node, computed once from all the others.
+        # Traces stored by older versions lack the node_hash, and their prev_node_hash cannot be checked.
+        #
+        # Once loaded from (or saved to) a cache file, this is a SimulationTrace, which reads the stored states lazily.
         if cached_trace is None:
             self.cached_trace = []
         else:
@@ -68,14 +91,25 @@ class Simulation:
         self.cache_misses = 0
         self.cache_hits = 0
 
+        # Incremental checkpoints.
+        #
+        # Most states in the traces are stored as deltas w.r.t. the previous state: only objects that were touched
+        # by some transaction (i.e., are dirty) are re-encoded, and only the fields that actually changed are stored.
+        # Every `keyframe_interval` states, a full state (keyframe) is stored instead, to bound reconstruction costs.
+        self.keyframe_interval = tinytroupe.config_manager.get("checkpoint_keyframe_interval", 20)
+        self._last_encoded_objects = {} # {(kind, name): encoded_state}, the objects as of the latest state in the trace
+        self._dirty_objects = set() # {(kind, name)}, the objects that might have changed since then
+        self._last_fingerprints = {} # {(kind, name): fingerprint}, cheap summaries of the objects as of the latest state in the trace
+        self._last_reconstruction = None # (position, {kind: {name: encoded_state}}), to speed up sequential replays
+        self._last_state_digest = (None, None) # (state, digest), since the same state is added to both traces
+
         # Execution chain mechanism.
         #
-        # The actual, current, execution trace. Each state is a tuple (prev_node_hash, event_hash, state), where prev_node_hash is a hash 
-        # of the previous node in this chain, if any, event_hash is a hash of the event that triggered the transition to this state, if any, 
-        # event_output is the output of the event, if any, and state is the actual complete state that resulted.
+        # The actual, current, execution trace. Each state is a tuple (prev_node_hash, event_hash, event_output, state, node_hash), just like
+        # in the cached trace.
         self.execution_trace = []
 
-    def begin(self, cache_path:str=None, auto_checkpoint:bool=False):
+    def begin(self, cache_path:str=None, auto_checkpoint:bool=False, fast_forward:bool=None):
         """
         Marks the start of the simulation being controlled.
 
@@ -83,6 +117,9 @@ class Simulation:
             cache_path (str): The path to the cache file. If not specified, 
                     defaults to the default cache path defined in the class.
             auto_checkpoint (bool, optional): Whether to automatically checkpoint at the end of each transaction. Defaults to False.
+            fast_forward (bool, optional): Whether to replay cached transactions without restoring their intermediate states. The 
+                    simulation state is then only restored when a transaction that is not cached must run, when a cached output refers
+                    to simulated objects, or when the simulation ends. If not specified, defaults to the FAST_FORWARD_REPLAY config.
         """
 
         logger.debug(f"Starting simulation, cache_path={cache_path}, auto_checkpoint={auto_checkpoint}.")
@@ -104,6 +141,10 @@ class Simulation:
         # should we automatically checkpoint?
         self.auto_checkpoint = auto_checkpoint
 
+        if fast_forward is not None:
+            self.fast_forward = fast_forward
+        self._deferred_restore_position = None
+
         # clear the agents, environments and other simulated entities, we'll track them from now on
         TinyPerson.clear_agents()
         TinyWorld.clear_environments()
@@ -123,14 +164,19 @@ class Simulation:
         """
         logger.debug("Ending simulation.")
         if self.status == Simulation.STATUS_STARTED:
+            self._materialize_state()
             self.status = Simulation.STATUS_STOPPED
             self.checkpoint()
         else:
             raise ValueError("Simulation is already stopped.")
 
-    def checkpoint(self):
+    def checkpoint(self, wait:bool=True):
         """
         Saves current simulation trace to a file.
+
+        Args:
+            wait (bool, optional): Whether to wait until the trace is actually written. If False and background checkpointing
+                is enabled, the trace is written by a background thread instead. Defaults to True.
         """
         logger.debug("Checkpointing simulation state...")
         # save the cache file
@@ -139,6 +185,19 @@ class Simulation:
         else:
             logger.debug("No unsaved cache changes to save to file.")
 
+        # make sure earlier background checkpoints are written too
+        if wait and self._checkpoint_writer is not None:
+            self._checkpoint_writer.flush()
+
+    def _auto_checkpoint(self):
+        """
+        Checkpoints after a transaction, according to the checkpointing policy.
+        """
+        self._transactions_since_checkpoint += 1
+        if self._transactions_since_checkpoint >= self.checkpoint_every_n_transactions:
+            self._transactions_since_checkpoint = 0
+            self.checkpoint(wait=False)
+
     def add_agent(self, agent):
         """
         Adds an agent to the simulation.
@@ -179,9 +238,19 @@ class Simulation:
         """
         return len(self.execution_trace) - 1
     
-    def _function_call_hash(self, function_name, *args, **kwargs) -> int:
+    def _function_call_hash(self, function_name, *args, **kwargs) -> str:
+        """
+        Computes the hash of the given function call, as a fixed-size digest of a canonical fingerprint
+        of the function name and its arguments (see _event_fingerprint).
+        """
+        return _digest([function_name,
+                        [_event_fingerprint(arg) for arg in args],
+                        {k: _event_fingerprint(v) for k, v in kwargs.items()}])
+
+    def _legacy_function_call_hash(self, function_name, *args, **kwargs) -> str:
         """
-        Computes the hash of the given function call.
+        Computes the event identifier used by traces stored by older versions, i.e., the full string representation 
+        of the function call.
         """
 
         # if functions are passed as arguments to the function, there's the problem that their
@@ -202,13 +271,33 @@ class Simulation:
             if callable(v):
                 kwargs_str[k] = v.__name__
                 
-        # then, convert to a single string, to obtain a unique hash
-        event = str((function_name, args_str, kwargs_str))
+        # then, convert to a single string
+        return str((function_name, args_str, kwargs_str))
 
-        # TODO actually compute a short hash of the event string, e.g., using SHA256 ?
-        # event_hash = utils.custom_hash(event)
+    def _compatible_event_hash(self, event_hash, function_name, args, kwargs, parallel=False) -> str:
+        """
+        If the cached event at the current position was stored by an older version and matches the given function call,
+        returns its legacy identifier, so that the cached trace can still be followed. Otherwise, returns the given event hash.
+        The (expensive) legacy identifier is only computed when there is such a legacy event to compare with.
+        """
+        position = self._execution_trace_position()
+
+        if not parallel:
+            if len(self.cached_trace) > position + 1:
+                cached_node = self.cached_trace[position + 1]
+                if not isinstance(cached_node, dict) and len(cached_node) <= 4:
+                    legacy_event_hash = self._legacy_function_call_hash(function_name, *args, **kwargs)
+                    if legacy_event_hash == cached_node[1]:
+                        return legacy_event_hash
+        
+        elif 0 <= position < len(self.cached_trace):
+            parallel_store = self.cached_trace[position]
+            if isinstance(parallel_store, dict) and len(parallel_store) > 0 and event_hash not in parallel_store:
+                legacy_event_hash = self._legacy_function_call_hash(function_name, *args, **kwargs)
+                if legacy_event_hash in parallel_store:
+                    return legacy_event_hash
 
-        return event
+        return event_hash
 
     def _skip_execution_with_cache(self):
         """
@@ -237,13 +326,21 @@ class Simulation:
                     #     - event_hash == c_event_hash_1
                     #     - hash(e0) == c_prev_node_hash_1
                     
+                    cached_node = self.cached_trace[self._execution_trace_position() + 1]
+                    if isinstance(cached_node, dict):
+                        # a parallel segment was cached here, so a sequential event cannot match it
+                        return False
+
                     try:
-                        event_hash_match = event_hash == self.cached_trace[self._execution_trace_position() + 1][1]
+                        event_hash_match = event_hash == cached_node[1]
                     except Exception as e:
                         logger.error(f"Error while checking event hash match: {e}")
                         event_hash_match = False                    
                     
-                    prev_node_match = True # TODO implement real check
+                    if len(cached_node) > 4:
+                        prev_node_match = cached_node[0] == Simulation._node_hash_at(self.execution_trace, self._execution_trace_position())
+                    else:
+                        prev_node_match = True # nodes from older traces do not have comparable hashes
 
                     return event_hash_match and prev_node_match
                 
@@ -264,7 +361,9 @@ class Simulation:
                     else:
                         event_hash_match = False
 
-                    prev_node_match = True # TODO implement real check
+                    # the cached segment must follow the same node as the current one
+                    prev_node_match = Simulation._node_hash_at(self.cached_trace, self._execution_trace_position() - 1) == \
+                                      Simulation._node_hash_at(self.execution_trace, self._execution_trace_position() - 1)
                     
                     return event_hash_match and prev_node_match
 
@@ -281,79 +380,110 @@ class Simulation:
         Drops the cached trace suffix starting at the current execution trace position. This effectively
         refreshes the cache to the current execution state and starts building a new cache from there.
         """
-        self.cached_trace = self.cached_trace[:self._execution_trace_position()+1]
+        del self.cached_trace[self._execution_trace_position()+1:]
         
+    @staticmethod
+    def _node_hash_at(trace, position: int):
+        """
+        Returns the hash of the node at the given position of the trace, or None if there's no such node (or it was 
+        stored by an older version). Parallel segments are transparent to the chain: the node before them is used instead.
+        """
+        for i in range(position, -1, -1):
+            node = trace[i]
+            if not isinstance(node, dict):
+                return node[4] if len(node) > 4 else None
+        return None
+
+    def _state_digest(self, state) -> str:
+        if self._last_state_digest[0] is not state:
+            self._last_state_digest = (state, _digest(state))
+        return self._last_state_digest[1]
+
+    def _make_node(self, previous_hash, state: dict, event_hash, event_output) -> tuple:
+        """
+        Creates a trace node, computing its hash from the previous node's hash, the event, its output and the resulting state.
+        """
+        node_hash = _digest([previous_hash, event_hash, _digest(event_output), self._state_digest(state)])
+        return (previous_hash, event_hash, event_output, state, node_hash)
+
     def _add_to_execution_trace(self, state: dict, event_hash: int, event_output, parallel=False):
         """
         Adds a state to the execution_trace list and computes the appropriate hash.
-        The computed hash is compared to the hash of the cached trace at the same position,
-        and if they don't match, the execution is aborted. Similarly, the event_hash is compared
-        to the hash of the event in the cached trace at the same position, and if they don't match, the execution
-        is aborted.
         """
         
-        # Compute the hash of the previous execution pair, if any
-        previous_hash = None
-
         if not parallel:
-            # Create a tuple of (hash, state) and append it to the execution_trace list
-            self.execution_trace.append((previous_hash, event_hash, event_output, state))
+            previous_hash = Simulation._node_hash_at(self.execution_trace, len(self.execution_trace) - 1)
+            self.execution_trace.append(self._make_node(previous_hash, state, event_hash, event_output))
         else:
-            with concurrent_execution_lock:
-                # state is not stored in parallel segments, only outputs
-                self.execution_trace[-1][event_hash] = {"prev_node_hash": previous_hash,
-                                                        "encoded_output": event_output}
-            
+            # state is not stored in parallel segments, only outputs
+            previous_hash = Simulation._node_hash_at(self.execution_trace, len(self.execution_trace) - 2)
+            self._thread_parallel_buffer()["execution"][event_hash] = {"prev_node_hash": previous_hash,
+                                                                       "encoded_output": event_output}
 
 
     def _add_to_cache_trace(self, state: dict, event_hash: int, event_output, parallel=False):
         """
         Adds a state to the cached_trace list and computes the appropriate hash.
         """
-        # Compute the hash of the previous cached pair, if any
-        previous_hash = None
-        if self.cached_trace:
-            previous_hash = utils.custom_hash(self.cached_trace[-1])
-        
         if not parallel:
-            # Create a tuple of (hash, state) and append it to the cached_trace list
-            self.cached_trace.append((previous_hash, event_hash, event_output, state))
+            previous_hash = Simulation._node_hash_at(self.cached_trace, len(self.cached_trace) - 1)
+            self.cached_trace.append(self._make_node(previous_hash, state, event_hash, event_output))
         else:
-            with concurrent_execution_lock:
-                # state is not stored in parallel segments, only outputs
-                self.cached_trace[-1][event_hash] = {"prev_node_hash": previous_hash,
-                                                    "encoded_output": event_output}
+            # state is not stored in parallel segments, only outputs
+            previous_hash = Simulation._node_hash_at(self.cached_trace, len(self.cached_trace) - 2)
+            self._thread_parallel_buffer()["cache"][event_hash] = {"prev_node_hash": previous_hash,
+                                                                   "encoded_output": event_output}
 
 
         self.has_unsaved_cache_changes = True
     
     def _load_cache_file(self, cache_path:str):
         """
-        Loads the cache file from the given path.
+        Loads the cache file from the given path. Legacy JSON cache files are converted to the trace format first.
+        The cached states themselves are only read when needed.
         """
-        try:
-            self.cached_trace = json.load(open(cache_path, "r", encoding="utf-8", errors="replace"))
-        except FileNotFoundError:
+        if isinstance(self.cached_trace, SimulationTrace):
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.flush()
+            self.cached_trace.close()
+
+        trace = open_trace(cache_path, compress=tinytroupe.config_manager.get("trace_compression", True))
+        if trace is not None:
+            self.cached_trace = trace
+        else:
             logger.info(f"Cache file not found on path: {cache_path}.")
             self.cached_trace = []
         
     def _save_cache_file(self, cache_path:str):
         """
-        Saves the cache file to the given path. Always overwrites.
+        Saves the cache file to the given path. Only the trace entries that changed since the last save are written.
+        With background checkpointing, a snapshot of those entries is handed to the background writer instead.
         """
         logger.debug(f"Now saving cache file to {cache_path}.")
-        try:
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile('w', delete=False) as temp:
-                json.dump(self.cached_trace, temp, indent=4)
-
-            # Replace the original file with the temporary file
-            os.replace(temp.name, cache_path)
-        except Exception as e:
-            traceback_string = ''.join(traceback.format_tb(e.__traceback__))
-            logger.error(f"An error occurred while saving the cache file: {e}\nTraceback:\n{traceback_string}")
+        with self._checkpoint_lock:
+            try:
+                trace_path = resolve_trace_paths(cache_path)[0]
+
+                if not isinstance(self.cached_trace, SimulationTrace) or self.cached_trace.path != trace_path:
+                    # the whole trace must be written to this file, whatever it contained before
+                    if self._checkpoint_writer is not None:
+                        self._checkpoint_writer.flush()
+                    if os.path.exists(trace_path):
+                        os.remove(trace_path)
+                    self.cached_trace = SimulationTrace(trace_path, entries=list(self.cached_trace),
+                                                        compress=tinytroupe.config_manager.get("trace_compression", True))
+
+                if self.background_checkpointing:
+                    if self._checkpoint_writer is None:
+                        self._checkpoint_writer = TraceWriter(min_interval_seconds=self.checkpoint_min_interval_seconds)
+                    self._checkpoint_writer.submit(self.cached_trace)
+                else:
+                    self.cached_trace.save()
+            except Exception as e:
+                traceback_string = ''.join(traceback.format_tb(e.__traceback__))
+                logger.error(f"An error occurred while saving the cache file: {e}\nTraceback:\n{traceback_string}")
 
-        self.has_unsaved_cache_changes = False
+            self.has_unsaved_cache_changes = False
 
     
 
@@ -368,7 +498,7 @@ class Simulation:
         """
         Starts a transaction.
         """
-        with concurrent_execution_lock:
+        with self._transactions_lock:
             self._under_transaction[id] = True
             self._clear_communications_buffers() # TODO <----------------------------------------------------------------
     
@@ -376,14 +506,14 @@ class Simulation:
         """
         Ends a transaction.
         """
-        with concurrent_execution_lock:
+        with self._transactions_lock:
             self._under_transaction[id] = False
     
     def is_under_transaction(self, id=None):
         """
         Checks if the agent is under a transaction.
         """
-        with concurrent_execution_lock:
+        with self._transactions_lock:
             return self._under_transaction.get(id, False)
 
     def _clear_communications_buffers(self):
@@ -403,17 +533,45 @@ class Simulation:
         """
         Starts parallel transactions.
         """
-        with concurrent_execution_lock:
+        with self._transactions_lock:
             self._under_parallel_transactions = True
+            self._parallel_buffers = {}
             # add a new parallel segment to the execution and cache traces
             self.execution_trace.append({}) 
             self.cached_trace.append({})
     
     def end_parallel_transactions(self):
         """
-        Ends parallel transactions.
+        Ends parallel transactions, merging what each thread produced into the segment.
         """
-        self._under_parallel_transactions = False
+        with self._transactions_lock:
+            self._under_parallel_transactions = False
+            buffers = list(self._parallel_buffers.values())
+            self._parallel_buffers = {}
+
+        execution_outputs = {}
+        cached_outputs = {}
+        for buffer in buffers:
+            execution_outputs.update(buffer["execution"])
+            cached_outputs.update(buffer["cache"])
+
+        # events are sorted, so that the segment does not depend on the order in which threads finished
+        if execution_outputs:
+            self.execution_trace[-1].update({event_hash: execution_outputs[event_hash] for event_hash in sorted(execution_outputs)})
+
+        if cached_outputs:
+            # the segment might have been saved already, so it must be explicitly replaced to be saved again
+            parallel_store = dict(self.cached_trace[-1])
+            parallel_store.update({event_hash: cached_outputs[event_hash] for event_hash in sorted(cached_outputs)})
+            self.cached_trace[-1] = parallel_store
+            self.has_unsaved_cache_changes = True
+
+    def _thread_parallel_buffer(self) -> dict:
+        """
+        Returns the current thread's buffer for the outputs of parallel transactions.
+        """
+        # dict.setdefault is atomic, so no lock is needed
+        return self._parallel_buffers.setdefault(threading.get_ident(), {"execution": {}, "cache": {}})
 
     def is_under_parallel_transactions(self):
         """
@@ -424,30 +582,244 @@ class Simulation:
     ###################################################################################################
     # Simulation state handling
     ###################################################################################################
-    
+
+    # the kinds of simulated objects whose states are stored, in the order they are encoded
+    STATE_OBJECT_KINDS = ("agents", "environments", "factories")
+
+    def _objects_of_kind(self, kind:str) -> list:
+        if kind == "agents":
+            return self.agents
+        elif kind == "environments":
+            return self.environments
+        elif kind == "factories":
+            return self.factories
+        else:
+            raise ValueError(f"Unknown kind of simulation object: {kind}")
+
+    def _mark_dirty(self, obj):
+        """
+        Marks the given simulated object as (potentially) changed, so that its state is encoded again at the next checkpoint.
+        """
+        # local import to avoid circular dependencies
+        from tinytroupe.agent import TinyPerson
+        from tinytroupe.environment import TinyWorld
+        from tinytroupe.factory.tiny_factory import TinyFactory
+
+        if isinstance(obj, TinyPerson):
+            self._dirty_objects.add(("agents", obj.name))
+        elif isinstance(obj, TinyWorld):
+            self._dirty_objects.add(("environments", obj.name))
+
+            # environments make their agents act, so these can change as well
+            for agent in obj.agents:
+                self._dirty_objects.add(("agents", agent.name))
+        elif isinstance(obj, TinyFactory):
+            self._dirty_objects.add(("factories", obj.name))
+
+    def _state_fingerprint(self, kind:str, obj):
+        """
+        Returns a cheap summary of the state of a simulated object, which changes with the most common changes made outside
+        of transactions (e.g., storing memories, adding faculties or documents, clearing communication buffers), so that
+        such changes are not missed by delta states even though the object was not marked as dirty.
+        """
+        try:
+            if kind == "agents":
+                return (obj.episodic_memory.count(), obj.semantic_memory.version(), len(obj._mental_faculties), id(obj._persona),
+                        id(obj._mental_state), len(obj._displayed_communications_buffer), len(obj._actions_buffer),
+                        obj.stimuli_count, obj.actions_count, len(obj._accessible_agents))
+            elif kind == "environments":
+                return (len(obj.agents), len(obj._displayed_communications_buffer), obj.current_datetime)
+            else:
+                return None
+        except Exception:
+            # if the object cannot be summarized, it is always encoded again
+            return object()
+
+    def _encode_object_state(self, kind:str, obj) -> dict:
+        """
+        Encodes the state of a single simulated object. The embeddings of vector stores (e.g., in semantic memory) are
+        saved next to the cache file rather than in the state itself, and only when they change.
+        """
+        # local import to avoid circular dependencies
+        from tinytroupe.agent.vector_store import external_storage
+
+        with external_storage(self._vector_storage_folder()):
+            if kind == "environments":
+                # agents that belong to the simulation are already encoded on their own, so environments only refer to them
+                return obj.encode_complete_state(agents_by_reference=self.name_to_agent.keys())
+
+            return obj.encode_complete_state()
+
+    def _vector_storage_folder(self) -> str:
+        """
+        Returns the folder where the vector stores of the encoded states are saved, next to the cache file.
+        """
+        if self.cache_path is None:
+            return None
+
+        return f"{resolve_trace_paths(self.cache_path)[0]}.vectors"
+
+    def _states_since_keyframe(self):
+        """
+        Returns how many states were stored in the cached trace, up to the current execution position, since the latest 
+        keyframe (inclusive), or None if there is no keyframe.
+        """
+        count = 0
+        for i in range(min(self._execution_trace_position(), len(self.cached_trace) - 1), -1, -1):
+            entry = self.cached_trace[i]
+            if isinstance(entry, dict) or entry[3] is None: # parallel segments do not store states
+                continue
+            count += 1
+            if not Simulation._is_delta_state(entry[3]):
+                return count
+        return None
+
+    @staticmethod
+    def _is_delta_state(state) -> bool:
+        return isinstance(state, dict) and state.get("delta", False)
+
     def _encode_simulation_state(self) -> dict:
         """
         Encodes the current simulation state, including agents, environments, and other
-        relevant information.
+        relevant information. The state is encoded either as a full keyframe or as a delta w.r.t.
+        the previous state in the trace, with only the changed fields of the dirty objects.
         """
-        state = {}
+        states_since_keyframe = self._states_since_keyframe()
+        is_keyframe = len(self._last_encoded_objects) == 0 or states_since_keyframe is None or \
+                      states_since_keyframe >= self.keyframe_interval
+
+        if is_keyframe:
+            state = {kind: [] for kind in Simulation.STATE_OBJECT_KINDS}
+        else:
+            state = {"delta": True}
+            state.update({kind: {} for kind in Simulation.STATE_OBJECT_KINDS})
+
+        for kind in Simulation.STATE_OBJECT_KINDS:
+            for obj in self._objects_of_kind(kind):
+                key = (kind, obj.name)
+                previous_obj_state = self._last_encoded_objects.get(key)
+                fingerprint = self._state_fingerprint(kind, obj)
+
+                if previous_obj_state is not None and key not in self._dirty_objects and fingerprint == self._last_fingerprints.get(key):
+                    # unchanged since the previous state
+                    obj_state = previous_obj_state
+                else:
+                    obj_state = self._encode_object_state(kind, obj)
+                    self._last_encoded_objects[key] = obj_state
+                    self._last_fingerprints[key] = fingerprint
+
+                if is_keyframe:
+                    state[kind].append(obj_state)
+                elif previous_obj_state is None:
+                    state[kind][obj.name] = {"changed": obj_state}
+                elif obj_state is not previous_obj_state:
+                    obj_delta = _fields_delta(previous_obj_state, obj_state)
+                    if obj_delta:
+                        state[kind][obj.name] = obj_delta
+
+        self._dirty_objects.clear()
+        self._last_reconstruction = None
 
-        # Encode agents
-        state["agents"] = []
-        for agent in self.agents:
-            state["agents"].append(agent.encode_complete_state())
-        
-        # Encode environments
-        state["environments"] = []
-        for environment in self.environments:
-            state["environments"].append(environment.encode_complete_state())
-        
-        # Encode factories
-        state["factories"] = []
-        for factory in self.factories:
-            state["factories"].append(factory.encode_complete_state())
-                
         return state
+
+    def _reconstruct_objects_states(self, position:int) -> dict:
+        """
+        Reconstructs the states of all simulated objects at the given position of the cached trace, starting from the 
+        latest keyframe and applying the subsequent deltas.
+
+        Returns:
+            dict: {kind: {name: encoded_state}}
+        """
+        # find the states to apply, going back until a keyframe (or a previous reconstruction) is found
+        chain = []
+        base = None
+        for i in range(position, -1, -1):
+            if self._last_reconstruction is not None and self._last_reconstruction[0] == i:
+                base = self._last_reconstruction[1]
+                break
+
+            entry = self.cached_trace[i]
+            if isinstance(entry, dict) or entry[3] is None: # parallel segments do not store states
+                continue
+
+            chain.append(entry[3])
+            if not Simulation._is_delta_state(entry[3]):
+                break
+        else:
+            if not chain or Simulation._is_delta_state(chain[-1]):
+                raise ValueError(f"No keyframe found in the cached trace before position {position}.")
+
+        chain.reverse()
+
+        if base is None:
+            keyframe = chain.pop(0)
+            objects = {kind: {obj_state["name"]: obj_state for obj_state in keyframe[kind]} for kind in Simulation.STATE_OBJECT_KINDS}
+        else:
+            objects = {kind: dict(base[kind]) for kind in Simulation.STATE_OBJECT_KINDS}
+
+        # states are never modified in place, only replaced, so shallow copies are enough here
+        for delta in chain:
+            for kind in Simulation.STATE_OBJECT_KINDS:
+                for name, obj_delta in delta[kind].items():
+                    obj_state = dict(objects[kind].get(name, {}))
+                    obj_state.update(obj_delta.get("changed", {}))
+                    for field in obj_delta.get("removed", []):
+                        obj_state.pop(field, None)
+                    objects[kind][name] = obj_state
+
+        self._last_reconstruction = (position, objects)
+        return objects
+
+    def _state_at(self, position:int) -> dict:
+        """
+        Returns the complete simulation state at the given position of the cached trace, in the format expected
+        by _decode_simulation_state().
+        """
+        objects = self._reconstruct_objects_states(position)
+
+        state = {kind: list(objects[kind].values()) for kind in Simulation.STATE_OBJECT_KINDS}
+
+        # environments only refer to the agents that are encoded on their own
+        state["environments"] = [dict(environment_state, agents=[objects["agents"][agent_state["name"]] if agent_state.get("agent_ref", False) else agent_state
+                                                                 for agent_state in environment_state["agents"]])
+                                 for environment_state in state["environments"]]
+        return state
+
+    def _restore_cached_state(self, position:int):
+        """
+        Restores the simulation state stored at the given position of the cached trace. In fast-forward mode,
+        the restoration is deferred until the state is actually needed (see _materialize_state()), so that
+        replaying a cached prefix only decodes its last state.
+        """
+        if self.fast_forward:
+            self._deferred_restore_position = position
+        else:
+            self._decode_cached_state(position)
+
+    def _materialize_state(self):
+        """
+        Restores the cached state whose restoration was deferred, if any.
+        """
+        with self._deferred_restore_lock:
+            if self._deferred_restore_position is not None:
+                position = self._deferred_restore_position
+                self._deferred_restore_position = None
+                self._decode_cached_state(position)
+
+    def _decode_cached_state(self, position:int):
+        """
+        Decodes the simulation state stored at the given position of the cached trace.
+        """
+        state = self._state_at(position)
+        self._decode_simulation_state(state)
+
+        # the restored objects are now exactly as in the trace
+        objects = self._last_reconstruction[1]
+        self._last_encoded_objects = {(kind, name): obj_state for kind in Simulation.STATE_OBJECT_KINDS 
+                                                              for name, obj_state in objects[kind].items()}
+        self._last_fingerprints = {(kind, obj.name): self._state_fingerprint(kind, obj) for kind in Simulation.STATE_OBJECT_KINDS
+                                                                                          for obj in self._objects_of_kind(kind)}
+        self._dirty_objects.clear()
         
     def _decode_simulation_state(self, state: dict):
         """
@@ -498,6 +870,63 @@ class Simulation:
                 raise ValueError(f"Agent {agent_state['name']} is not in the simulation, thus cannot be decoded there.") from e        
 
 
+def _digest(obj) -> str:
+    """
+    Computes a short, deterministic digest of a JSON-like object. Tuples and lists are digested alike, since
+    they become indistinguishable once the trace is stored.
+    """
+    return hashlib.blake2b(json.dumps(obj, separators=(",", ":"), default=str).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _event_fingerprint(value):
+    """
+    Computes a canonical, JSON-serializable fingerprint of a function call argument, to identify transaction events.
+    Simulated objects are identified by their kind and name, callables by their qualified name, and containers
+    recursively. Other values are identified by their string representation.
+    """
+    # local import to avoid circular dependencies
+    from tinytroupe.agent import TinyPerson
+    from tinytroupe.environment import TinyWorld
+    from tinytroupe.factory.tiny_factory import TinyFactory
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, TinyPerson):
+        return ["TinyPerson", value.name]
+    elif isinstance(value, TinyWorld):
+        return ["TinyWorld", value.name]
+    elif isinstance(value, TinyFactory):
+        return ["TinyFactory", value.name]
+    elif isinstance(value, (list, tuple)):
+        return [_event_fingerprint(item) for item in value]
+    elif isinstance(value, dict):
+        return ["dict", sorted([str(k), _event_fingerprint(v)] for k, v in value.items())]
+    elif isinstance(value, (set, frozenset)):
+        return ["set", sorted(_digest(_event_fingerprint(item)) for item in value)]
+    elif callable(value):
+        # the default string representation of functions includes their memory position, which changes from run to run
+        return ["callable", getattr(value, "__module__", None), getattr(value, "__qualname__", type(value).__qualname__)]
+    else:
+        return [type(value).__qualname__, str(value)]
+
+
+def _fields_delta(old_state: dict, new_state: dict) -> dict:
+    """
+    Computes the top-level fields that changed between two encoded states of the same object.
+    """
+    delta = {}
+
+    changed = {field: value for field, value in new_state.items() if field not in old_state or old_state[field] != value}
+    if changed:
+        delta["changed"] = changed
+
+    removed = [field for field in old_state if field not in new_state]
+    if removed:
+        delta["removed"] = removed
+
+    return delta
+
+
 class Transaction:
 
     def __init__(self, obj_under_transaction, simulation, function, *args, **kwargs):
@@ -513,6 +942,10 @@ class Transaction:
         self.args = args
         self.kwargs = kwargs    
 
+        # whatever the object under transaction is, it might change, so must be checkpointed again
+        if simulation is not None:
+            simulation._mark_dirty(obj_under_transaction)
+
         #
         # If we have an ongoing simulation, set the simulation id of the object under transaction if it is not already set.
         #
@@ -559,6 +992,10 @@ class Transaction:
             if begin_parallel:
                 self.simulation.begin_parallel_transactions()
             
+            # traces stored by older versions identify events differently
+            event_hash = self.simulation._compatible_event_hash(event_hash, self.function_name, self.args, self.kwargs,
+                                                                parallel=self.simulation.is_under_parallel_transactions())
+
             # CACHED? Check if the event hash is in the cache
             if self.simulation._is_transaction_event_cached(event_hash, 
                                                             parallel=self.simulation.is_under_parallel_transactions()):
@@ -571,13 +1008,13 @@ class Transaction:
                 if not self.simulation.is_under_parallel_transactions():
                     
                     self.simulation._skip_execution_with_cache()
-                    state = self.simulation.cached_trace[self.simulation._execution_trace_position()][3] # state
-                    self.simulation._decode_simulation_state(state)
+                    self.simulation._restore_cached_state(self.simulation._execution_trace_position())
                     
                     # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
                     # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
                     # encoded/decoded as is.
                     encoded_output = self.simulation.cached_trace[self.simulation._execution_trace_position()][2] # output
+                    self._materialize_state_if_referenced(encoded_output)
                     output = self._decode_function_output(encoded_output)
                 
                 # PARALLEL
@@ -585,10 +1022,14 @@ class Transaction:
 
                     # in parallel segments, state is not restored, only outputs
                     encoded_output = self.simulation._get_cached_parallel_value(event_hash, "encoded_output")
+                    self._materialize_state_if_referenced(encoded_output)
                     output = self._decode_function_output(encoded_output)
 
             else: # not cached
 
+                # the function will actually run, so it needs the current state, if it was not restored yet
+                self.simulation._materialize_state()
+
                 if not begin_parallel:
                     # in case of beginning a parallel segment, we don't want to count it as a cache miss,
                     # since the segment itself will not be cached, but rather the events within it.
@@ -637,7 +1078,7 @@ class Transaction:
         logger.debug(f"Will attempt to checkpoint simulation state after transaction execution.")
         if self.simulation is not None and self.simulation.auto_checkpoint:
             logger.debug("Auto-checkpointing simulation state after transaction execution.")
-            self.simulation.checkpoint()
+            self.simulation._auto_checkpoint()
 
         # after all the transaction is done, return the output - the client will never know about all the complexity we've
         # gone through to get here.
@@ -645,7 +1086,12 @@ class Transaction:
     
     def _save_output_with_simulation_state(self, event_hash, output):
         encoded_output = self._encode_function_output(output)
-        state = self.simulation._encode_simulation_state()
+
+        # states are not stored in parallel segments, so there's no need to encode them there
+        if not self.simulation.is_under_parallel_transactions():
+            state = self.simulation._encode_simulation_state()
+        else:
+            state = None
 
         # immediately drop the cached trace suffix, since we are starting a new execution from this point on.
         # in the case of parallel transactions, this will drop everything _after_ the current parallel segment
@@ -695,6 +1141,14 @@ class Transaction:
         else:
             raise ValueError(f"Unsupported output type: {type(output)}")
 
+    def _materialize_state_if_referenced(self, encoded_output: dict):
+        """
+        Cached outputs that refer to simulated objects (e.g., agents created by the cached transactions) can only 
+        be decoded once the corresponding state is restored.
+        """
+        if encoded_output is not None and encoded_output["type"] != "JSON":
+            self.simulation._materialize_state()
+
     def _decode_function_output(self, encoded_output: dict):
         """
         Decodes the given encoded function output.
@@ -739,7 +1193,8 @@ def transactional(parallel=False):
             simulation = current_simulation()
             obj_sim_id = obj_under_transaction.simulation_id if hasattr(obj_under_transaction, 'simulation_id') else None
 
-            logger.debug(f"-----------------------------------------> Transaction: {func.__name__} with args {args[1:]} and kwargs {kwargs} under simulation {obj_sim_id}, parallel={parallel}.")
+            if logger.isEnabledFor(logging.DEBUG): # avoids rendering the arguments, which might be large, when not needed
+                logger.debug(f"-----------------------------------------> Transaction: {func.__name__} with args {args[1:]} and kwargs {kwargs} under simulation {obj_sim_id}, parallel={parallel}.")
             
             parallel_id = str(threading.current_thread())
             
@@ -791,13 +1246,13 @@ def _simulation(id="default"):
     
     return _current_simulations[id]
 
-def begin(cache_path=None, id="default", auto_checkpoint=False):
+def begin(cache_path=None, id="default", auto_checkpoint=False, fast_forward=None):
     """
     Marks the start of the simulation being controlled.
     """
     global _current_simulation_id
     if _current_simulation_id is None:
-        _simulation(id).begin(cache_path, auto_checkpoint)
+        _simulation(id).begin(cache_path, auto_checkpoint, fast_forward)
         _current_simulation_id = id
     else:
         raise ValueError(f"Simulation is already started under id {_current_simulation_id}. Currently only one simulation can be started at a time.")   
@@ -0,0 +1,476 @@
+"""
+Step executors make the agents of an environment act during a simulation step. The default executor runs
+the agents in threads, which is adequate while agents are mostly waiting for the LLM API. However, a good
+part of the work done inside `act` is CPU-bound (e.g., prompt rendering, serialization of the mental state,
+memory operations), and threads cannot run it in parallel. For large populations, the process executor
+therefore keeps a copy of each agent in a worker process, sends it the changes to the agent's state at each
+step, runs `act` there, and brings back the resulting actions together with the changes the agent made.
+
+In all cases, the actions themselves are handled by the environment afterwards, sequentially and in the
+order of its agents, so that their effects are deterministic.
+"""
+
+import atexit
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+
+from tinytroupe.environment import logger
+from tinytroupe.agent import TinyPerson
+from tinytroupe.agent.memory import EpisodicMemory, SemanticMemory
+from tinytroupe.utils import JsonSerializableRegistry
+from tinytroupe import config_manager
+
+
+class StepExecutor:
+    """
+    Base class for step executors. Executors keep their pool of workers across steps, creating it when first
+    needed, and record how many agents are waiting for a worker and how long each agent takes to act.
+    """
+
+    def __init__(self, max_workers:int=None):
+        self.max_workers = max_workers
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        self._metrics_lock = threading.Lock()
+        self._pending_futures = set()
+        self._agent_latencies = {} # agent name -> {"count": ..., "total": ..., "last": ..., "max": ...}
+
+    def act(self, environment, agents:list) -> list:
+        """
+        Makes the specified agents act once, that is, until they are done and need additional stimuli.
+
+        Args:
+            environment (TinyWorld): The environment in which the agents act.
+            agents (list): The agents that must act.
+
+        Returns:
+            list: A list of (agent, actions, exception) tuples, in the same order as the agents. If the agent
+                  failed to act, actions is None and exception is the error raised.
+        """
+        results = {}
+        for agent, actions, exc in self.act_as_completed(environment, agents):
+            results[id(agent)] = (agent, actions, exc)
+
+        return [results[id(agent)] for agent in agents]
+
+    def act_as_completed(self, environment, agents:list):
+        """
+        Makes the specified agents act once, like `act`, but yields the (agent, actions, exception) tuples
+        as soon as each agent is done, in the order in which they finish.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def shutdown(self):
+        """
+        Shuts down the workers of the executor. They are created again if the executor is used afterwards.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+
+    def queue_depth(self) -> int:
+        """
+        Returns the number of agents that are waiting for a worker to become available.
+        """
+        with self._metrics_lock:
+            return sum(1 for future in self._pending_futures if not future.running())
+
+    def agent_latencies(self) -> dict:
+        """
+        Returns the time taken by each agent to act, in seconds, as a dict of the form
+        {agent_name: {"count": ..., "mean": ..., "last": ..., "max": ...}}.
+        """
+        with self._metrics_lock:
+            return {name: {"count": latency["count"],
+                           "mean": latency["total"] / latency["count"],
+                           "last": latency["last"],
+                           "max": latency["max"]}
+                    for name, latency in self._agent_latencies.items()}
+
+    def stats(self) -> dict:
+        """
+        Returns the current metrics of the executor.
+        """
+        with self._metrics_lock:
+            pending = len(self._pending_futures)
+
+        queue_depth = self.queue_depth()
+
+        return {"max_workers": self.max_workers,
+                "queue_depth": queue_depth,
+                "in_progress": pending - queue_depth,
+                "agent_latencies": self.agent_latencies()}
+
+    def _create_pool(self) -> concurrent.futures.Executor:
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def _submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+            pool = self._pool
+
+        return self._track_future(pool.submit(fn, *args, **kwargs))
+
+    def _track_future(self, future:concurrent.futures.Future) -> concurrent.futures.Future:
+        with self._metrics_lock:
+            self._pending_futures.add(future)
+        future.add_done_callback(self._discard_future)
+
+        return future
+
+    def _discard_future(self, future):
+        with self._metrics_lock:
+            self._pending_futures.discard(future)
+
+    def _record_latency(self, agent_name:str, seconds:float):
+        with self._metrics_lock:
+            latency = self._agent_latencies.get(agent_name)
+            if latency is None:
+                self._agent_latencies[agent_name] = {"count": 1, "total": seconds, "last": seconds, "max": seconds}
+            else:
+                latency["count"] += 1
+                latency["total"] += seconds
+                latency["last"] = seconds
+                latency["max"] = max(latency["max"], seconds)
+
+
+class ThreadStepExecutor(StepExecutor):
+    """
+    Makes agents act in parallel threads of the current process.
+    """
+
+    def act_as_completed(self, environment, agents:list):
+        futures = {self._submit(self._timed_act, agent): agent for agent in agents}
+
+        for future in concurrent.futures.as_completed(futures):
+            agent = futures[future]
+            try:
+                actions = future.result()
+            except Exception as exc:
+                yield agent, None, exc
+            else:
+                yield agent, actions, None
+
+    def _create_pool(self):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="TinyWorldStep")
+
+    def _timed_act(self, agent):
+        start = time.monotonic()
+        try:
+            return agent.act(return_actions=True)
+        finally:
+            self._record_latency(agent.name, time.monotonic() - start)
+
+
+class ProcessStepExecutor(StepExecutor):
+    """
+    Makes agents act in a pool of worker processes.
+
+    Each agent always acts in the same worker, which keeps a copy of it between steps. At each step, only what
+    changed since the agent last acted is sent to the worker (see `_encode_state_delta`): the small top-level fields
+    of its state, the episodic memories stored meanwhile (e.g., the stimuli received), and the semantic memory or 
+    mental faculties only if they changed. The worker returns the actions taken together with the changes to the 
+    agent's state, encoded the same way, which are then applied to the original agent. Communications produced 
+    while acting are replayed through the environment, so that they are displayed and buffered as usual.
+
+    Note that, since workers are separate processes, they do not share the API cache, rate limits or
+    other process-wide settings with the main process beyond what is configured in the config file. Agents'
+    mental faculties must also be importable by the workers, and, as usual with worker processes, scripts
+    must start the simulation under an `if __name__ == "__main__":` guard.
+    """
+
+    def __init__(self, max_workers:int=None):
+        super().__init__(max_workers=max_workers)
+
+        # one single-process pool per worker, so that agents can be sent to the worker that already has them
+        self._pools = []
+        self._agents_workers = {} # agent name -> index of the worker the agent acts in
+
+        # what each worker knows about its agents, as of the last time they acted
+        self._synced_agents = {} # agent name -> (sync id, weak reference to the agent, sync record)
+        self._sync_ids = itertools.count(1)
+
+    def act_as_completed(self, environment, agents:list):
+        futures = {self._submit_agent(environment, agent): agent for agent in agents}
+
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                agent = futures.pop(future)
+                try:
+                    actions, sync_id, delta, communications, elapsed = future.result()
+                except _AgentOutOfSyncError:
+                    # the worker lost its copy of the agent, so the complete state is sent again
+                    self._synced_agents.pop(agent.name, None)
+                    futures[self._submit_agent(environment, agent)] = agent
+                    continue
+                except concurrent.futures.process.BrokenProcessPool as exc:
+                    # a dead worker breaks its pool, so we must start a new one for the next steps, and the agents it had are lost
+                    self._reset_worker(self._agents_workers[agent.name])
+                    yield agent, None, exc
+                    continue
+                except Exception as exc:
+                    # the worker dropped its copy of the agent, which might have been left half-changed
+                    self._synced_agents.pop(agent.name, None)
+                    yield agent, None, exc
+                    continue
+
+                self._record_latency(agent.name, elapsed)
+
+                # accessible agents are only changed by the environment, so we keep the very same objects
+                accessible_agents = agent._accessible_agents
+                _apply_state_delta(agent, delta)
+                agent._accessible_agents = accessible_agents
+
+                self._synced_agents[agent.name] = (sync_id, weakref.ref(agent), _sync_record(agent))
+
+                for communication in communications:
+                    environment._push_and_display_latest_communication(communication)
+
+                yield agent, actions, None
+
+    def shutdown(self):
+        with self._pool_lock:
+            for pool in self._pools:
+                if pool is not None:
+                    pool.shutdown(wait=True, cancel_futures=True)
+            self._pools = []
+            self._agents_workers = {}
+            self._synced_agents = {}
+
+    def _submit_agent(self, environment, agent) -> concurrent.futures.Future:
+        synced = self._synced_agents.get(agent.name)
+        if synced is not None and synced[1]() is not agent:
+            # another agent with the same name (e.g., from an earlier simulation)
+            synced = None
+
+        base_sync_id, base = (synced[0], synced[2]) if synced is not None else (None, None)
+        delta = _encode_state_delta(agent, base)
+
+        return self._submit_to_worker(self._worker_for(agent.name), _act_in_worker, agent.name, base_sync_id, next(self._sync_ids),
+                                      delta, environment.current_datetime, TinyPerson.communication_display)
+
+    def _worker_for(self, agent_name:str) -> int:
+        with self._pool_lock:
+            worker = self._agents_workers.get(agent_name)
+            if worker is None:
+                # new agents go to the worker with the fewest agents
+                workers_count = self.max_workers or os.cpu_count() or 1
+                loads = [0] * workers_count
+                for assigned_worker in self._agents_workers.values():
+                    loads[assigned_worker] += 1
+                worker = loads.index(min(loads))
+                self._agents_workers[agent_name] = worker
+
+            return worker
+
+    def _submit_to_worker(self, worker:int, fn, *args, **kwargs) -> concurrent.futures.Future:
+        with self._pool_lock:
+            while len(self._pools) <= worker:
+                self._pools.append(None)
+            if self._pools[worker] is None:
+                self._pools[worker] = self._create_pool()
+            pool = self._pools[worker]
+
+        return self._track_future(pool.submit(fn, *args, **kwargs))
+
+    def _reset_worker(self, worker:int):
+        with self._pool_lock:
+            if worker < len(self._pools):
+                self._pools[worker] = None
+
+            for agent_name, assigned_worker in self._agents_workers.items():
+                if assigned_worker == worker:
+                    self._synced_agents.pop(agent_name, None)
+
+    def _create_pool(self):
+        # spawn is used to avoid forking a process that may hold locks in other threads (e.g., from clients)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+
+class _AgentOutOfSyncError(Exception):
+    """
+    Raised by a worker asked to apply changes to a copy of an agent it does not have.
+    """
+    pass
+
+def _sync_record(agent) -> dict:
+    """
+    Returns what must be remembered about an agent, right after it was synchronized with a worker, to tell which parts
+    of its state changed since then. The memories and faculties are identified by their objects, so that replacing
+    them (e.g., when restoring a cached simulation state) is always noticed.
+    """
+    episodic_memory = agent.episodic_memory
+    return {"episodic_memory": (id(episodic_memory), id(episodic_memory.memory), len(episodic_memory.memory), episodic_memory.count()),
+            "semantic_memory": (id(agent.semantic_memory), agent.semantic_memory.version()),
+            "mental_faculties": tuple((id(faculty), tuple(value.documents_version() for value in vars(faculty).values()
+                                                          if hasattr(value, "documents_version")))
+                                      for faculty in agent._mental_faculties)}
+
+def _encode_state_delta(agent, base:dict) -> dict:
+    """
+    Encodes the parts of the agent state that changed since the sync record base was taken, or the complete state if
+    base is None. The small top-level fields of the state are always included, while episodic memory is only included
+    if values were removed from it (otherwise, the values stored since are included instead).
+    """
+    delta = {"state": agent.encode_complete_state(include_memory=False, include_mental_faculties=False)}
+    record = _sync_record(agent)
+
+    episodic_memory = agent.episodic_memory
+    if base is not None and record["episodic_memory"][:2] == base["episodic_memory"][:2] and \
+       len(episodic_memory.memory) >= base["episodic_memory"][2] and episodic_memory.count() >= base["episodic_memory"][3]:
+        delta["episodic_memory_values"] = episodic_memory._window(start=base["episodic_memory"][3])
+        delta["episodic_memory_length"] = len(episodic_memory.memory)
+    else:
+        delta["episodic_memory"] = episodic_memory.to_json()
+
+    if base is None or record["semantic_memory"] != base["semantic_memory"]:
+        delta["semantic_memory"] = agent.semantic_memory.to_json()
+
+    if base is None or record["mental_faculties"] != base["mental_faculties"]:
+        delta["mental_faculties"] = [faculty.to_json() for faculty in agent._mental_faculties]
+
+    return delta
+
+def _apply_state_delta(agent, delta:dict):
+    """
+    Applies to the agent the changes encoded by `_encode_state_delta`.
+    """
+    state = dict(delta["state"])
+    del state["_accessible_agents"]
+
+    if "episodic_memory" in delta:
+        agent.episodic_memory = EpisodicMemory.from_json(delta["episodic_memory"])
+    else:
+        agent.episodic_memory._extend(delta["episodic_memory_values"], delta["episodic_memory_length"])
+
+    if "semantic_memory" in delta:
+        agent.semantic_memory = SemanticMemory.from_json(delta["semantic_memory"])
+
+    if "mental_faculties" in delta:
+        agent._mental_faculties = [JsonSerializableRegistry.from_json(faculty_state) for faculty_state in delta["mental_faculties"]]
+
+    agent.__dict__.update(state)
+
+    agent._invalidate_prompt_cache()
+    agent._memory_context_cache = None
+
+
+###########################################################################
+# Worker side
+###########################################################################
+
+# the agents already created in this worker process, reused across steps
+_worker_agents = {} # name -> agent
+
+# the latest sync id of each agent whose copy in this worker is up to date
+_worker_sync_ids = {} # name -> sync id
+
+class _WorkerEnvironment:
+    """
+    Stands for the actual environment while an agent acts in a worker process. It provides the current
+    datetime and collects the communications the agent produces, so that the actual environment can
+    display them afterwards.
+    """
+
+    def __init__(self, current_datetime):
+        self.current_datetime = current_datetime
+        self.communications = []
+
+    def _push_and_display_latest_communication(self, communication):
+        self.communications.append(communication)
+
+def _act_in_worker(name:str, base_sync_id:int, sync_id:int, delta:dict, current_datetime, communication_display:bool):
+    """
+    Makes the specified agent act in the current worker process, after applying the changes to its state made since
+    it was last synchronized (base_sync_id), or its complete state if base_sync_id is None.
+
+    Returns:
+        tuple: The actions taken, the new sync id, the changes to the agent state, the communications produced, 
+               and the time taken to act.
+    """
+    worker_sync_id = _worker_sync_ids.pop(name, None)
+    if base_sync_id is not None and worker_sync_id != base_sync_id:
+        raise _AgentOutOfSyncError(f"Worker does not have agent {name} as of sync {base_sync_id}.")
+
+    agent = _worker_agents.get(name)
+    if agent is None:
+        agent = TinyPerson(name)
+        _worker_agents[name] = agent
+
+    _apply_state_delta(agent, delta)
+
+    # other agents live in the main process, and only the environment may change them anyway
+    agent._accessible_agents = []
+
+    base = _sync_record(agent)
+
+    environment = _WorkerEnvironment(current_datetime)
+    agent.environment = environment
+    start = time.monotonic()
+    try:
+        actions = agent.act(return_actions=True, communication_display=communication_display)
+    finally:
+        elapsed = time.monotonic() - start
+        agent.environment = None
+
+    new_delta = _encode_state_delta(agent, base)
+    new_delta["state"]["_accessible_agents"] = delta["state"]["_accessible_agents"]
+
+    _worker_sync_ids[name] = sync_id
+
+    return actions, sync_id, new_delta, environment.communications, elapsed
+
+
+###########################################################################
+# Executors registry
+###########################################################################
+
+_shared_process_executors = {} # max_workers -> executor
+_shared_process_executors_lock = threading.Lock()
+
+def get_step_executor(kind:str=None, max_workers:int=None) -> StepExecutor:
+    """
+    Returns a step executor of the specified kind. Process executors are shared by all environments,
+    so that worker processes are created only once.
+
+    Args:
+        kind (str, optional): Either "thread" or "process". Defaults to the STEP_EXECUTOR config value.
+        max_workers (int, optional): The maximum number of workers. Defaults to the STEP_EXECUTOR_WORKERS
+            config value. If that is 0, thread executors use as many threads as the LLM requests allowed to be in
+            flight (MAX_CONCURRENT_REQUESTS), since more would just wait for the API, and process executors use
+            one process per CPU.
+    """
+    if kind is None:
+        kind = config_manager.get("step_executor", "thread")
+    if max_workers is None:
+        max_workers = config_manager.get("step_executor_workers", 0) or None
+
+    kind = kind.lower()
+    if kind == "thread":
+        if max_workers is None:
+            max_workers = config_manager.get("max_concurrent_requests", 64) or None
+        return ThreadStepExecutor(max_workers=max_workers)
+
+    elif kind == "process":
+        with _shared_process_executors_lock:
+            if max_workers not in _shared_process_executors:
+                _shared_process_executors[max_workers] = ProcessStepExecutor(max_workers=max_workers)
+            return _shared_process_executors[max_workers]
+
+    else:
+        raise ValueError(f"Unknown step executor: {kind}")
+
+@atexit.register
+def _shutdown_shared_executors():
+    for executor in _shared_process_executors.values():
+        executor.shutdown()
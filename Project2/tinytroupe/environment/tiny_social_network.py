@@ -15,7 +15,7 @@ AgentOrWorld = Union["TinyPerson", "TinyWorld"]
 
 class TinySocialNetwork(TinyWorld):
 
-    def __init__(self, name, broadcast_if_no_target=True):
+    def __init__(self, name, broadcast_if_no_target=True, step_executor=None, scheduling=None):
         """
         Create a new TinySocialNetwork environment.
 
@@ -23,11 +23,22 @@ class TinySocialNetwork(TinyWorld):
             name (str): The name of the environment.
             broadcast_if_no_target (bool): If True, broadcast actions through an agent's available relations
               if the target of an action is not found.
+            step_executor (str or StepExecutor): How agents act when steps are parallelized. See TinyWorld.
+            scheduling (str): Which agents act at each step, either "all" or "event_driven". See TinyWorld.
         """
         
-        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target)
+        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target, step_executor=step_executor, scheduling=scheduling)
 
         self.relations = {}
+
+        # for each relation, the agents each agent is related to, allowing quick lookups in large networks
+        self._relations_adjacency = {} # {relation_name: {agent_name: {other_agent_name: True, ...}, ...}, ...}
+
+        # for each agent, the agents it is related to in any relation, rebuilt only when its relations change
+        self._agents_neighbours = {} # {agent_name: [other_agent_name, ...], ...}
+
+        # the agents whose accessible agents must be updated because their relations changed
+        self._agents_with_outdated_contexts = {} # {agent_name: True, ...}
     
     @transactional()
     def add_relation(self, agent_1, agent_2, name="default"):
@@ -43,41 +54,92 @@ class TinySocialNetwork(TinyWorld):
         logger.debug(f"Adding relation {name} between {agent_1.name} and {agent_2.name}.")
 
         # agents must already be in the environment, if not they are first added
-        if agent_1 not in self.agents:
-            self.agents.append(agent_1)
-        if agent_2 not in self.agents:
-            self.agents.append(agent_2)
+        for agent in [agent_1, agent_2]:
+            if (self.name_to_agent.get(agent.name) is not agent) and (agent not in self.agents):
+                self.agents.append(agent)
 
         if name in self.relations:
             self.relations[name].append((agent_1, agent_2))
         else:
             self.relations[name] = [(agent_1, agent_2)]
+            self._relations_adjacency[name] = {}
+
+        adjacency = self._relations_adjacency[name]
+        adjacency.setdefault(agent_1.name, {})[agent_2.name] = True
+        adjacency.setdefault(agent_2.name, {})[agent_1.name] = True
+
+        self._agents_neighbours.pop(agent_1.name, None)
+        self._agents_neighbours.pop(agent_2.name, None)
+
+        self._agents_with_outdated_contexts[agent_1.name] = True
+        self._agents_with_outdated_contexts[agent_2.name] = True
 
         return self # for chaining
     
+    def add_agent(self, agent: TinyPerson):
+        """
+        Adds an agent to the environment. Its accessible agents are reset to the agents it is related to 
+        at the next step.
+        """
+        super().add_agent(agent)
+        self._agents_with_outdated_contexts[agent.name] = True
+
+        return self # for chaining
+
     @transactional()
     def _update_agents_contexts(self):
         """
-        Updates the agents' observations based on the current state of the world.
+        Updates the agents' observations based on the current state of the world, so that each agent can 
+        access exactly the agents it is related to. Only the agents whose relations changed since the last 
+        update are visited.
         """
+        if not self._agents_with_outdated_contexts:
+            return
+
+        for agent_name in self._agents_with_outdated_contexts:
+            agent = self._get_related_agent(agent_name)
+            if agent is None:
+                # the agent has since left the environment
+                continue
 
-        # clear all accessibility first
-        for agent in self.agents:
+            logger.debug(f"Updating the accessible agents of {agent_name}.")
             agent.make_all_agents_inaccessible()
+            for related_agent_name in self._related_agents_names(agent):
+                related_agent = self._get_related_agent(related_agent_name)
+                if related_agent is not None:
+                    agent.make_agent_accessible(related_agent)
+
+        self._agents_with_outdated_contexts = {}
+
+    def _related_agents_names(self, agent:TinyPerson) -> list:
+        """
+        Returns the names of the agents related to the specified agent, in any relation, following the order in 
+        which the relations were added.
+        """
+        if agent.name not in self._agents_neighbours:
+            related_agents_names = {}
+            for adjacency in self._relations_adjacency.values():
+                related_agents_names.update(adjacency.get(agent.name, {}))
+            self._agents_neighbours[agent.name] = list(related_agents_names)
+
+        return self._agents_neighbours[agent.name]
+
+    def _get_related_agent(self, name:str) -> TinyPerson:
+        agent = self.get_agent_by_name(name)
+        if agent is None:
+            # agents added through relations might not be registered by name
+            agent = next((agent for agent in self.agents if agent.name == name), None)
 
-        # now update accessibility based on relations
-        for relation_name, relation in self.relations.items():
-            logger.debug(f"Updating agents' observations for relation {relation_name}.")
-            for agent_1, agent_2 in relation:
-                agent_1.make_agent_accessible(agent_2)
-                agent_2.make_agent_accessible(agent_1)
+        return agent
 
     @transactional()
-    def _step(self):
+    def _step(self, timedelta_per_step=None, randomize_agents_order=True, parallelize=True):
         self._update_agents_contexts()
 
         #call super
-        super()._step()
+        return super()._step(timedelta_per_step=timedelta_per_step, 
+                             randomize_agents_order=randomize_agents_order, 
+                             parallelize=parallelize)
     
     @transactional()
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
@@ -119,14 +181,17 @@ class TinySocialNetwork(TinyWorld):
         Returns:
             bool: True if the two agents are in the given relation, False otherwise.
         """
+        if agent_1 is None or agent_2 is None:
+            return False
+
         if relation_name is None:
-            for relation_name, relation in self.relations.items():
-                if (agent_1, agent_2) in relation or (agent_2, agent_1) in relation:
+            for adjacency in self._relations_adjacency.values():
+                if agent_2.name in adjacency.get(agent_1.name, {}):
                     return True
             return False
         
         else:
-            if relation_name in self.relations:
-                return (agent_1, agent_2) in self.relations[relation_name] or (agent_2, agent_1) in self.relations[relation_name]
+            if relation_name in self._relations_adjacency:
+                return agent_2.name in self._relations_adjacency[relation_name].get(agent_1.name, {})
             else:
                 return False
\ No newline at end of file
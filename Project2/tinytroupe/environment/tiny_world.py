@@ -4,12 +4,12 @@ import copy
 from datetime import datetime, timedelta
 import textwrap
 import random
-import concurrent.futures
 
 from tinytroupe.agent import *
 from tinytroupe.utils import name_or_empty, pretty_datetime
 import tinytroupe.control as control
 from tinytroupe.control import transactional
+from tinytroupe.environment.step_executor import StepExecutor, ThreadStepExecutor, get_step_executor
 from tinytroupe import utils
 from tinytroupe import config_manager
  
@@ -33,7 +33,10 @@ class TinyWorld:
                  initial_datetime=datetime.now(),
                  interventions=[],
                  broadcast_if_no_target=True,
-                 max_additional_targets_to_display=3):
+                 max_additional_targets_to_display=3,
+                 step_executor=None,
+                 stream_actions=None,
+                 scheduling=None):
         """
         Initializes an environment.
 
@@ -46,6 +49,13 @@ class TinyWorld:
             broadcast_if_no_target (bool): If True, broadcast actions if the target of an action is not found.
             max_additional_targets_to_display (int): The maximum number of additional targets to display in a communication. If None, 
                 all additional targets are displayed.
+            step_executor (str or StepExecutor): How agents act when steps are parallelized, either "thread", "process" or
+                a StepExecutor instance. Defaults to the STEP_EXECUTOR config value.
+            stream_actions (bool): If True, when steps are parallelized, the actions of each agent are handled as soon as possible
+                instead of after all agents have acted. See _step_in_parallel_as_completed. Defaults to the STREAM_AGENT_ACTIONS 
+                config value.
+            scheduling (str): Which agents act at each step, either "all" (every agent acts at every step) or "event_driven" (only agents
+                that received new stimuli since they last acted, or that were woken up, act). Defaults to the AGENT_SCHEDULING config value.
         """
 
         if name is not None:
@@ -55,6 +65,10 @@ class TinyWorld:
             
         self.current_datetime = initial_datetime
         self.broadcast_if_no_target = broadcast_if_no_target
+        self.stream_actions = stream_actions if stream_actions is not None else config_manager.get("stream_agent_actions", False)
+        self.scheduling = scheduling if scheduling is not None else config_manager.get("agent_scheduling", "all")
+        if self.scheduling not in ["all", "event_driven"]:
+            raise ValueError(f"Unknown agent scheduling: {self.scheduling}")
         self.simulation_id = None # will be reset later if the agent is used within a specific simulation scope
         
         self.agents = []
@@ -62,6 +76,12 @@ class TinyWorld:
 
         self._interventions = interventions
 
+        # the number of stimuli each agent had received when it last acted, used to detect new stimuli
+        self._stimuli_count_when_last_acted = {} # {agent_name: stimuli_count, ...}
+
+        # the agents that must act regardless of stimuli, either at the next step (None) or once the given datetime is reached
+        self._scheduled_wake_ups = {} # {agent_name: ISO datetime or None, ...}
+
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
@@ -72,6 +92,15 @@ class TinyWorld:
 
         self.console = Console()
 
+        # the executor used to make agents act in parallel, reused across steps. Executors given by the caller
+        # or shared by several environments are not shut down by this environment.
+        if isinstance(step_executor, StepExecutor):
+            self._step_executor = step_executor
+            self._owns_step_executor = False
+        else:
+            self._step_executor = get_step_executor(step_executor)
+            self._owns_step_executor = isinstance(self._step_executor, ThreadStepExecutor)
+
         # add the environment to the list of all environments
         TinyWorld.add_environment(self)
         
@@ -107,25 +136,29 @@ class TinyWorld:
                 if TinyWorld.communication_display:
                     self._display_intervention_communication(intervention)
                 intervention.apply_effect()
+                self._wake_up_intervention_targets(intervention)
                 
                 logger.debug(f"[{self.name}] Intervention '{intervention.name}' was applied.")
 
+        agents = self._agents_to_activate()
+
         # Agents can act in parallel or sequentially
         if parallelize:
-            agents_actions = self._step_in_parallel(timedelta_per_step=timedelta_per_step)
+            agents_actions = self._step_in_parallel(timedelta_per_step=timedelta_per_step, agents=agents)
         else:
             agents_actions = self._step_sequentially(timedelta_per_step=timedelta_per_step, 
-                                                 randomize_agents_order=randomize_agents_order)
+                                                 randomize_agents_order=randomize_agents_order,
+                                                 agents=agents)
         
         return agents_actions
         
-    def _step_sequentially(self, timedelta_per_step=None, randomize_agents_order=True):
+    def _step_sequentially(self, timedelta_per_step=None, randomize_agents_order=True, agents=None):
         """
         The sequential version of the _step method to request agents to act. 
         """
         
         # agents can act in a random order
-        reordered_agents = copy.copy(self.agents)
+        reordered_agents = copy.copy(agents if agents is not None else self.agents)
         if randomize_agents_order:
             random.shuffle(reordered_agents)
 
@@ -135,35 +168,225 @@ class TinyWorld:
             logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
             actions = agent.act(return_actions=True)
             agents_actions[agent.name] = actions
+            self._stimuli_count_when_last_acted[agent.name] = agent.stimuli_count
 
             self._handle_actions(agent, agent.pop_latest_actions())
         
         return agents_actions
 
-    def _step_in_parallel(self, timedelta_per_step=None):
+    def _step_in_parallel(self, timedelta_per_step=None, agents=None):
         """
         A parallelized version of the _step method to request agents to act.
         """
+        if agents is None:
+            agents = self.agents
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = {executor.submit(agent.act, return_actions=True): agent for agent in self.agents}
-            agents_actions = {}
+        if self.stream_actions:
+            return self._step_in_parallel_as_completed(timedelta_per_step=timedelta_per_step, agents=agents)
 
-            # Wait for all futures to complete
-            concurrent.futures.wait(futures.keys())
+        results = self._step_executor.act(self, agents)
 
-            for future in futures:
-                agent = futures[future]
-                try:
-                    actions = future.result()
-                    agents_actions[agent.name] = actions
-                    self._handle_actions(agent, agent.pop_latest_actions())
-                except Exception as exc:
+        # the stimuli seen by each agent must be recorded before any action is handled, since handling 
+        # actions can deliver new stimuli to other agents, which they must only see in the next step
+        for agent, actions, exc in results:
+            if exc is None:
+                self._stimuli_count_when_last_acted[agent.name] = agent.stimuli_count
+
+        agents_actions = {}
+        for agent, actions, exc in results:
+            if exc is not None:
+                logger.error(f"[{self.name}] Agent {name_or_empty(agent)} generated an exception: {exc}")
+                continue
+
+            agents_actions[agent.name] = actions
+            self._handle_actions(agent, agent.pop_latest_actions())
+
+        return agents_actions
+
+    def _step_in_parallel_as_completed(self, timedelta_per_step=None, agents=None):
+        """
+        A version of _step_in_parallel that handles the actions of agents while other agents are still acting, 
+        instead of waiting for all of them to finish first.
+
+        Ordering guarantees: actions are still handled in the order of the environment's agents, and the actions of
+        an agent are only handled once all the agents they can affect (see _agents_affected_by_actions) are done acting. 
+        Hence, every agent receives exactly the same stimuli, in the same order, as with _step_in_parallel, and the 
+        resulting state is the same, which keeps simulation caches valid. The time saved comes from handling the actions
+        of the agents that finish first while slower agents are still waiting for the LLM.
+        """
+        agents = list(agents if agents is not None else self.agents)
+        acting_agents_names = set(agent.name for agent in agents)
+
+        finished = {} # agent name -> (actions, exception)
+        latest_actions = {} # agent name -> actions not yet handled
+        next_index = 0
+
+        agents_actions = {}
+
+        def handle_ready_agents():
+            nonlocal next_index
+
+            while next_index < len(agents):
+                agent = agents[next_index]
+                if agent.name not in finished:
+                    return
+
+                actions, exc = finished[agent.name]
+                if exc is not None:
                     logger.error(f"[{self.name}] Agent {name_or_empty(agent)} generated an exception: {exc}")
+                    next_index += 1
+                    continue
+
+                if agent.name not in latest_actions:
+                    latest_actions[agent.name] = agent.pop_latest_actions()
+
+                # agents that are still acting must not be disturbed, so we wait for them (agents not acting in this step 
+                # are never waited for, since they are not going to finish)
+                affected_agents = self._agents_affected_by_actions(agent, latest_actions[agent.name])
+                if any((affected_agent.name in acting_agents_names) and (affected_agent.name not in finished) 
+                       for affected_agent in affected_agents):
+                    return
+                
+                agents_actions[agent.name] = actions
+                self._handle_actions(agent, latest_actions.pop(agent.name))
+                next_index += 1
+
+        for agent, actions, exc in self._step_executor.act_as_completed(self, agents):
+            finished[agent.name] = (actions, exc)
+            if exc is None:
+                self._stimuli_count_when_last_acted[agent.name] = agent.stimuli_count
+            handle_ready_agents()
+
+        # once every agent is done, all the remaining actions can be handled
+        handle_ready_agents()
+        if next_index < len(agents):
+            raise RuntimeError(f"[{self.name}] The actions of {len(agents) - next_index} agents could not be handled.")
 
         return agents_actions
 
+    def _agents_affected_by_actions(self, source: TinyPerson, actions: list) -> list:
+        """
+        Returns the agents whose state can be changed by handling the specified actions, which is used to
+        know which agents must be done acting before the actions can be handled. Subclasses that handle other 
+        actions, or handle them differently, must override this method accordingly.
+
+        Args:
+            source (TinyPerson): The agent that issued the actions.
+            actions (list): The actions issued by the agent.
         
+        Returns:
+            list: The agents that can be affected.
+        """
+        affected_agents = []
+        for action in actions:
+            if action["type"] in ["REACH_OUT", "TALK"]:
+                target_agent = self.get_agent_by_name(action.get("target"))
+                if target_agent is not None:
+                    affected_agents.append(target_agent)
+                elif action["type"] == "TALK" and self.broadcast_if_no_target:
+                    return self.agents
+
+        return affected_agents
+
+    def _agents_to_activate(self) -> list:
+        """
+        Returns the agents that must act in the current step, according to the scheduling policy of the environment.
+        With event-driven scheduling, these are the agents that received new stimuli since they last acted, and
+        those whose wake up is due.
+        """
+        agents = []
+        for agent in self.agents:
+            woken_up = self._pop_due_wake_up(agent)
+            if self.scheduling == "all" or woken_up or self._has_new_stimuli(agent):
+                agents.append(agent)
+
+        if self.scheduling == "event_driven":
+            logger.debug(f"[{self.name}] {len(agents)} of {len(self.agents)} agents will act in this step.")
+
+        return agents
+
+    def _has_new_stimuli(self, agent: TinyPerson) -> bool:
+        return agent.stimuli_count > self._stimuli_count_when_last_acted.get(agent.name, 0)
+
+    def _pop_due_wake_up(self, agent: TinyPerson) -> bool:
+        if agent.name not in self._scheduled_wake_ups:
+            return False
+
+        wake_up_datetime = self._scheduled_wake_ups[agent.name]
+        if (wake_up_datetime is not None) and (self.current_datetime is not None) and \
+           (datetime.fromisoformat(wake_up_datetime) > self.current_datetime):
+            return False
+
+        del self._scheduled_wake_ups[agent.name]
+        return True
+
+    def _wake_up_intervention_targets(self, intervention):
+        """
+        Makes the agents targeted by an intervention (or all agents, if an environment is targeted) act at the next step,
+        since the intervention's effects may concern them even if they bring no new stimuli.
+        """
+        targets = intervention.targets if isinstance(intervention.targets, list) else [intervention.targets]
+        for target in targets:
+            if isinstance(target, TinyWorld):
+                for agent in target.agents:
+                    if agent in self.agents:
+                        self.wake_up(agent)
+            elif target in self.agents:
+                self.wake_up(target)
+
+    def wake_up(self, agent: TinyPerson, at: datetime=None):
+        """
+        Schedules an agent to act, even if it received no new stimuli, which is only relevant with event-driven scheduling.
+
+        Args:
+            agent (TinyPerson): The agent to wake up.
+            at (datetime, optional): The datetime from which the agent must act. Defaults to None, meaning the next step.
+        """
+        # only the earliest wake up of each agent is kept, since acting then will cover the later ones anyway
+        if agent.name in self._scheduled_wake_ups:
+            current_wake_up_datetime = self._scheduled_wake_ups[agent.name]
+            if (current_wake_up_datetime is None) or \
+               ((at is not None) and (datetime.fromisoformat(current_wake_up_datetime) <= at)):
+                return
+
+        self._scheduled_wake_ups[agent.name] = at.isoformat() if at is not None else None
+
+    def is_quiescent(self, include_future_wake_ups=True) -> bool:
+        """
+        Checks whether nothing else would happen in the environment if it were not stimulated further, that is to say, 
+        whether no agent received new stimuli since it last acted and no agent is scheduled to wake up.
+
+        Args:
+            include_future_wake_ups (bool, optional): If False, wake ups scheduled for a datetime that was not reached yet are ignored.
+                Defaults to True.
+        """
+        for agent in self.agents:
+            if self._has_new_stimuli(agent):
+                return False
+
+            if agent.name in self._scheduled_wake_ups:
+                wake_up_datetime = self._scheduled_wake_ups[agent.name]
+                if include_future_wake_ups or (wake_up_datetime is None) or (self.current_datetime is None) or \
+                   (datetime.fromisoformat(wake_up_datetime) <= self.current_datetime):
+                    return False
+
+        return True
+
+    def step_executor_stats(self) -> dict:
+        """
+        Returns the metrics of the executor used to make agents act in parallel, namely, the number of agents waiting
+        for a worker (queue_depth), the number of agents acting (in_progress), and the time taken by each agent to act
+        (agent_latencies).
+        """
+        return self._step_executor.stats()
+
+    def close(self):
+        """
+        Releases the resources used by the environment, such as the workers that make agents act in parallel.
+        The environment can still be used afterwards, in which case they are created again.
+        """
+        if self._owns_step_executor:
+            self._step_executor.shutdown()
 
     def _advance_datetime(self, timedelta):
         """
@@ -206,6 +429,45 @@ class TinyWorld:
         
         if return_actions:
             return agents_actions_over_time
+
+    @transactional()
+    @config_manager.config_defaults(parallelize="parallel_agent_actions")
+    def run_until_quiescent(self, max_steps: int=100, timedelta_per_step=None, return_actions=False, randomize_agents_order=True, parallelize=None):
+        """
+        Runs the environment until it is quiescent (see is_quiescent), that is, until agents have no more stimuli to react to, 
+        or until the maximum number of steps is reached. This is most useful with event-driven scheduling, in which only the agents
+        that have something to react to act at each step.
+
+        Args:
+            max_steps (int, optional): The maximum number of steps to run, since agents might keep stimulating each other forever. Defaults to 100.
+            timedelta_per_step (timedelta, optional): The time interval between steps. If None, time does not advance, so wake ups 
+                scheduled for the future are not waited for. Defaults to None.
+            return_actions (bool, optional): If True, returns the actions taken by the agents. Defaults to False.
+            randomize_agents_order (bool, optional): If True, randomizes the order in which agents act. Defaults to True.
+            parallelize (bool, optional): If True, agents act in parallel. Defaults to True.
+        
+        Returns:
+            list: A list of actions taken by the agents over time, if return_actions is True, in the same format as in run().
+        """
+        agents_actions_over_time = []
+        for i in range(max_steps):
+            if self.is_quiescent(include_future_wake_ups=timedelta_per_step is not None):
+                logger.info(f"[{self.name}] Environment is quiescent after {i} steps.")
+                break
+
+            logger.info(f"[{self.name}] Running world simulation step {i+1} (at most {max_steps}) until quiescent.")
+
+            if TinyWorld.communication_display:
+                self._display_step_communication(cur_step=i+1, total_steps=max_steps, timedelta_per_step=timedelta_per_step)
+
+            agents_actions = self._step(timedelta_per_step=timedelta_per_step, randomize_agents_order=randomize_agents_order, parallelize=parallelize)
+            agents_actions_over_time.append(agents_actions)
+        
+        else:
+            logger.warning(f"[{self.name}] Environment was still not quiescent after {max_steps} steps.")
+        
+        if return_actions:
+            return agents_actions_over_time
     
     @transactional()
     def skip(self, steps: int, timedelta_per_step=None):
@@ -753,10 +1015,14 @@ class TinyWorld:
     # IO
     #######################################################################
 
-    def encode_complete_state(self) -> dict:
+    def encode_complete_state(self, agents_by_reference=None) -> dict:
         """
         Encodes the complete state of the environment in a dictionary.
 
+        Args:
+            agents_by_reference (collection, optional): The names of the agents that are encoded elsewhere, and which
+                are therefore only referred to (as {"name": ..., "agent_ref": True}) instead of encoded. Defaults to None.
+
         Returns:
             dict: A dictionary encoding the complete state of the environment.
         """
@@ -764,6 +1030,8 @@ class TinyWorld:
 
         # remove the logger and other fields
         del to_copy['console']
+        del to_copy['_step_executor']
+        del to_copy['_owns_step_executor']
         del to_copy['agents']
         del to_copy['name_to_agent']
         del to_copy['current_datetime']
@@ -772,7 +1040,9 @@ class TinyWorld:
         state = copy.deepcopy(to_copy)
 
         # agents are encoded separately
-        state["agents"] = [agent.encode_complete_state() for agent in self.agents]
+        state["agents"] = [{"name": agent.name, "agent_ref": True} if (agents_by_reference is not None) and (agent.name in agents_by_reference) 
+                           else agent.encode_complete_state()
+                           for agent in self.agents]
 
         # datetime also has to be encoded separately
         state["current_datetime"] = self.current_datetime.isoformat()
@@ -861,6 +1131,9 @@ class TinyWorld:
     @staticmethod
     def clear_environments():
         """
-        Clears the list of all environments.
+        Clears the list of all environments, closing them.
         """
+        for environment in TinyWorld.all_environments.values():
+            environment.close()
+
         TinyWorld.all_environments = {}
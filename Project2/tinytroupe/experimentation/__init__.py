@@ -8,5 +8,6 @@ logger = logging.getLogger("tinytroupe")
 from .randomization import ABRandomizer
 from .proposition import Proposition, check_proposition, compute_score
 from .in_place_experiment_runner import InPlaceExperimentRunner
+from .parallel_world_runner import ParallelWorldRunner
 
-__all__ = ["ABRandomizer", "Proposition", "InPlaceExperimentRunner"]
\ No newline at end of file
+__all__ = ["ABRandomizer", "Proposition", "InPlaceExperimentRunner", "ParallelWorldRunner"]
\ No newline at end of file
@@ -0,0 +1,176 @@
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import time
+import traceback
+
+from tinytroupe.experimentation import logger
+import tinytroupe.control as control
+from tinytroupe import utils
+
+
+class ParallelWorldRunner:
+    """
+    Runs several independent simulations (e.g., the arms of an A/B experiment, or repetitions with different seeds)
+    in parallel worker processes. Each simulation runs in isolation, with its own agents, environments and factories
+    registries, and its own simulation cache file, so that they can use every available core.
+
+    Since worlds and agents cannot be shipped across processes, each simulation is specified by a function that builds
+    and runs it, returning its results. The function must be importable by the workers (i.e., defined at the top level
+    of a module), and its results must be picklable (e.g., extracted values rather than the agents themselves). As usual
+    with worker processes, scripts must call run() under an `if __name__ == "__main__":` guard.
+
+    Example:
+        runner = ParallelWorldRunner(max_workers=8, cache_dir="./cache")
+        for seed in range(8):
+            runner.add_world(f"treatment_{seed}", run_treatment, seed=seed, kwargs={"ad": ad_text})
+        results = runner.run()
+    """
+
+    def __init__(self, max_workers:int=None, cache_dir:str=".", use_cache:bool=True):
+        """
+        Initializes the runner.
+
+        Args:
+            max_workers (int, optional): The maximum number of worker processes. Defaults to the number of CPUs.
+            cache_dir (str, optional): The directory where each simulation's cache file is stored. Defaults to the current directory.
+            use_cache (bool, optional): Whether each simulation runs under a simulation control scope (control.begin/end) with its
+                own cache file, so that it can be resumed or replayed later. Defaults to True.
+        """
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
+        self.use_cache = use_cache
+
+        self.worlds = {} # {world_name: {"function": ..., "kwargs": ..., "seed": ...}, ...}
+        self.results = {} # {world_name: result, ...}
+        self.errors = {} # {world_name: formatted traceback, ...}
+        self.stats = {} # {world_name: {"elapsed_seconds": ..., "cache_hits": ..., "cache_misses": ...}, ...}
+
+    def add_world(self, name:str, function, kwargs:dict=None, seed:int=None):
+        """
+        Adds a simulation to be run.
+
+        Args:
+            name (str): A unique name for the simulation, also used to name its cache file.
+            function (callable): A top-level function that builds and runs the simulation, returning its results.
+            kwargs (dict, optional): The keyword arguments to call the function with. Defaults to None.
+            seed (int, optional): The seed of the worker's random number generator before the simulation runs. Defaults to None.
+        """
+        if name in self.worlds:
+            raise ValueError(f"Simulation names must be unique, but '{name}' was already added.")
+
+        self.worlds[name] = {"function": function, "kwargs": kwargs if kwargs is not None else {}, "seed": seed}
+
+        return self # for chaining
+
+    def cache_path(self, name:str) -> str:
+        """
+        Returns the path of the cache file of the specified simulation, or None if caching is not used.
+        """
+        if not self.use_cache:
+            return None
+
+        return os.path.join(self.cache_dir, f"tinytroupe-{name}.cache.trace")
+
+    def trace(self, name:str):
+        """
+        Returns the simulation trace stored by the specified simulation, or None if there is none.
+        """
+        from tinytroupe.trace_store import open_trace # import here to avoid circular import issues
+
+        cache_path = self.cache_path(name)
+        if cache_path is None:
+            return None
+
+        return open_trace(cache_path)
+
+    def run(self, raise_on_error:bool=False) -> dict:
+        """
+        Runs all the simulations added so far, in parallel, and gathers their results.
+
+        Args:
+            raise_on_error (bool, optional): Whether to raise an error if any simulation fails. Otherwise, failures are logged
+                and recorded in the `errors` attribute. Defaults to False.
+
+        Returns:
+            dict: The results of the simulations that succeeded, as {world_name: result}.
+        """
+        if self.use_cache:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # spawn is used to make sure every worker starts without any state inherited from this process
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(_run_world_in_worker, world["function"], world["kwargs"],
+                                       self.cache_path(name), world["seed"]): name
+                       for name, world in self.worlds.items()}
+
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as exc:
+                    outcome = {"error": "".join(traceback.format_exception(exc)), "stats": {}}
+
+                self.stats[name] = outcome["stats"]
+                if "error" in outcome:
+                    logger.error(f"Simulation '{name}' failed:\n{outcome['error']}")
+                    self.errors[name] = outcome["error"]
+                else:
+                    logger.info(f"Simulation '{name}' finished in {outcome['stats']['elapsed_seconds']:.1f} seconds.")
+                    self.results[name] = outcome["result"]
+                    self.errors.pop(name, None)
+
+        if raise_on_error and len(self.errors) > 0:
+            raise RuntimeError(f"{len(self.errors)} simulations failed: {list(self.errors.keys())}")
+
+        return {name: self.results[name] for name in self.worlds if name in self.results}
+
+
+def _reset_registries():
+    from tinytroupe.agent import TinyPerson
+    from tinytroupe.environment import TinyWorld
+    from tinytroupe.factory.tiny_factory import TinyFactory
+    from tinytroupe.factory.tiny_person_factory import TinyPersonFactory
+
+    control.reset()
+    TinyPerson.clear_agents()
+    TinyWorld.clear_environments()
+    TinyFactory.clear_factories()
+    TinyPersonFactory.clear_factories()
+    utils.reset_fresh_id()
+
+def _run_world_in_worker(function, kwargs:dict, cache_path:str, seed:int) -> dict:
+    """
+    Runs a simulation in the current worker process, isolated from any simulation previously run by the same worker.
+    """
+    _reset_registries()
+
+    if seed is not None:
+        random.seed(seed)
+
+    start = time.monotonic()
+    stats = {}
+    try:
+        if cache_path is not None:
+            control.begin(cache_path=cache_path)
+
+        try:
+            result = function(**kwargs)
+        finally:
+            if cache_path is not None:
+                simulation = control.current_simulation()
+                stats["cache_hits"] = simulation.cache_hits
+                stats["cache_misses"] = simulation.cache_misses
+                control.end()
+
+    except Exception as exc:
+        stats["elapsed_seconds"] = time.monotonic() - start
+        return {"error": "".join(traceback.format_exception(exc)), "stats": stats}
+
+    finally:
+        _reset_registries()
+
+    stats["elapsed_seconds"] = time.monotonic() - start
+    return {"result": result, "stats": stats}
@@ -18,7 +18,8 @@ import threading
 
 import math
 
-# to protect from race conditions when generating agents in parallel
+# to protect from race conditions when generating agents in parallel. It only guards short updates to shared
+# bookkeeping (e.g., names in use), and is never held during model calls.
 concurrent_agent_generataion_lock = threading.Lock()
 
 
@@ -27,6 +28,13 @@ class TinyPersonFactory(TinyFactory):
     # keep track of all the names generated by all the factories, to ensure they are globally unique.
     all_unique_names=[]
 
+    # how many times to try to generate a one-off name that is not taken by a concurrently generated agent
+    MAX_NAME_RESERVATION_ATTEMPTS = 5
+
+    # factory name -> lock that makes sure the factory's sampling plan is initialized only once. These are kept
+    # here rather than in the factories themselves, since factories' attributes must be serializable.
+    _sampling_plan_locks = {}
+
     def __init__(self, sampling_space_description:str=None, total_population_size:int=None, context:str=None, simulation_id:str=None):
         """
         Initialize a TinyPersonFactory instance.
@@ -202,7 +210,8 @@ class TinyPersonFactory(TinyFactory):
         # are we going to use a pre-computed sample of characteristics too?
         if self.population_size is not None:
             
-            with concurrent_agent_generataion_lock:
+            # only other generations from this same factory need to wait for its sampling plan
+            with TinyPersonFactory._sampling_plan_locks.setdefault(self.name, threading.Lock()):
                 if self.remaining_characteristics_sample is None:
                     # if the sample does not exist, we generate it here once.
                     self.initialize_sampling_plan()
@@ -240,10 +249,22 @@ class TinyPersonFactory(TinyFactory):
                          {json.dumps(sampled_characteristics, indent=4)}
                     """
         else: # no predefined population size, so we generate one-off agents.
-            # CONCURRENT PROTECTION
-            with concurrent_agent_generataion_lock:
-                fresh_agent_name = self._unique_full_name(already_generated_names=TinyPersonFactory._all_used_and_precomputed_names(), 
+            # the name is generated without holding any lock, since that requires a model call, and then reserved,
+            # unless a concurrent generation took it meanwhile, in which case another one is generated.
+            for _ in range(TinyPersonFactory.MAX_NAME_RESERVATION_ATTEMPTS):
+                candidate_name = self._unique_full_name(already_generated_names=TinyPersonFactory._all_used_and_precomputed_names(), 
                                                         context=self.context_text)
+                
+                # CONCURRENT PROTECTION
+                with concurrent_agent_generataion_lock:
+                    if candidate_name not in TinyPersonFactory._all_used_and_precomputed_names():
+                        TinyPersonFactory.all_unique_names.append(candidate_name)
+                        fresh_agent_name = candidate_name
+                        break
+            
+            if fresh_agent_name is None:
+                logger.warning(f"Could not reserve a fresh name after {TinyPersonFactory.MAX_NAME_RESERVATION_ATTEMPTS} attempts. Using the latest one generated.")
+                fresh_agent_name = candidate_name
 
             if agent_particularities is not None:
                 agent_particularities = \
@@ -321,14 +342,18 @@ class TinyPersonFactory(TinyFactory):
             # the agent is created here. This is why the present method cannot be cached. Instead, an auxiliary method is used
             # for the actual model call, so that it gets cached properly without skipping the agent creation.
             
-            # protect parallel agent generation
+            # protect parallel agent generation: registering the agent's name must be atomic
             with concurrent_agent_generataion_lock:
                 person = TinyPerson(agent_spec["name"])
-                self._setup_agent(person, agent_spec)
-                if post_processing_func is not None:
-                    post_processing_func(person)
+            
+            # the agent is not shared yet, so it can be set up without any lock (this might involve model calls)
+            self._setup_agent(person, agent_spec)
+            if post_processing_func is not None:
+                post_processing_func(person)
+            minibio = person.minibio()
 
-                self.generated_minibios.append(person.minibio())
+            with concurrent_agent_generataion_lock:
+                self.generated_minibios.append(minibio)
                 self.generated_names.append(person.get("name"))
 
             return person
@@ -601,7 +626,8 @@ class TinyPersonFactory(TinyFactory):
             
             # update the global list of unique names
             new_names = [sample["name"] for sample in self.remaining_characteristics_sample]
-            TinyPersonFactory.all_unique_names = list(set(TinyPersonFactory.all_unique_names + new_names))
+            with concurrent_agent_generataion_lock:
+                TinyPersonFactory.all_unique_names = list(set(TinyPersonFactory.all_unique_names + new_names))
             
         else:
             raise ValueError("Sampling plan already initialized. Cannot reinitialize it.")
@@ -1219,7 +1245,8 @@ class TinyPersonFactory(TinyFactory):
             if cur_iterations >= max_iterations and len(names) < n:
                 logger.error(f"Could not generate the requested number of names after {max_iterations} iterations. Moving on with the {len(names)} names generated.")
             
-            TinyPersonFactory.all_unique_names = list(set(TinyPersonFactory.all_unique_names + names))
+            with concurrent_agent_generataion_lock:
+                TinyPersonFactory.all_unique_names = list(set(TinyPersonFactory.all_unique_names + names))
 
         return names
 
@@ -1,8 +1,13 @@
 import os
+import asyncio
+import collections
+import functools
+import hashlib
+import threading
 import openai
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+import httpx
 import time
-import pickle
 import logging
 import configparser
 from typing import Union
@@ -10,6 +15,7 @@ from typing import Union
 
 import tiktoken
 from tinytroupe import utils
+from tinytroupe.api_cache import APICache, EmbeddingCache, request_fingerprint, canonical_request_json
 from tinytroupe.control import transactional
 from tinytroupe import default
 from tinytroupe import config_manager
@@ -28,6 +34,10 @@ class OpenAIClient:
     A utility class for interacting with the OpenAI API.
     """
 
+    # provider limits for a single embedding request
+    MAX_EMBEDDING_INPUTS_PER_REQUEST = 2048
+    MAX_EMBEDDING_TOKENS_PER_REQUEST = 300000
+
     def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
         logger.debug("Initializing OpenAIClient")
 
@@ -44,7 +54,7 @@ class OpenAIClient:
         self.cache_api_calls = cache_api_calls
         self.cache_file_name = cache_file_name
         if self.cache_api_calls:
-            # load the cache, if any
+            # open the cache store, if any. Entries are read lazily, on lookup.
             self.api_cache = self._load_cache()
     
     
@@ -101,7 +111,8 @@ class OpenAIClient:
         stop (str): A string that, if encountered in the generated response, will cause the generation to stop.
         max_attempts (int): The maximum number of attempts to make before giving up on generating a response.
         timeout (int): The maximum number of seconds to wait for a response from the API.
-        waiting_time (int): The number of seconds to wait between requests.
+        waiting_time (int): The number of seconds to wait before retrying a failed request. Request admission itself is 
+            governed by the shared rate limiter (see `register_rate_limiter`).
         exponential_backoff_factor (int): The factor by which to increase the waiting time between requests.
         n (int): The number of completions to generate.
         response_format: The format of the response, if any.
@@ -128,59 +139,37 @@ class OpenAIClient:
         # setup the OpenAI configurations for this client.
         self._setup_from_config()
 
-        # dedent the messages (field 'content' only) if needed (using textwrap)
-        if dedent_messages:
-            for message in current_messages:
-                if "content" in message:
-                    message["content"] = utils.dedent(message["content"])
-            
-        
-        # We need to adapt the parameters to the API type, so we create a dictionary with them first
-        chat_api_params = {
-            "model": model,
-            "messages": current_messages,
-            "temperature": temperature,
-            "max_tokens":max_tokens,
-            "top_p": top_p,
-            "frequency_penalty": frequency_penalty,
-            "presence_penalty": presence_penalty,
-            "stop": stop,
-            "timeout": timeout,
-            "stream": False,
-            "n": n,
-        }
+        chat_api_params = self._build_chat_api_params(current_messages, dedent_messages, model, temperature, max_tokens, top_p,
+                                                      frequency_penalty, presence_penalty, stop, timeout, n, response_format)
+        cache_key, cache_request_metadata = self._cache_key(model, chat_api_params)
+        estimated_tokens = None # computed only if a request is actually sent
 
-        if response_format is not None:
-            chat_api_params["response_format"] = response_format
+        # counting tokens is not free, so we only do it for the log if it will actually be shown
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Sending messages to OpenAI API. Token count={self._count_tokens(current_messages, model)}.")
 
         i = 0
         while i < max_attempts:
             try:
                 i += 1
 
-                try:
-                    logger.debug(f"Sending messages to OpenAI API. Token count={self._count_tokens(current_messages, model)}.")
-                except NotImplementedError:
-                    logger.debug(f"Token count not implemented for model {model}.")
-                    
                 start_time = time.monotonic()
                 logger.debug(f"Calling model with client class {self.__class__.__name__}.")
 
                 ###############################################################
                 # call the model, either from the cache or from the API
                 ###############################################################
-                cache_key = str((model, chat_api_params)) # need string to be hashable
-                if self.cache_api_calls and (cache_key in self.api_cache):
-                    response = self.api_cache[cache_key]
-                else:
-                    if waiting_time > 0:
-                        logger.info(f"Waiting {waiting_time} seconds before next API request (to avoid throttling)...")
-                        time.sleep(waiting_time)
+                response = self.api_cache.get(cache_key) if self.cache_api_calls else None
+                if response is None:
+                    # wait until the shared rate limiter admits the request (to avoid throttling)
+                    if estimated_tokens is None:
+                        estimated_tokens = self._estimate_request_tokens(current_messages, model)
+                    rate_limiter().acquire(estimated_tokens)
                     
                     response = self._raw_model_call(model, chat_api_params)
+                    rate_limiter().record_usage(self._completion_tokens(response))
                     if self.cache_api_calls:
-                        self.api_cache[cache_key] = response
-                        self._save_cache()
+                        self.api_cache.put(cache_key, response, request=cache_request_metadata)
                 
                 
                 logger.debug(f"Got response from API: {response}")
@@ -188,10 +177,7 @@ class OpenAIClient:
                 logger.debug(
                     f"Got response in {end_time - start_time:.2f} seconds after {i} attempts.")
 
-                if enable_pydantic_model_return:
-                    return utils.to_pydantic_or_sanitized_dict(self._raw_model_response_extractor(response), model=response_format)
-                else:
-                    return utils.sanitize_dict(self._raw_model_response_extractor(response))
+                return self._extract_response(response, enable_pydantic_model_return, response_format)
 
             except InvalidRequestError as e:
                 logger.error(f"[{i}] Invalid request error, won't retry: {e}")
@@ -223,6 +209,61 @@ class OpenAIClient:
         logger.error(f"Failed to get response after {max_attempts} attempts.")
         return None
     
+    def _build_chat_api_params(self, current_messages, dedent_messages, model, temperature, max_tokens, top_p,
+                               frequency_penalty, presence_penalty, stop, timeout, n, response_format):
+        """
+        Builds the parameters of a chat completion request.
+        """
+        # dedent the messages (field 'content' only) if needed (using textwrap)
+        if dedent_messages:
+            for message in current_messages:
+                if "content" in message:
+                    message["content"] = utils.dedent(message["content"])
+            
+        
+        # We need to adapt the parameters to the API type, so we create a dictionary with them first
+        chat_api_params = {
+            "model": model,
+            "messages": current_messages,
+            "temperature": temperature,
+            "max_tokens":max_tokens,
+            "top_p": top_p,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+            "stop": stop,
+            "timeout": timeout,
+            "stream": False,
+            "n": n,
+        }
+
+        if response_format is not None:
+            chat_api_params["response_format"] = response_format
+
+        return chat_api_params
+
+    def _cache_key(self, model, chat_api_params):
+        """
+        Returns the cache key of a request, and the request description to store with it, if any.
+
+        The cache key is a compact fingerprint of the request, which must be computed before any attempt, since
+        _raw_model_call() may adapt the parameters. The full request is only kept when debugging.
+        """
+        if not self.cache_api_calls:
+            return None, None
+
+        cache_key = request_fingerprint(model, chat_api_params)
+        cache_request_metadata = canonical_request_json(model, chat_api_params) if logger.isEnabledFor(logging.DEBUG) else None
+        return cache_key, cache_request_metadata
+
+    def _extract_response(self, response, enable_pydantic_model_return, response_format):
+        """
+        Converts the raw API response into the value returned by send_message().
+        """
+        if enable_pydantic_model_return:
+            return utils.to_pydantic_or_sanitized_dict(self._raw_model_response_extractor(response), model=response_format)
+        else:
+            return utils.sanitize_dict(self._raw_model_response_extractor(response))
+
     def _raw_model_call(self, model, chat_api_params):
         """
         Calls the OpenAI API with the given parameters. Subclasses should
@@ -230,29 +271,13 @@ class OpenAIClient:
         """   
 
         # adjust parameters depending on the model
-        if self._is_reasoning_model(model):
-            # Reasoning models have slightly different parameters
-            del chat_api_params["stream"]
-            del chat_api_params["temperature"]
-            del chat_api_params["top_p"]
-            del chat_api_params["frequency_penalty"]
-            del chat_api_params["presence_penalty"]            
-
-            chat_api_params["max_completion_tokens"] = chat_api_params["max_tokens"]
-            del chat_api_params["max_tokens"]
-
-            chat_api_params["reasoning_effort"] = default["reasoning_effort"]
-
+        self._adapt_chat_api_params(model, chat_api_params)
 
         # To make the log cleaner, we remove the messages from the logged parameters
         logged_params = {k: v for k, v in chat_api_params.items() if k != "messages"} 
 
         if "response_format" in chat_api_params:
             # to enforce the response format via pydantic, we need to use a different method
-
-            if "stream" in chat_api_params:
-                del chat_api_params["stream"]
-
             logger.debug(f"Calling LLM model (using .parse too) with these parameters: {logged_params}. Not showing 'messages' parameter.")
             # complete message
             logger.debug(f"   --> Complete messages sent to LLM: {chat_api_params['messages']}")
@@ -269,6 +294,27 @@ class OpenAIClient:
                         **chat_api_params
                     )
 
+    def _adapt_chat_api_params(self, model, chat_api_params):
+        """
+        Adapts, in place, the parameters of a request to the specifics of the given model.
+        """
+        if self._is_reasoning_model(model) and "max_tokens" in chat_api_params:
+            # Reasoning models have slightly different parameters
+            del chat_api_params["stream"]
+            del chat_api_params["temperature"]
+            del chat_api_params["top_p"]
+            del chat_api_params["frequency_penalty"]
+            del chat_api_params["presence_penalty"]            
+
+            chat_api_params["max_completion_tokens"] = chat_api_params["max_tokens"]
+            del chat_api_params["max_tokens"]
+
+            chat_api_params["reasoning_effort"] = default["reasoning_effort"]
+
+        if "response_format" in chat_api_params:
+            # to enforce the response format via pydantic, we need to use a different method, which does not accept streaming
+            chat_api_params.pop("stream", None)
+
     def _is_reasoning_model(self, model):
         return "o1" in model or "o3" in model
 
@@ -279,77 +325,44 @@ class OpenAIClient:
         """
         return response.choices[0].message.to_dict()
 
-    def _count_tokens(self, messages: list, model: str):
+    def _estimate_request_tokens(self, messages: list, model: str) -> int:
+        """
+        Estimates the number of tokens a request will consume, for rate limiting purposes. Only computed
+        if the shared rate limiter actually limits tokens.
         """
-        Count the number of OpenAI tokens in a list of messages using tiktoken.
+        if not rate_limiter().limits_tokens():
+            return 0
 
-        Adapted from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+        num_tokens = self._count_tokens(messages, model)
+        if num_tokens is None:
+            # rough approximation, used when the model's tokenizer is not known
+            num_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 4
+        return num_tokens
 
-        Args:
-        messages (list): A list of dictionaries representing the conversation history.
-        model (str): The name of the model to use for encoding the string.
+    def _completion_tokens(self, response) -> int:
         """
-        try:
-            try:
-                encoding = tiktoken.encoding_for_model(model)
-            except KeyError:
-                logger.debug("Token count: model not found. Using cl100k_base encoding.")
-                encoding = tiktoken.get_encoding("cl100k_base")
-            
-            if model in {
-                "gpt-3.5-turbo-0613",
-                "gpt-3.5-turbo-16k-0613",
-                "gpt-4-0314",
-                "gpt-4-32k-0314",
-                "gpt-4-0613",
-                "gpt-4-32k-0613",
-                } or "o1" in model or "o3" in model: # assuming o1/3 models work the same way
-                tokens_per_message = 3
-                tokens_per_name = 1
-            elif model == "gpt-3.5-turbo-0301":
-                tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-                tokens_per_name = -1  # if there's a name, the role is omitted
-            elif "gpt-3.5-turbo" in model:
-                logger.debug("Token count: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-                return self._count_tokens(messages, model="gpt-3.5-turbo-0613")
-            elif ("gpt-4" in model) or ("ppo" in model) :
-                logger.debug("Token count: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-                return self._count_tokens(messages, model="gpt-4-0613")
-            else:
-                raise NotImplementedError(
-                    f"""_count_tokens() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-                )
-            
-            num_tokens = 0
-            for message in messages:
-                num_tokens += tokens_per_message
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-            num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-            return num_tokens
-        
-        except Exception as e:
-            logger.error(f"Error counting tokens: {e}")
-            return None
+        Returns the number of completion tokens reported in the API response, if any.
+        """
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "completion_tokens", None) or 0
 
-    def _save_cache(self):
+    def _count_tokens(self, messages: list, model: str):
         """
-        Saves the API cache to disk. We use pickle to do that because some obj
-        are not JSON serializable.
+        Count the number of OpenAI tokens in a list of messages using tiktoken. See `count_tokens()`.
+
+        Args:
+        messages (list): A list of dictionaries representing the conversation history.
+        model (str): The name of the model to use for encoding the string.
         """
-        # use pickle to save the cache
-        pickle.dump(self.api_cache, open(self.cache_file_name, "wb", encoding="utf-8", errors="replace"))
+        return count_tokens(messages, model)
 
-    
     def _load_cache(self):
-
         """
-        Loads the API cache from disk.
+        Opens the API cache store on disk. Any legacy pickle cache is imported into it.
         """
-        # unpickle
-        return pickle.load(open(self.cache_file_name, "rb", encoding="utf-8", errors="replace")) if os.path.exists(self.cache_file_name) else {}
+        return APICache(self.cache_file_name,
+                        max_entries=default["cache_max_entries"],
+                        max_age_days=default["cache_max_age_days"])
 
     def get_embedding(self, text, model=default["embedding_model"]):
         """
@@ -362,25 +375,122 @@ class OpenAIClient:
         Returns:
         The embedding of the text.
         """
-        response = self._raw_embedding_model_call(text, model)
-        return self._raw_embedding_model_response_extractor(response)
+        return self.get_embeddings([text], model)[0]
+
+    def get_embeddings(self, texts, model=default["embedding_model"], max_attempts=None, waiting_time=None,
+                       exponential_backoff_factor=None):
+        """
+        Gets the embeddings of the given texts using the specified model. Many texts are packed in each
+        request, up to the provider's limits, so that embedding a large number of texts takes only a few round trips.
+
+        Args:
+        texts (list): The texts to embed.
+        model (str): The name of the model to use for embedding the texts.
+        max_attempts (int): The maximum number of attempts for each request.
+        waiting_time (int): The number of seconds to wait before retrying a failed request.
+        exponential_backoff_factor (int): The factor by which to increase the waiting time between retries.
+
+        Returns:
+        A list with the embedding of each text, in the same order as the texts.
+        """
+        max_attempts = int(utils.first_non_none(max_attempts, default["max_attempts"]))
+        waiting_time = utils.first_non_none(waiting_time, default["waiting_time"])
+        exponential_backoff_factor = utils.first_non_none(exponential_backoff_factor, default["exponential_backoff_factor"])
+
+        embeddings, missing_texts = self._lookup_cached_embeddings(texts, model)
+        if not missing_texts:
+            return embeddings
+
+        self._setup_from_config()
+
+        new_embeddings = []
+        for batch in self._embedding_batches(missing_texts):
+            backoff = waiting_time if waiting_time > 0 else 2
+            for i in range(1, max_attempts + 1):
+                try:
+                    rate_limiter().acquire(self._estimate_embedding_tokens(batch))
+                    response = self._raw_embedding_model_call(batch, model)
+                    new_embeddings.extend(self._raw_embedding_model_response_extractor(response))
+                    break
+
+                except (InvalidRequestError, openai.BadRequestError):
+                    # there's no point in retrying if the request is invalid
+                    raise
+
+                except Exception as e:
+                    if i >= max_attempts:
+                        raise
+                    logger.warning(f"[{i}] {type(e).__name__} Error while getting embeddings, waiting {backoff} seconds and trying again: {e}")
+                    time.sleep(backoff)
+                    backoff = backoff * exponential_backoff_factor
+
+        return self._merge_new_embeddings(texts, model, embeddings, missing_texts, new_embeddings)
+
+    def _lookup_cached_embeddings(self, texts, model):
+        """
+        Looks the given texts up in the embedding cache, if enabled.
+
+        Returns:
+        A list with the cached embedding of each text (or None, if not cached), and the list of distinct texts
+        that still need to be embedded.
+        """
+        cache = embedding_cache()
+        embeddings = cache.get_many(model, texts) if cache is not None else [None] * len(texts)
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        return embeddings, missing_texts
+
+    def _merge_new_embeddings(self, texts, model, embeddings, missing_texts, new_embeddings):
+        """
+        Stores newly obtained embeddings in the embedding cache, if enabled, and fills them in the results.
+        """
+        cache = embedding_cache()
+        if cache is not None:
+            cache.put_many(model, missing_texts, new_embeddings)
+
+        text_to_embedding = dict(zip(missing_texts, new_embeddings))
+        return [embedding if embedding is not None else text_to_embedding[text] for text, embedding in zip(texts, embeddings)]
+
+    def _embedding_batches(self, texts):
+        """
+        Splits the given texts into batches that respect the provider's limits on the number of inputs
+        and of tokens per embedding request.
+        """
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            text_tokens = self._estimate_embedding_tokens([text])
+            if batch and (len(batch) >= OpenAIClient.MAX_EMBEDDING_INPUTS_PER_REQUEST or 
+                          batch_tokens + text_tokens > OpenAIClient.MAX_EMBEDDING_TOKENS_PER_REQUEST):
+                yield batch
+                batch = []
+                batch_tokens = 0
+
+            batch.append(text)
+            batch_tokens += text_tokens
+
+        if batch:
+            yield batch
+
+    def _estimate_embedding_tokens(self, texts) -> int:
+        # a conservative approximation (~3 characters per token), which avoids running the tokenizer
+        return sum(len(text) for text in texts) // 3 + len(texts)
     
-    def _raw_embedding_model_call(self, text, model):
+    def _raw_embedding_model_call(self, texts, model):
         """
-        Calls the OpenAI API to get the embedding of the given text. Subclasses should
+        Calls the OpenAI API to get the embeddings of the given texts. Subclasses should
         override this method to implement their own API calls.
         """
         return self.client.embeddings.create(
-            input=[text],
+            input=texts,
             model=model
         )
     
     def _raw_embedding_model_response_extractor(self, response):
         """
-        Extracts the embedding from the API response. Subclasses should
+        Extracts the embeddings, in input order, from the API response. Subclasses should
         override this method to implement their own response extraction.
         """
-        return response.data[0].embedding
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
 
 class AzureClient(OpenAIClient):
 
@@ -412,6 +522,396 @@ class AzureClient(OpenAIClient):
             )
     
 
+class AsyncOpenAIClient(OpenAIClient):
+    """
+    An asyncio-native client for the OpenAI API. All instances share a single event loop (running in a 
+    background thread), a single HTTP connection pool and a global semaphore that bounds the number of
+    requests in flight, so that many concurrent callers do not need one connection (or thread) each.
+
+    The `asend_message`, `aget_embedding` and `aget_embeddings` coroutines are the native interface. The synchronous
+    `send_message`, `get_embedding` and `get_embeddings` methods are a facade over them, so existing callers keep working.
+    """
+
+    # shared by all async clients, created lazily by _shared_loop()
+    _loop = None
+    _loop_thread = None
+    _loop_lock = threading.Lock()
+    _semaphore = None
+    _http_client = None
+
+    def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
+        logger.debug("Initializing AsyncOpenAIClient")
+        self.async_client = None
+
+        super().__init__(cache_api_calls, cache_file_name)
+
+    @staticmethod
+    def _shared_loop():
+        """
+        Returns the event loop shared by all async clients, starting it if needed.
+        """
+        with AsyncOpenAIClient._loop_lock:
+            if AsyncOpenAIClient._loop is None:
+                max_concurrent_requests = default["max_concurrent_requests"]
+
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="tinytroupe-llm-event-loop", daemon=True)
+                thread.start()
+
+                AsyncOpenAIClient._semaphore = asyncio.Semaphore(max_concurrent_requests)
+                AsyncOpenAIClient._http_client = openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=max_concurrent_requests,
+                                        max_keepalive_connections=max_concurrent_requests))
+                AsyncOpenAIClient._loop_thread = thread
+                AsyncOpenAIClient._loop = loop
+
+            return AsyncOpenAIClient._loop
+
+    async def _on_shared_loop(self, coroutine):
+        """
+        Awaits the given coroutine on the shared event loop, which owns the connection pool and the semaphore.
+        """
+        loop = AsyncOpenAIClient._shared_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coroutine
+        else:
+            return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+    def _run_sync(self, coroutine):
+        """
+        Runs the given coroutine on the shared event loop, blocking until it is done.
+        """
+        loop = AsyncOpenAIClient._shared_loop()
+        if threading.current_thread() is AsyncOpenAIClient._loop_thread:
+            coroutine.close()
+            raise RuntimeError("The synchronous facade cannot be used from within the shared event loop. Await the async methods instead.")
+
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def _setup_from_config(self):
+        """
+        Sets up the async OpenAI API client, reusing the shared connection pool.
+        """
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                            http_client=AsyncOpenAIClient._http_client)
+
+    def send_message(self, current_messages, **kwargs):
+        """
+        Synchronous facade over `asend_message`. Accepts the same arguments as `OpenAIClient.send_message`.
+        """
+        return self._run_sync(self.asend_message(current_messages, **kwargs))
+
+    def get_embedding(self, text, model=default["embedding_model"]):
+        """
+        Synchronous facade over `aget_embedding`.
+        """
+        return self._run_sync(self.aget_embedding(text, model))
+
+    def get_embeddings(self, texts, model=default["embedding_model"], max_attempts=None, waiting_time=None,
+                       exponential_backoff_factor=None):
+        """
+        Synchronous facade over `aget_embeddings`. Accepts the same arguments as `OpenAIClient.get_embeddings`.
+        """
+        return self._run_sync(self.aget_embeddings(texts, model, max_attempts=max_attempts, waiting_time=waiting_time,
+                                                   exponential_backoff_factor=exponential_backoff_factor))
+
+    async def asend_message(self, current_messages, **kwargs):
+        """
+        Sends a message to the OpenAI API and returns the response. Accepts the same arguments as
+        `OpenAIClient.send_message`.
+        """
+        return await self._on_shared_loop(self._asend_message(current_messages, **kwargs))
+
+    async def aget_embedding(self, text, model=default["embedding_model"]):
+        """
+        Gets the embedding of the given text using the specified model.
+        """
+        return (await self.aget_embeddings([text], model))[0]
+
+    async def aget_embeddings(self, texts, model=default["embedding_model"], max_attempts=None, waiting_time=None,
+                              exponential_backoff_factor=None):
+        """
+        Gets the embeddings of the given texts using the specified model, packing many texts in each request.
+        The requests for different batches are sent concurrently, and each one is retried like in `OpenAIClient.get_embeddings`.
+        """
+        return await self._on_shared_loop(self._aget_embeddings(texts, model, max_attempts, waiting_time, exponential_backoff_factor))
+
+    @config_manager.config_defaults(
+        model="model",
+        temperature="temperature",
+        max_tokens="max_tokens",
+        top_p="top_p",
+        frequency_penalty="frequency_penalty",
+        presence_penalty="presence_penalty",
+        timeout="timeout",
+        max_attempts="max_attempts",
+        waiting_time="waiting_time",
+        exponential_backoff_factor="exponential_backoff_factor",
+        response_format=None,
+        echo=None
+    )
+    async def _asend_message(self,
+                    current_messages,
+                    dedent_messages=True,
+                    model=None,
+                    temperature=None,
+                    max_tokens=None,
+                    top_p=None,
+                    frequency_penalty=None,
+                    presence_penalty=None,
+                    stop=[],
+                    timeout=None,
+                    max_attempts=None,
+                    waiting_time=None,
+                    exponential_backoff_factor=None,
+                    n = 1,
+                    response_format=None,
+                    enable_pydantic_model_return=False,
+                    echo=False):
+
+        async def aux_exponential_backoff():
+            nonlocal waiting_time
+
+            # in case waiting time was initially set to 0
+            if waiting_time <= 0:
+                waiting_time = 2
+
+            logger.info(f"Request failed. Waiting {waiting_time} seconds between requests...")
+            await asyncio.sleep(waiting_time)
+
+            # exponential backoff
+            waiting_time = waiting_time * exponential_backoff_factor
+
+        self._setup_from_config()
+
+        chat_api_params = self._build_chat_api_params(current_messages, dedent_messages, model, temperature, max_tokens, top_p,
+                                                      frequency_penalty, presence_penalty, stop, timeout, n, response_format)
+        cache_key, cache_request_metadata = self._cache_key(model, chat_api_params)
+        estimated_tokens = None # computed only if a request is actually sent
+
+        i = 0
+        while i < max_attempts:
+            try:
+                i += 1
+                start_time = time.monotonic()
+
+                response = self.api_cache.get(cache_key) if self.cache_api_calls else None
+                if response is None:
+                    if estimated_tokens is None:
+                        estimated_tokens = self._estimate_request_tokens(current_messages, model)
+                    await rate_limiter().aacquire(estimated_tokens)
+
+                    async with AsyncOpenAIClient._semaphore:
+                        response = await self._raw_model_call_async(model, chat_api_params)
+                    rate_limiter().record_usage(self._completion_tokens(response))
+
+                    if self.cache_api_calls:
+                        self.api_cache.put(cache_key, response, request=cache_request_metadata)
+
+                logger.debug(f"Got response in {time.monotonic() - start_time:.2f} seconds after {i} attempts.")
+                return self._extract_response(response, enable_pydantic_model_return, response_format)
+
+            except (InvalidRequestError, openai.BadRequestError) as e:
+                logger.error(f"[{i}] Invalid request error, won't retry: {e}")
+                return None
+
+            except openai.RateLimitError:
+                logger.warning(f"[{i}] Rate limit error, waiting a bit and trying again.")
+                await aux_exponential_backoff()
+
+            except Exception as e:
+                logger.error(f"[{i}] {type(e).__name__} Error: {e}")
+                await aux_exponential_backoff()
+
+        logger.error(f"Failed to get response after {max_attempts} attempts.")
+        return None
+
+    async def _raw_model_call_async(self, model, chat_api_params):
+        """
+        Calls the OpenAI API asynchronously with the given parameters.
+        """
+        self._adapt_chat_api_params(model, chat_api_params)
+
+        if "response_format" in chat_api_params:
+            return await self.async_client.beta.chat.completions.parse(**chat_api_params)
+        else:
+            return await self.async_client.chat.completions.create(**chat_api_params)
+
+    async def _aget_embeddings(self, texts, model, max_attempts=None, waiting_time=None, exponential_backoff_factor=None):
+        max_attempts = int(utils.first_non_none(max_attempts, default["max_attempts"]))
+        waiting_time = utils.first_non_none(waiting_time, default["waiting_time"])
+        exponential_backoff_factor = utils.first_non_none(exponential_backoff_factor, default["exponential_backoff_factor"])
+
+        embeddings, missing_texts = self._lookup_cached_embeddings(texts, model)
+        if not missing_texts:
+            return embeddings
+
+        self._setup_from_config()
+
+        async def aux_embed_batch(batch):
+            backoff = waiting_time if waiting_time > 0 else 2
+            for i in range(1, max_attempts + 1):
+                try:
+                    await rate_limiter().aacquire(self._estimate_embedding_tokens(batch))
+                    async with AsyncOpenAIClient._semaphore:
+                        response = await self.async_client.embeddings.create(input=batch, model=model)
+                    return self._raw_embedding_model_response_extractor(response)
+
+                except (InvalidRequestError, openai.BadRequestError):
+                    # there's no point in retrying if the request is invalid
+                    raise
+
+                except Exception as e:
+                    if i >= max_attempts:
+                        raise
+                    logger.warning(f"[{i}] {type(e).__name__} Error while getting embeddings, waiting {backoff} seconds and trying again: {e}")
+                    await asyncio.sleep(backoff)
+                    backoff = backoff * exponential_backoff_factor
+
+        batches_embeddings = await asyncio.gather(*[aux_embed_batch(batch) for batch in self._embedding_batches(missing_texts)])
+        new_embeddings = [embedding for batch_embeddings in batches_embeddings for embedding in batch_embeddings]
+
+        return self._merge_new_embeddings(texts, model, embeddings, missing_texts, new_embeddings)
+
+
+class AsyncAzureClient(AsyncOpenAIClient):
+
+    def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
+        logger.debug("Initializing AsyncAzureClient")
+
+        super().__init__(cache_api_calls, cache_file_name)
+
+    def _setup_from_config(self):
+        """
+        Sets up the async Azure OpenAI Service API client, reusing the shared connection pool.
+        """
+        if self.async_client is not None:
+            return
+
+        if os.getenv("AZURE_OPENAI_KEY"):
+            logger.info("Using Azure OpenAI Service API with key.")
+            self.async_client = AsyncAzureOpenAI(azure_endpoint= os.getenv("AZURE_OPENAI_ENDPOINT"),
+                                                 api_version = config["OpenAI"]["AZURE_API_VERSION"],
+                                                 api_key = os.getenv("AZURE_OPENAI_KEY"),
+                                                 http_client=AsyncOpenAIClient._http_client)
+        else:  # Use Entra ID Auth
+            logger.info("Using Azure OpenAI Service API with Entra ID Auth.")
+            from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+
+            credential = DefaultAzureCredential()
+            token_provider = get_bearer_token_provider(credential, "https://cognitiveservices.azure.com/.default")
+            self.async_client = AsyncAzureOpenAI(
+                azure_endpoint= os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_version = config["OpenAI"]["AZURE_API_VERSION"],
+                azure_ad_token_provider=token_provider,
+                http_client=AsyncOpenAIClient._http_client
+            )
+
+
+###########################################################################
+# Token counting
+#
+# Encoders are built once per model, and the token counts of message
+# contents are memoized, since the same (long) prompt fragments are 
+# counted over and over again across actions.
+###########################################################################
+_token_count_cache = collections.OrderedDict() # {(encoding_name, content_digest): num_tokens}
+_token_count_cache_max_size = 8192
+_token_count_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _token_counting_scheme(model: str):
+    """
+    Returns the (encoding, tokens_per_message, tokens_per_name) used to count tokens for the given model,
+    or None if token counting is not implemented for it.
+    """
+    if model in {
+        "gpt-3.5-turbo-0613",
+        "gpt-3.5-turbo-16k-0613",
+        "gpt-4-0314",
+        "gpt-4-32k-0314",
+        "gpt-4-0613",
+        "gpt-4-32k-0613",
+        } or "o1" in model or "o3" in model: # assuming o1/3 models work the same way
+        tokens_per_message = 3
+        tokens_per_name = 1
+    elif model == "gpt-3.5-turbo-0301":
+        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    elif "gpt-3.5-turbo" in model:
+        logger.debug("Token count: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
+        return _token_counting_scheme("gpt-3.5-turbo-0613")
+    elif ("gpt-4" in model) or ("ppo" in model) :
+        logger.debug("Token count: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
+        return _token_counting_scheme("gpt-4-0613")
+    else:
+        return None
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.debug("Token count: model not found. Using cl100k_base encoding.")
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+    return encoding, tokens_per_message, tokens_per_name
+
+def _count_text_tokens(encoding, text: str) -> int:
+    """
+    Counts the tokens of the given text, memoizing the result by content digest.
+    """
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8", errors="replace"), digest_size=16).digest())
+    with _token_count_cache_lock:
+        num_tokens = _token_count_cache.get(key)
+        if num_tokens is not None:
+            _token_count_cache.move_to_end(key)
+            return num_tokens
+
+    num_tokens = len(encoding.encode(text))
+
+    with _token_count_cache_lock:
+        _token_count_cache[key] = num_tokens
+        if len(_token_count_cache) > _token_count_cache_max_size:
+            _token_count_cache.popitem(last=False)
+
+    return num_tokens
+
+def count_tokens(messages: list, model: str):
+    """
+    Count the number of OpenAI tokens in a list of messages using tiktoken.
+
+    Adapted from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+    Args:
+    messages (list): A list of dictionaries representing the conversation history.
+    model (str): The name of the model to use for encoding the string.
+
+    Returns:
+    The number of tokens, or None if they could not be counted (e.g., the model is not supported).
+    """
+    try:
+        scheme = _token_counting_scheme(model)
+        if scheme is None:
+            raise NotImplementedError(
+                f"""count_tokens() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+            )
+        encoding, tokens_per_message, tokens_per_name = scheme
+
+        num_tokens = 0
+        for message in messages:
+            num_tokens += tokens_per_message
+            for key, value in message.items():
+                num_tokens += _count_text_tokens(encoding, value if isinstance(value, str) else str(value))
+                if key == "name":
+                    num_tokens += tokens_per_name
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return num_tokens
+
+    except Exception as e:
+        logger.error(f"Error counting tokens: {e}")
+        return None
+
+
 ###########################################################################
 # Exceptions
 ###########################################################################
@@ -427,6 +927,110 @@ class NonTerminalError(Exception):
     """
     pass
 
+###########################################################################
+# Rate limiting
+#
+# All clients share one process-wide rate limiter, so that parallel agents,
+# worlds and factories are admitted at the configured rate, instead of
+# being throttled by the API after the fact.
+###########################################################################
+class RateLimiter:
+    """
+    A thread-safe token-bucket rate limiter, tracking both requests per minute and tokens per minute.
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._lock = threading.Lock()
+        self._last_refill = time.monotonic()
+        # buckets start full, so that initial bursts are allowed
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+
+    def limits_tokens(self) -> bool:
+        """
+        Whether this limiter limits tokens, and therefore needs token estimates.
+        """
+        return self.tokens_per_minute > 0
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Reserves capacity for one request with the given number of tokens, and returns how long the caller
+        must wait, in seconds, before sending it. Reservations may drive the buckets below zero, so that
+        concurrent callers queue up in order.
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_refill
+            self._last_refill = now
+
+            wait = 0.0
+            if self.requests_per_minute > 0:
+                self._available_requests = min(self.requests_per_minute,
+                                               self._available_requests + elapsed * self.requests_per_minute / 60.0)
+                self._available_requests -= 1
+                if self._available_requests < 0:
+                    wait = max(wait, -self._available_requests * 60.0 / self.requests_per_minute)
+
+            if self.tokens_per_minute > 0:
+                self._available_tokens = min(self.tokens_per_minute,
+                                             self._available_tokens + elapsed * self.tokens_per_minute / 60.0)
+                # a single request larger than the whole bucket would otherwise never be admitted
+                self._available_tokens -= min(tokens, self.tokens_per_minute)
+                if self._available_tokens < 0:
+                    wait = max(wait, -self._available_tokens * 60.0 / self.tokens_per_minute)
+
+            return wait
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Blocks until a request with the given estimated number of tokens can be sent.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logger.info(f"Rate limiter: waiting {wait:.2f} seconds before next API request.")
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """
+        Waits, without blocking the event loop, until a request with the given estimated number of tokens can be sent.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logger.info(f"Rate limiter: waiting {wait:.2f} seconds before next API request.")
+            await asyncio.sleep(wait)
+
+    def record_usage(self, tokens: int) -> None:
+        """
+        Debits tokens that were consumed but not known in advance (e.g., the completion tokens of a response).
+        """
+        if self.tokens_per_minute > 0 and tokens:
+            with self._lock:
+                self._available_tokens -= tokens
+
+
+_rate_limiter = RateLimiter(requests_per_minute=default["requests_per_minute"],
+                            tokens_per_minute=default["tokens_per_minute"])
+
+def register_rate_limiter(limiter: RateLimiter):
+    """
+    Registers the rate limiter shared by all clients.
+
+    Args:
+    limiter (RateLimiter): The rate limiter to use.
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
+
+def rate_limiter() -> RateLimiter:
+    """
+    Returns the rate limiter shared by all clients.
+    """
+    return _rate_limiter
+
 ###########################################################################
 # Clients registry
 #
@@ -499,9 +1103,53 @@ def force_api_cache(cache_api_calls, cache_file_name=default["cache_file_name"])
     for client in _api_type_to_client.values():
         client.set_api_cache(cache_api_calls, cache_file_name)
 
+###########################################################################
+# Embedding cache
+#
+# A single, process-wide, cache of embeddings, shared by all clients.
+###########################################################################
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+_embedding_cache_enabled = default["cache_embeddings"]
+_embedding_cache_file_name = default["embedding_cache_file_name"]
+
+def embedding_cache():
+    """
+    Returns the embedding cache shared by all clients, opening it if needed, or None if embeddings are not cached.
+    """
+    global _embedding_cache
+    if not _embedding_cache_enabled:
+        return None
+
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(_embedding_cache_file_name)
+        return _embedding_cache
+
+def force_embedding_cache(cache_embeddings, cache_file_name=default["embedding_cache_file_name"]):
+    """
+    Forces the use of the given embedding cache configuration, thus overriding any other configuration.
+
+    Args:
+    cache_embeddings (bool): Whether to cache embeddings.
+    cache_file_name (str): The base name of the files to use for caching embeddings.
+    """
+    global _embedding_cache, _embedding_cache_enabled, _embedding_cache_file_name
+    with _embedding_cache_lock:
+        if _embedding_cache is not None:
+            _embedding_cache.close()
+            _embedding_cache = None
+
+        _embedding_cache_enabled = cache_embeddings
+        _embedding_cache_file_name = cache_file_name
+
 # default client
 register_client("openai", OpenAIClient())
 register_client("azure", AzureClient())
 
+# async clients, sharing one connection pool and bounding the number of requests in flight
+register_client("openai_async", AsyncOpenAIClient())
+register_client("azure_async", AsyncAzureClient())
+
 
 
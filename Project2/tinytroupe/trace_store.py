@@ -0,0 +1,461 @@
+"""
+On-disk storage for simulation traces (see `tinytroupe.control`).
+
+A trace is kept in an append-only file of length-prefixed records, one per trace entry. Checkpointing a simulation
+thus only writes the entries that were added (or changed) since the previous checkpoint, rather than the whole trace.
+The offsets of the records are indexed when the file is opened, and entries are only read (and decoded) when they are
+actually needed, so resuming a simulation does not require loading the whole trace in memory.
+
+Each record holds a compact JSON encoding of the entry (the same values the legacy JSON traces held), compressed with
+zlib when large enough to be worth it. Legacy JSON traces (e.g., `tinytroupe-default.cache.json`) are converted
+automatically the first time they are opened through `open_trace`, and can also be converted explicitly with
+`convert_json_trace`.
+"""
+import atexit
+import collections
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import logging
+logger = logging.getLogger("tinytroupe")
+
+
+def resolve_trace_paths(cache_path: str):
+    """
+    Returns the path of the trace file corresponding to the given cache path, as well as the path of the legacy
+    JSON trace it might have to be converted from. If the cache path refers to a legacy JSON trace (i.e., ends in `.json`),
+    the trace file is kept alongside it, with the `.trace` extension.
+    """
+    root, extension = os.path.splitext(cache_path)
+    if extension == ".json":
+        return root + ".trace", cache_path
+    else:
+        return cache_path, root + ".json"
+
+
+def open_trace(cache_path: str, compress: bool = True):
+    """
+    Opens the trace stored at the given cache path, converting the corresponding legacy JSON trace if needed.
+
+    Returns:
+        SimulationTrace: The trace, or None if there is no trace stored there yet.
+    """
+    trace_path, legacy_path = resolve_trace_paths(cache_path)
+
+    if not os.path.exists(trace_path):
+        if os.path.exists(legacy_path):
+            convert_json_trace(legacy_path, trace_path, compress=compress)
+        else:
+            return None
+
+    return SimulationTrace(trace_path, compress=compress)
+
+
+def convert_json_trace(json_path: str, trace_path: str = None, compress: bool = True) -> str:
+    """
+    Converts a legacy JSON trace into a trace file. An existing trace file at the destination is overwritten.
+
+    Args:
+        json_path (str): The path of the JSON trace.
+        trace_path (str, optional): The path of the trace file to write. Defaults to the JSON path, with the `.trace` extension.
+        compress (bool): Whether to compress large records.
+
+    Returns:
+        str: The path of the trace file written.
+    """
+    if trace_path is None:
+        trace_path = resolve_trace_paths(json_path)[0]
+
+    with open(json_path, "r", encoding="utf-8", errors="replace") as f:
+        entries = json.load(f)
+
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+
+    trace = SimulationTrace(trace_path, entries=entries, compress=compress)
+    trace.save()
+    trace.close()
+
+    logger.info(f"Converted legacy JSON trace {json_path} ({len(entries)} entries) into {trace_path}.")
+    return trace_path
+
+
+class TraceFile:
+    """
+    An append-only file of length-prefixed records, each holding a JSON-encoded value.
+    """
+
+    MAGIC = b"TTTRACE1"
+
+    # each record starts with the length of its payload and its flags
+    _RECORD_HEADER = struct.Struct("<IB")
+    _FLAG_COMPRESSED = 0x01
+
+    # records smaller than this (in bytes) are not worth compressing
+    COMPRESSION_THRESHOLD = 1024
+
+    def __init__(self, path: str, compress: bool = True) -> None:
+        self.path = path
+        self.compress = compress
+
+        self._lock = threading.Lock() # reads and writes might come from different threads (e.g., a TraceWriter)
+        self._offsets = [] # the offset of each record in the file
+
+        if os.path.exists(path):
+            self._file = open(path, "r+b")
+            if self._file.read(len(TraceFile.MAGIC)) != TraceFile.MAGIC:
+                self._file.close()
+                raise ValueError(f"Not a simulation trace file: {path}")
+            self._index()
+        else:
+            self._file = open(path, "w+b")
+            self._file.write(TraceFile.MAGIC)
+            self._file.flush()
+            self._end = len(TraceFile.MAGIC)
+
+    def _index(self):
+        """
+        Scans the record headers to find the offset of each record. An incomplete record at the end of the
+        file (e.g., due to an interrupted write) is discarded.
+        """
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+
+        offset = len(TraceFile.MAGIC)
+        while offset + TraceFile._RECORD_HEADER.size <= size:
+            self._file.seek(offset)
+            length, _ = TraceFile._RECORD_HEADER.unpack(self._file.read(TraceFile._RECORD_HEADER.size))
+            end = offset + TraceFile._RECORD_HEADER.size + length
+            if end > size:
+                break
+
+            self._offsets.append(offset)
+            offset = end
+
+        if offset != size:
+            logger.warning(f"Trace file {self.path} ends with an incomplete record, probably from an interrupted checkpoint. Discarding it.")
+            self._file.truncate(offset)
+
+        self._end = offset
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def read(self, i: int):
+        """
+        Reads and decodes the i-th record.
+        """
+        with self._lock:
+            self._file.seek(self._offsets[i])
+            length, flags = TraceFile._RECORD_HEADER.unpack(self._file.read(TraceFile._RECORD_HEADER.size))
+            payload = self._file.read(length)
+
+        if flags & TraceFile._FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        return json.loads(payload)
+
+    def encode(self, value) -> bytes:
+        """
+        Encodes the given value as a record, ready to be appended. Encoding does not touch the file, so it can happen concurrently.
+        """
+        payload = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        flags = 0
+        if self.compress and len(payload) >= TraceFile.COMPRESSION_THRESHOLD:
+            payload = zlib.compress(payload)
+            flags |= TraceFile._FLAG_COMPRESSED
+
+        return TraceFile._RECORD_HEADER.pack(len(payload), flags) + payload
+
+    def append(self, values: list) -> None:
+        """
+        Encodes the given values and appends them, as new records, to the end of the file.
+        """
+        self.append_records([self.encode(value) for value in values])
+
+    def append_records(self, records: list) -> None:
+        """
+        Appends the given, already encoded, records to the end of the file.
+        """
+        with self._lock:
+            offset = self._end
+            for record in records:
+                self._offsets.append(offset)
+                offset += len(record)
+
+            self._file.seek(self._end)
+            self._file.write(b"".join(records))
+            self._file.flush()
+            self._end = offset
+
+    def truncate(self, n: int) -> None:
+        """
+        Drops all records from the n-th onwards.
+        """
+        with self._lock:
+            if n < len(self._offsets):
+                self._end = self._offsets[n]
+                del self._offsets[n:]
+                self._file.truncate(self._end)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class SimulationTrace:
+    """
+    A list-like view of a trace file. Entries that are already stored are read lazily, while entries that were
+    added (or replaced) since the last `save()` are kept in memory.
+
+    Saving happens in two steps, so that the expensive one can run in the background (see `TraceWriter`): a `snapshot()`
+    of the entries to save is taken, which is cheap, and then `write()` encodes and writes it. Entries of a snapshot
+    that is not written yet are kept in memory, so they can still be read meanwhile.
+    """
+
+    # how many recently used entries to keep decoded in memory
+    READ_CACHE_SIZE = 64
+
+    def __init__(self, path: str, entries: list = None, compress: bool = True) -> None:
+        """
+        Opens (or creates) the trace file.
+
+        Args:
+            path (str): The path of the trace file.
+            entries (list, optional): If given, the entries that replace whatever is stored in the file, once saved.
+            compress (bool): Whether to compress large records.
+        """
+        self.path = path
+
+        self._lock = threading.RLock()
+        self._file = TraceFile(path, compress=compress)
+        self._read_cache = collections.OrderedDict() # {position: entry}
+        self._unwritten = {} # {position: entry}, for entries in snapshots not yet written
+
+        if entries is None:
+            self._saved = len(self._file) # how many entries, from the start, are stored in the file (or being so) as they are
+            self._pending = []
+        else:
+            self._saved = 0
+            self._pending = list(entries)
+
+    def __len__(self) -> int:
+        return self._saved + len(self._pending)
+
+    def _position(self, i: int) -> int:
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("trace index out of range")
+        return i
+
+    def __getitem__(self, i):
+        with self._lock:
+            if isinstance(i, slice):
+                return [self[j] for j in range(*i.indices(len(self)))]
+
+            i = self._position(i)
+            if i >= self._saved:
+                return self._pending[i - self._saved]
+
+            if i in self._unwritten:
+                return self._unwritten[i]
+
+            if i in self._read_cache:
+                self._read_cache.move_to_end(i)
+                return self._read_cache[i]
+
+            entry = self._file.read(i)
+            self._remember(i, entry)
+            return entry
+
+    def __setitem__(self, i: int, entry) -> None:
+        """
+        Replaces an entry. If it was already saved, it (and whatever follows it) is written again at the next save.
+        """
+        with self._lock:
+            i = self._position(i)
+            if i < self._saved:
+                self._pending = [entry] + [self[j] for j in range(i + 1, self._saved)] + self._pending
+                self._forget_from(i)
+                self._saved = i
+            else:
+                self._pending[i - self._saved] = entry
+
+    def __delitem__(self, i) -> None:
+        """
+        Deletes a suffix of the trace, e.g., `del trace[n:]`. Traces only ever shrink from the end.
+        """
+        with self._lock:
+            if not isinstance(i, slice) or i.step not in (None, 1) or i.stop is not None:
+                raise ValueError("Only suffixes of a simulation trace can be deleted.")
+
+            start = i.indices(len(self))[0]
+            if start < self._saved:
+                self._pending = []
+                self._forget_from(start)
+                self._saved = start
+            else:
+                del self._pending[start - self._saved:]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, entry) -> None:
+        with self._lock:
+            self._pending.append(entry)
+
+    def snapshot(self) -> tuple:
+        """
+        Takes a snapshot of the entries to save, and considers them saved from now on.
+
+        Returns:
+            tuple: (position, entries), where position is the position of the first entry in the snapshot. The stored
+                   entries from that position onwards are to be replaced by the snapshot entries.
+        """
+        with self._lock:
+            # parallel segments (dicts) are the only entries that might still change in place, so they are copied
+            entries = [dict(entry) if isinstance(entry, dict) else entry for entry in self._pending]
+            position = self._saved
+
+            for k, entry in enumerate(entries):
+                self._unwritten[position + k] = entry
+            self._saved += len(entries)
+            self._pending = []
+
+            return position, entries
+
+    def write(self, snapshot: tuple) -> None:
+        """
+        Encodes and writes a snapshot to the file. Snapshots must be written in the order they were taken.
+        """
+        position, entries = snapshot
+        records = [self._file.encode(entry) for entry in entries]
+
+        self._file.truncate(position)
+        self._file.append_records(records)
+
+        with self._lock:
+            for k, entry in enumerate(entries):
+                # the entry might have been dropped (or replaced) meanwhile
+                if self._unwritten.get(position + k) is entry:
+                    del self._unwritten[position + k]
+
+                    # the latest entries are the most likely to be used next
+                    if k >= len(entries) - SimulationTrace.READ_CACHE_SIZE:
+                        self._remember(position + k, entry)
+
+    def save(self) -> None:
+        """
+        Writes the pending entries to the file, after dropping the stored entries they replace.
+        """
+        self.write(self.snapshot())
+
+    @staticmethod
+    def merge_snapshots(earlier: tuple, later: tuple) -> tuple:
+        """
+        Merges two consecutive snapshots into one that has the same effect when written.
+        """
+        earlier_position, earlier_entries = earlier
+        later_position, later_entries = later
+
+        if later_position <= earlier_position:
+            return later
+        else:
+            # the later snapshot always starts at most right after the earlier one ends
+            return earlier_position, earlier_entries[:later_position - earlier_position] + later_entries
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def _remember(self, i: int, entry) -> None:
+        self._read_cache[i] = entry
+        self._read_cache.move_to_end(i)
+        while len(self._read_cache) > SimulationTrace.READ_CACHE_SIZE:
+            self._read_cache.popitem(last=False)
+
+    def _forget_from(self, i: int) -> None:
+        for position in [position for position in self._read_cache if position >= i]:
+            del self._read_cache[position]
+        for position in [position for position in self._unwritten if position >= i]:
+            del self._unwritten[position]
+
+
+class TraceWriter:
+    """
+    Writes trace snapshots in a background thread, so that checkpointing does not block the simulation. Snapshots
+    submitted while a previous one is still waiting to be written are coalesced into a single write. Writes can also
+    be spaced by a minimum interval, during which further snapshots are coalesced as well.
+    """
+
+    def __init__(self, min_interval_seconds: float = 0) -> None:
+        self.min_interval_seconds = min_interval_seconds
+
+        self._condition = threading.Condition()
+        self._queued = {} # {id(trace): (trace, snapshot)}
+        self._writing = False
+        self._flushing = False
+        self._last_write_time = 0
+
+        self._thread = threading.Thread(target=self._run, name="TraceWriter", daemon=True)
+        self._thread.start()
+
+        # whatever was submitted must be written before the interpreter exits
+        atexit.register(self.flush)
+
+    def submit(self, trace: SimulationTrace) -> None:
+        """
+        Takes a snapshot of the given trace and queues it for writing.
+        """
+        with self._condition:
+            snapshot = trace.snapshot()
+            key = id(trace)
+            if key in self._queued:
+                snapshot = SimulationTrace.merge_snapshots(self._queued[key][1], snapshot)
+            self._queued[key] = (trace, snapshot)
+            self._condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until all submitted snapshots are written, ignoring the minimum interval between writes.
+
+        Returns:
+            bool: Whether everything was written before the timeout, if any.
+        """
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            done = self._condition.wait_for(lambda: not self._queued and not self._writing, timeout=timeout)
+            self._flushing = False
+            return done
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queued)
+
+                # coalesce further snapshots until the minimum interval has passed, unless someone is waiting for them
+                remaining = self._last_write_time + self.min_interval_seconds - time.monotonic()
+                while remaining > 0 and not self._flushing:
+                    self._condition.wait(remaining)
+                    remaining = self._last_write_time + self.min_interval_seconds - time.monotonic()
+
+                queued = list(self._queued.values())
+                self._queued = {}
+                self._writing = True
+
+            for trace, snapshot in queued:
+                try:
+                    trace.write(snapshot)
+                except Exception as e:
+                    logger.error(f"An error occurred while writing the trace file {trace.path}: {e}")
+
+            with self._condition:
+                self._writing = False
+                self._last_write_time = time.monotonic()
+                self._condition.notify_all()